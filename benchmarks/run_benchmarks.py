@@ -0,0 +1,280 @@
+"""
+Benchmarks of the hot paths of the conversion and of the split at increasing scales on synthetic datasets (see
+synthetic_dicom), with the results written in a json file to track the regressions
+
+Run from the root of the repository: python -m benchmarks.run_benchmarks -o results.json [-b previous_results.json]
+
+Authors: Chris Foulon
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+import nibabel as nib
+import pydicom
+
+from data_identification.modules import dicom_metadata, dicom_to_nifti, extra_utils, nifti_utils
+from benchmarks import synthetic_dicom
+
+# options of dcm2niix used by dicom_to_nifti.convert_dataset (see dicom_to_nifti.plan_dataset)
+filename_format = '%p_%t_%s__pref__'
+converter_options = ['-d', '0', '-f', filename_format]
+
+
+def time_function(function, repeat=1, setup=None):
+    """
+    Returns
+    -------
+    (time_list, result) : tuple
+        the duration of each call of function in seconds and the result of the last call (setup is called before each
+        call, outside of the timing)
+    """
+    time_list = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        time_list.append(time.perf_counter() - start)
+    return time_list, result
+
+
+def create_result(name, scale, time_list, item_count, unit, **parameters):
+    return {'name': name, 'scale': scale, 'parameters': parameters, 'items': item_count, 'unit': unit,
+            'times': time_list, 'min': min(time_list), 'median': statistics.median(time_list),
+            'items_per_second': item_count / max(min(time_list), 1e-9)}
+
+
+def list_dicom_folders(input_list):
+    """
+    The folders containing files in the inputs that are directories (the zip archives are not listed)
+    """
+    folder_list = []
+    for input_path in input_list:
+        if os.path.isdir(input_path):
+            folder_list += [path for entry_type, path, stats in extra_utils.discover_inputs(input_path)
+                            if entry_type == 'folder' and stats[1] > 0]
+    return folder_list
+
+
+def benchmark_scan(folder_list, scale, repeat):
+    result_list = []
+    file_count = sum([extra_utils.get_folder_file_stats(f)[1] for f in folder_list])
+    for name, scan_options in [('scan_dicomdir', {}), ('scan_dicomdir_prescan', {'prescan': True})]:
+        time_list, _ = time_function(
+            lambda: [dicom_metadata.scan_dicomdir(f, filename_format, **scan_options) for f in folder_list], repeat)
+        result_list.append(create_result(name, scale, time_list, file_count, 'files', folders=len(folder_list)))
+    return result_list
+
+
+def benchmark_conversion(input_list, output_folder, file_count, scale, repeat, nb_cores):
+    def reset_output():
+        shutil.rmtree(output_folder, ignore_errors=True)
+        os.makedirs(output_folder)
+
+    result_list = []
+    time_list, _ = time_function(
+        lambda: [dicom_to_nifti.convert_subdir(p, output_folder, filename_format,
+                                               converter_options=list(converter_options), rerun='delete')
+                 for p in input_list], repeat, setup=reset_output)
+    result_list.append(create_result('convert_subdir', scale, time_list, file_count, 'files', inputs=len(input_list)))
+    time_list, _ = time_function(
+        lambda: dicom_to_nifti.convert_dataset(input_list, output_folder, rerun='delete', nb_cores=nb_cores),
+        repeat, setup=reset_output)
+    result_list.append(create_result('convert_dataset', scale, time_list, file_count, 'files',
+                                     inputs=len(input_list), nb_cores=nb_cores))
+    output_dir_list = [d for d, _, _ in os.walk(output_folder)]
+    time_list, _ = time_function(
+        lambda: [extra_utils.check_output_integrity(d) for d in output_dir_list], repeat)
+    result_list.append(create_result('check_output_integrity', scale, time_list, len(output_dir_list), 'folders'))
+    # the duplicates (resent series) are removed by the first call
+    time_list, (final_dict, _) = time_function(
+        lambda: extra_utils.create_final_dict(output_folder, check_integrity=True, nb_cores=nb_cores), repeat)
+    result_list.append(create_result('create_final_dict', scale, time_list, len(output_dir_list), 'folders',
+                                     outputs=len(final_dict), nb_cores=nb_cores))
+    return result_list
+
+
+def create_dwi(path, matrix_size, slice_count, volume_count, rng):
+    data = rng.integers(0, 4096, (matrix_size, matrix_size, slice_count, volume_count), dtype=np.int16)
+    nib.save(nib.Nifti1Image(data, np.diag([2., 2., 2., 1.])), path)
+    bvalues = np.tile([0, 1000, 2000, 3000], volume_count // 4 + 1)[:volume_count]
+    np.savetxt(path.split('.')[0] + '.bval', bvalues[None], fmt='%d')
+
+
+def benchmark_split(work_folder, scale_dict, scale, repeat, nb_cores):
+    """
+    Split synthetic DWI images of matrix_size x matrix_size x slice_count voxels and 4 * serie_count volumes (one per
+    study for the dataset split)
+    """
+    rng = np.random.default_rng(0)
+    image_folder = os.path.join(work_folder, 'dwi')
+    split_folder = os.path.join(work_folder, 'split')
+    os.makedirs(image_folder, exist_ok=True)
+    volume_count = 4 * scale_dict['serie_count']
+    path_list = []
+    for study_index in range(scale_dict['study_count']):
+        path = os.path.join(image_folder, 'dwi{:05d}.nii.gz'.format(study_index))
+        create_dwi(path, scale_dict['matrix_size'], scale_dict['slice_count'], volume_count, rng)
+        path_list.append(path)
+
+    def reset_split():
+        shutil.rmtree(split_folder, ignore_errors=True)
+        os.makedirs(split_folder)
+
+    result_list = []
+    for compression, virtual in [('gzip', False), ('parallel', False), ('none', False), ('gzip', True)]:
+        name = 'split_dwi4d_and_label_{}'.format('virtual' if virtual else compression)
+        time_list, _ = time_function(
+            lambda: nifti_utils.split_dwi4d_and_label(path_list[0], split_folder, compression=compression,
+                                                      nb_threads=nb_cores, virtual=virtual), repeat, setup=reset_split)
+        result_list.append(create_result(name, scale, time_list, volume_count, 'volumes'))
+    time_list, _ = time_function(
+        lambda: nifti_utils.split_dataset(path_list, split_folder, nb_cores=nb_cores, resume=False), repeat,
+        setup=reset_split)
+    result_list.append(create_result('split_dataset', scale, time_list, volume_count * len(path_list), 'volumes',
+                                     images=len(path_list), nb_cores=nb_cores))
+    loader = nifti_utils.VolumeLoader()
+    handle_list = [nifti_utils.volume_handle(path_list[0], i) for i in range(volume_count)]
+    time_list, _ = time_function(lambda: [loader.load(h) for h in handle_list], repeat, setup=loader.clear)
+    result_list.append(create_result('volume_loader', scale, time_list, volume_count, 'volumes'))
+    return result_list
+
+
+def parse_scale(scale):
+    """
+    'STUDIESxSERIESxSLICES' (e.g. '4x4x32') -> scale dictionary
+    """
+    try:
+        study_count, serie_count, slice_count = [int(s) for s in scale.lower().split('x')]
+    except ValueError:
+        raise ValueError('[{}] is not a scale like STUDIESxSERIESxSLICES (e.g. 4x4x32)'.format(scale))
+    return {'study_count': study_count, 'serie_count': serie_count, 'slice_count': slice_count}
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'date': datetime.now().isoformat(), 'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpu_count': multiprocessing.cpu_count(),
+            'numpy': np.__version__, 'nibabel': nib.__version__, 'pydicom': pydicom.__version__}
+
+
+def compare_results(result_list, baseline_list, threshold=1.2):
+    """
+    Log the ratio of the median times of the benchmarks found in both lists, the ratios above threshold are reported
+    as regressions.
+
+    Returns
+    -------
+    regression_list : list of dict
+    """
+    baseline_dict = {(r['name'], r['scale']): r for r in baseline_list}
+    regression_list = []
+    for r in result_list:
+        baseline = baseline_dict.get((r['name'], r['scale']))
+        if baseline is None:
+            continue
+        ratio = r['median'] / max(baseline['median'], 1e-9)
+        logging.warning('{:<40} {:>12} {:>9.3f}s (baseline {:.3f}s, x{:.2f}){}'.format(
+            r['name'], r['scale'], r['median'], baseline['median'], ratio,
+            ' REGRESSION' if ratio > threshold else ''))
+        if ratio > threshold:
+            regression_list.append({'name': r['name'], 'scale': r['scale'], 'ratio': ratio})
+    return regression_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the scan, conversion, aggregation and split functions on '
+                                                 'synthetic DICOM datasets of increasing sizes')
+    parser.add_argument('-o', '--output', type=str, required=True, help='json file of the results')
+    parser.add_argument('-sc', '--scales', type=str, nargs='+', default=['2x2x16', '4x4x32', '8x4x64'],
+                        help='sizes of the datasets as STUDIESxSERIESxSLICES (default: 2x2x16 4x4x32 8x4x64)')
+    parser.add_argument('-ms', '--matrix_size', type=int, default=64, help='number of rows and columns of the slices')
+    parser.add_argument('-fl', '--flat', action='store_true', help='all the files of a study in the same folder')
+    parser.add_argument('-z', '--zip_fraction', type=float, default=0.25, help='fraction of the studies zipped')
+    parser.add_argument('-nz', '--nested_zip', action='store_true', help='zip the studies in nested archives')
+    parser.add_argument('-ns', '--missing_sequence_name', type=float, default=0.25,
+                        help='fraction of the studies without SequenceName')
+    parser.add_argument('-r', '--resend_fraction', type=float, default=0.25,
+                        help='fraction of the studies with a serie sent again in another folder')
+    parser.add_argument('-rp', '--repeat', type=int, default=3, help='number of runs of each benchmark')
+    parser.add_argument('-nc', '--number_of_cores', type=int, default=-1,
+                        help='cores of the parallel benchmarks (default: all)')
+    parser.add_argument('-sk', '--skip', type=str, nargs='*', default=[], choices=['scan', 'conversion', 'split'],
+                        help='groups of benchmarks not run')
+    parser.add_argument('-b', '--baseline', type=str, default=None,
+                        help='json file of previous results to compare with')
+    parser.add_argument('-t', '--threshold', type=float, default=1.2,
+                        help='ratio of the median times above which a benchmark is reported as a regression')
+    parser.add_argument('-w', '--work_folder', type=str, default=None,
+                        help='folder of the synthetic datasets (default: a temporary folder deleted at the end)')
+    parser.add_argument('-v', '--verbose', default='none', choices=['none', 'info', 'debug'], nargs='?', const='info',
+                        type=str, help='print the messages of the benchmarked functions [default is "none"]')
+    args = parser.parse_args()
+    level = {'none': logging.WARNING, 'info': logging.INFO, 'debug': logging.DEBUG}[args.verbose]
+    logging.basicConfig(level=level, stream=sys.stdout, format='%(message)s')
+    nb_cores = multiprocessing.cpu_count() if args.number_of_cores == -1 else args.number_of_cores
+    scale_list = [parse_scale(s) for s in args.scales]
+
+    work_root = args.work_folder if args.work_folder is not None else tempfile.mkdtemp(prefix='dicom_benchmarks_')
+    results = {'environment': get_environment(), 'arguments': vars(args), 'datasets': [], 'results': []}
+    try:
+        for scale, scale_dict in zip(args.scales, scale_list):
+            scale_dict['matrix_size'] = args.matrix_size
+            work_folder = os.path.join(work_root, scale)
+            shutil.rmtree(work_folder, ignore_errors=True)
+            dataset_folder = os.path.join(work_folder, 'dataset')
+            start = time.perf_counter()
+            description = synthetic_dicom.generate_dataset(
+                dataset_folder, flat=args.flat, zip_fraction=args.zip_fraction, nested_zip=args.nested_zip,
+                missing_sequence_name_fraction=args.missing_sequence_name, resend_fraction=args.resend_fraction,
+                **scale_dict)
+            description['generation_time'] = time.perf_counter() - start
+            description['scale'] = scale
+            results['datasets'].append(description)
+            print('[{}] {} files generated in {:.1f}s'.format(scale, description['file_count'],
+                                                              description['generation_time']))
+            result_list = []
+            if 'scan' not in args.skip:
+                result_list += benchmark_scan(list_dicom_folders(description['input_list']), scale, args.repeat)
+            if 'conversion' not in args.skip:
+                result_list += benchmark_conversion(description['input_list'], os.path.join(work_folder, 'output'),
+                                                    description['file_count'], scale, args.repeat, nb_cores)
+            if 'split' not in args.skip:
+                result_list += benchmark_split(work_folder, scale_dict, scale, args.repeat, nb_cores)
+            for r in result_list:
+                print('[{}] {:<40} median {:>9.3f}s min {:>9.3f}s {:>10.1f} {}/s'.format(
+                    scale, r['name'], r['median'], r['min'], r['items_per_second'], r['unit']))
+            results['results'] += result_list
+            # the results are written after each scale so they are kept if a bigger scale fails
+            with open(args.output, 'w+') as out_file:
+                json.dump(results, out_file, indent=4)
+    finally:
+        if args.work_folder is None:
+            shutil.rmtree(work_root, ignore_errors=True)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline_list = json.load(baseline_file)['results']
+        results['regressions'] = compare_results(results['results'], baseline_list, args.threshold)
+        with open(args.output, 'w+') as out_file:
+            json.dump(results, out_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
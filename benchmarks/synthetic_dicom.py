@@ -0,0 +1,256 @@
+"""
+Generator of synthetic DICOM datasets for the benchmarks: MR studies written with pydicom, as nested or flat folders,
+zip archives (possibly nested), with or without SequenceName and with resent series
+
+Authors: Chris Foulon
+"""
+import os
+import io
+import shutil
+import zipfile
+import argparse
+import json
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+
+def create_dicom_dataset(study_dict, serie_dict, instance_number, pixel_array):
+    """
+    Create the dataset of one slice of a serie.
+
+    Parameters
+    ----------
+    study_dict : dict
+        'PatientID', 'StudyInstanceUID', 'StudyDate' and 'StudyTime' of the study
+    serie_dict : dict
+        'SeriesInstanceUID', 'SeriesNumber', 'ProtocolName', 'SequenceName' (None to leave it out), 'EchoTime' and
+        'RepetitionTime' of the serie
+    instance_number : int
+        number of the slice, starting at 1
+    pixel_array : numpy.ndarray
+        uint16 2D array of the slice
+
+    Returns
+    -------
+    ds : pydicom.dataset.Dataset
+    """
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = MRImageStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.PatientID = study_dict['PatientID']
+    ds.PatientName = 'Synthetic^{}'.format(study_dict['PatientID'])
+    ds.StudyInstanceUID = study_dict['StudyInstanceUID']
+    ds.StudyDate = study_dict['StudyDate']
+    ds.StudyTime = study_dict['StudyTime']
+    ds.StudyID = '1'
+    ds.Modality = 'MR'
+    ds.Manufacturer = 'SIEMENS'
+    ds.MagneticFieldStrength = 3
+    ds.SeriesInstanceUID = serie_dict['SeriesInstanceUID']
+    ds.SeriesNumber = serie_dict['SeriesNumber']
+    ds.ProtocolName = serie_dict['ProtocolName']
+    ds.SeriesDescription = serie_dict['ProtocolName']
+    if serie_dict.get('SequenceName') is not None:
+        ds.SequenceName = serie_dict['SequenceName']
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'ND']
+    ds.EchoTime = serie_dict['EchoTime']
+    ds.RepetitionTime = serie_dict['RepetitionTime']
+    ds.FlipAngle = 9
+    ds.AcquisitionNumber = 1
+    ds.InstanceNumber = instance_number
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.ImagePositionPatient = [-0.5 * pixel_array.shape[1], -0.5 * pixel_array.shape[0], 2.0 * instance_number]
+    ds.SliceLocation = 2.0 * instance_number
+    ds.PixelSpacing = [1, 1]
+    ds.SliceThickness = 2
+    ds.Rows, ds.Columns = pixel_array.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.RescaleSlope = 1
+    ds.RescaleIntercept = 0
+    ds.PixelData = pixel_array.astype(np.uint16).tobytes()
+    return ds
+
+
+def generate_study(study_folder, study_index, serie_count=4, slice_count=32, matrix_size=64, flat=False,
+                   missing_sequence_name=False, rng=None):
+    """
+    Write the DICOM files of a study in study_folder: one sub-folder per serie (or all the files in study_folder if
+    flat is True).
+
+    Parameters
+    ----------
+    study_folder : str
+        folder of the study (created if it does not exist)
+    study_index : int
+        index of the study in the dataset, used in its PatientID and in the ProtocolName of its series so the output
+        prefixes of the different studies are distinct
+    serie_count : int
+        number of series
+    slice_count : int
+        number of files per serie
+    matrix_size : int
+        number of rows and columns of the slices
+    flat : bool
+        True means that the files of all the series are in study_folder
+    missing_sequence_name : bool
+        True means that the files do not have a SequenceName field
+    rng : numpy.random.Generator
+        random generator of the pixel values
+
+    Returns
+    -------
+    serie_folder_dict : dict
+        SeriesInstanceUID: folder of the files of the serie
+    """
+    if rng is None:
+        rng = np.random.default_rng(study_index)
+    study_dict = {'PatientID': 'SUB{:05d}'.format(study_index), 'StudyInstanceUID': generate_uid(),
+                  'StudyDate': '20200101', 'StudyTime': '{:06d}'.format(80000 + study_index % 40000)}
+    serie_folder_dict = {}
+    for serie_index in range(serie_count):
+        serie_dict = {'SeriesInstanceUID': generate_uid(), 'SeriesNumber': serie_index + 1,
+                      'ProtocolName': 'study{}_serie{}'.format(study_index, serie_index),
+                      'SequenceName': None if missing_sequence_name else '*tfl3d1_{}'.format(serie_index),
+                      'EchoTime': 2.5 + serie_index, 'RepetitionTime': 2000}
+        serie_folder = study_folder if flat else os.path.join(study_folder, 'serie_{:03d}'.format(serie_index + 1))
+        os.makedirs(serie_folder, exist_ok=True)
+        volume = rng.integers(0, 4096, (slice_count, matrix_size, matrix_size), dtype=np.uint16)
+        for slice_index in range(slice_count):
+            ds = create_dicom_dataset(study_dict, serie_dict, slice_index + 1, volume[slice_index])
+            ds.save_as(os.path.join(serie_folder, 's{:03d}_i{:04d}.dcm'.format(serie_index + 1, slice_index + 1)),
+                       write_like_original=False)
+        serie_folder_dict[serie_dict['SeriesInstanceUID']] = serie_folder
+    return serie_folder_dict
+
+
+def zip_folder(folder, zip_path, nested=False):
+    """
+    Compress folder in zip_path and delete it. With nested=True, the folder is compressed in an inner archive stored
+    in zip_path (a zip archive inside a zip archive). The folders have their own entries, like with 'zip -r'
+    (extra_utils.unzip_recursive_and_list only lists the folders of the archive that have an entry).
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer if nested else zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for dirpath, _, filenames in os.walk(folder):
+            zip_file.write(dirpath, os.path.relpath(dirpath, os.path.dirname(folder)))
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                zip_file.write(path, os.path.relpath(path, os.path.dirname(folder)))
+    if nested:
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_file:
+            zip_file.writestr(os.path.basename(folder) + '.zip', buffer.getvalue())
+    shutil.rmtree(folder)
+
+
+def generate_dataset(output_folder, study_count=4, serie_count=4, slice_count=32, matrix_size=64, flat=False,
+                     zip_fraction=0., nested_zip=False, missing_sequence_name_fraction=0., resend_fraction=0., seed=0):
+    """
+    Write a synthetic dataset of study_count studies in output_folder (one folder or zip archive per study, like the
+    inputs of dicom_to_nifti.convert_dataset).
+
+    Parameters
+    ----------
+    output_folder : str
+        root folder of the dataset (created if it does not exist)
+    study_count : int
+        number of studies
+    serie_count : int
+        see generate_study
+    slice_count : int
+        see generate_study
+    matrix_size : int
+        see generate_study
+    flat : bool
+        see generate_study
+    zip_fraction : float
+        fraction of the studies stored as zip archives
+    nested_zip : bool
+        True means that the zip archives of the studies contain an inner zip archive with the files
+    missing_sequence_name_fraction : float
+        fraction of the studies without SequenceName
+    resend_fraction : float
+        fraction of the studies whose first serie is sent again in another folder ('resend_[study]', same files and
+        same SOPInstanceUIDs)
+    seed : int
+        seed of the random choices and of the pixel values
+
+    Returns
+    -------
+    description : dict
+        the parameters, the number of files written and the list of the inputs
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_folder, exist_ok=True)
+    study_index_list = list(range(study_count))
+    zip_set = set(rng.choice(study_index_list, int(round(zip_fraction * study_count)), replace=False).tolist())
+    missing_set = set(rng.choice(study_index_list, int(round(missing_sequence_name_fraction * study_count)),
+                                 replace=False).tolist())
+    resend_set = set(rng.choice(study_index_list, int(round(resend_fraction * study_count)), replace=False).tolist())
+    input_list = []
+    file_count = 0
+    for study_index in study_index_list:
+        study_folder = os.path.join(output_folder, 'study_{:05d}'.format(study_index))
+        serie_folder_dict = generate_study(study_folder, study_index, serie_count=serie_count,
+                                           slice_count=slice_count, matrix_size=matrix_size, flat=flat,
+                                           missing_sequence_name=study_index in missing_set, rng=rng)
+        file_count += serie_count * slice_count
+        if study_index in resend_set:
+            first_serie_folder = next(iter(serie_folder_dict.values()))
+            resend_folder = os.path.join(output_folder, 'resend_{:05d}'.format(study_index))
+            os.makedirs(resend_folder, exist_ok=True)
+            for f in os.listdir(first_serie_folder):
+                if f.startswith('s001_'):
+                    shutil.copyfile(os.path.join(first_serie_folder, f), os.path.join(resend_folder, f))
+                    file_count += 1
+            input_list.append(resend_folder)
+        if study_index in zip_set:
+            zip_folder(study_folder, study_folder + '.zip', nested=nested_zip)
+            input_list.append(study_folder + '.zip')
+        else:
+            input_list.append(study_folder)
+    return {'study_count': study_count, 'serie_count': serie_count, 'slice_count': slice_count,
+            'matrix_size': matrix_size, 'flat': flat, 'zip_fraction': zip_fraction, 'nested_zip': nested_zip,
+            'missing_sequence_name_fraction': missing_sequence_name_fraction, 'resend_fraction': resend_fraction,
+            'seed': seed, 'file_count': file_count, 'pydicom_version': pydicom.__version__,
+            'input_list': sorted(input_list)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic DICOM dataset')
+    parser.add_argument('-o', '--output', type=str, required=True, help='root folder of the dataset')
+    parser.add_argument('-st', '--studies', type=int, default=4, help='number of studies')
+    parser.add_argument('-se', '--series', type=int, default=4, help='number of series per study')
+    parser.add_argument('-sl', '--slices', type=int, default=32, help='number of files per serie')
+    parser.add_argument('-ms', '--matrix_size', type=int, default=64, help='number of rows and columns')
+    parser.add_argument('-fl', '--flat', action='store_true', help='all the files of a study in the same folder')
+    parser.add_argument('-z', '--zip_fraction', type=float, default=0., help='fraction of the studies zipped')
+    parser.add_argument('-nz', '--nested_zip', action='store_true', help='zip the studies in nested archives')
+    parser.add_argument('-ns', '--missing_sequence_name', type=float, default=0.,
+                        help='fraction of the studies without SequenceName')
+    parser.add_argument('-r', '--resend_fraction', type=float, default=0.,
+                        help='fraction of the studies with a serie sent again in another folder')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    description = generate_dataset(args.output, study_count=args.studies, serie_count=args.series,
+                                   slice_count=args.slices, matrix_size=args.matrix_size, flat=args.flat,
+                                   zip_fraction=args.zip_fraction, nested_zip=args.nested_zip,
+                                   missing_sequence_name_fraction=args.missing_sequence_name,
+                                   resend_fraction=args.resend_fraction, seed=args.seed)
+    print(json.dumps(description, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,15 @@ import os
 import json
 import logging
 import re
+import base64
+import types
+import operator
+import functools
 
+import numpy as np
 import pydicom
 from pydicom.sequence import Sequence
-from data_identification.modules import extra_utils
+from data_identification.modules import extra_utils, header_cache
 
 # based on https://github.com/pydicom/contrib-pydicom/blob/master/input-output/pydicom_series.py
 
@@ -71,72 +76,622 @@ def extract_identifier_list_from_string(string):
     return identifier_list
 
 
-def create_metadata_filename(identifier_string, dcm, dicom_folder=''):
+def format_header_fields(identifier_string):
     """
+    List the header fields used by create_metadata_filename for a given dcm2niix format string.
 
     Parameters
     ----------
-    identifier_string
-    dcm
-    dicom_folder
+    identifier_string : str
+        dcm2niix format string (e.g. '%p_%t_%s')
 
     Returns
     -------
-
-    Notes
-    -----
-    '%b': basename and '%c': comments are not yet handled
+    field_list : list of str
+        DICOM keywords of the fields needed to create the identifier
     """
-
-    identifier_list = re.findall(r'%[a-z]', identifier_string)
-    filename = identifier_string
-    for identifier in identifier_list:
+    field_list = []
+    for identifier in re.findall(r'%[a-z]', identifier_string):
         if identifier in format_to_key_dict:
-            cleaned_identifier = str(getattr(dcm, format_to_key_dict[identifier]))
+            field_list.append(format_to_key_dict[identifier])
         elif identifier == '%t':
-            cleaned_identifier = '{}{}'.format(dcm.StudyDate, str(round(float(dcm.StudyTime))))
-            # cleaned_identifier = '{}{}'.format(dcm.StudyDate, dcm.StudyTime.split('.')[0])
-        elif identifier == '%a':
-            raise ValueError('%a antenna (coil) name is not present in every header and thus'
-                             ' cannot be used in filename')
-        elif identifier == '%f':
-            if dicom_folder != '' and dicom_folder is not None:
-                cleaned_identifier = dicom_folder
-            else:
-                raise ValueError('dicom_folder must be defined to be able to use the %f option')
+            field_list += ['StudyDate', 'StudyTime']
+    return field_list
+
+
+def identifier_candidate_fields(identifier_string):
+    """
+    Fields that can be used to identify the series with a given dcm2niix format string: the fields of the format
+    string and the replacement_fields used when a field of the format string is missing from some headers.
+    """
+    field_list = format_header_fields(identifier_string)
+    for field in replacement_fields:
+        if field not in field_list:
+            field_list.append(field)
+    return field_list
+
+
+def get_field_values(dcm, field_list):
+    """
+    Returns
+    -------
+    field_values : tuple
+        the value of each field of field_list in the header dcm as a string, None if the field is not in the header
+    """
+    return tuple(None if value is None else str(value) for value in [getattr(dcm, f, None) for f in field_list])
+
+
+def resolve_identifier_format(identifier_string, missing_field_set, dicom_dir=''):
+    """
+    Replace the fields of the format string missing from some headers with the first replacement field present in
+    every header.
+
+    Parameters
+    ----------
+    identifier_string : str
+        dcm2niix format string
+    missing_field_set : set of str
+        the fields that are missing from at least one header
+    dicom_dir : str
+        the folder of the headers, used in the log
+
+    Returns
+    -------
+    resolved_identifier_string : str
+        the format string to use for this set of headers
+
+    Raises
+    ------
+    AttributeError
+        if a missing field cannot be replaced
+    """
+    resolved_identifier_string = identifier_string
+    for field in format_header_fields(identifier_string):
+        if field not in missing_field_set:
+            continue
+        replacement = None
+        if field in key_to_format_dict:
+            replacement = next((r for r in replacement_fields if r not in missing_field_set and
+                                key_to_format_dict[r] not in resolved_identifier_string), None)
+        if replacement is None:
+            raise AttributeError('No replacement found in the DICOM headers for the missing field \'{}\''.format(
+                field))
+        logging.info('[{}] not found in a file from [{}], it is replaced by [{}]'.format(field, dicom_dir,
+                                                                                       replacement))
+        resolved_identifier_string = resolved_identifier_string.replace(key_to_format_dict[field],
+                                                                        key_to_format_dict[replacement])
+    return resolved_identifier_string
+
+
+def group_field_series(field_series, field_list, identifier_string, dicom_dir):
+    """
+    Merge the series grouped by the values of the candidate fields of the identifier (see identifier_candidate_fields)
+    into the series identified with the format string resolved from the fields available in every header (see
+    resolve_identifier_format).
+
+    Parameters
+    ----------
+    field_series : dict
+        DicomSerie for each tuple of field values (see get_field_values)
+    field_list : list of str
+        the candidate fields
+    identifier_string : str
+        dcm2niix format string
+    dicom_dir : str
+        folder containing the DICOM files
+
+    Returns
+    -------
+    series : dict
+        dictionary of the DicomSeries with their identifier (created with the resolved format string) as key
+    """
+    missing_field_set = set([field_list[ind] for field_values in field_series
+                             for ind, value in enumerate(field_values) if value is None])
+    resolved_identifier_string = resolve_identifier_format(identifier_string, missing_field_set, dicom_dir)
+    formatter = get_series_key_formatter(resolved_identifier_string)
+    series = {}
+    for field_values in field_series:
+        header_values = types.SimpleNamespace(**{f: v for f, v in zip(field_list, field_values) if v is not None})
+        serie_id = formatter(header_values, dicom_dir)
+        if serie_id in series:
+            series[serie_id].merge(field_series[field_values])
+        else:
+            field_series[field_values].rename(serie_id, resolved_identifier_string)
+            series[serie_id] = field_series[field_values]
+        # dcm2niix is also given the resolved format string (see dicom_to_nifti.prepare_dicom_folder)
+        series[serie_id].output_prefix_set.add(formatter.output_prefix(header_values, dicom_dir))
+    for serie_id in series:
+        logging.info('New dicom serie created with filename: {}'.format(series[serie_id].output_filename))
+    return series
+
+
+def prescan_header_fields(identifier_string):
+    """
+    Fields read by the prescan of scan_dicomdir: the candidate fields of the identifier (see
+    identifier_candidate_fields), InstanceNumber to sort the files and the UIDs used to detect the duplicated series.
+    """
+    field_list = identifier_candidate_fields(identifier_string)
+    for field in ['InstanceNumber', 'SOPInstanceUID', 'SeriesInstanceUID']:
+        if field not in field_list:
+            field_list.append(field)
+    return field_list
+
+
+def merge_json_dicts(json_list):
+    """
+    Merge the DICOM json dictionaries of the files of a serie. The fields with the same value in every file are stored
+    once and the others are stored as a list with one element per file (None if the field is absent from a file).
+
+    Parameters
+    ----------
+    json_list : list of dict
+        the output of pydicom.Dataset.to_json_dict for each file
+
+    Returns
+    -------
+    merged_dict : dict
+    """
+    keys_set = set()
+    for json_dict in json_list:
+        keys_set.update(json_dict.keys())
+
+    metadata_list_dict = {key: [d[key] if key in d.keys() else None for d in json_list]
+                          for key in keys_set}
+    merged_dict = {}
+    for key in metadata_list_dict:
+        if metadata_list_dict[key].count(metadata_list_dict[key][0]) == len(metadata_list_dict[key]):
+            merged_dict[key] = metadata_list_dict[key][0]
         else:
-            raise ValueError('Error, {} identifier is not handled'.format(identifier))
-        filename = filename.replace(identifier, cleaned_identifier)
-    return extra_utils.clean_string(filename)
+            merged_dict[key] = metadata_list_dict[key]
+    return merged_dict
+
+
+def _numeric_value_matrix(element_list):
+    """
+    Return the Values of element_list as a list of rows if every element has the same vr and the same number of
+    numeric values of the same type (int or float), None otherwise.
+    """
+    if any(e is None or set(e.keys()) != {'vr', 'Value'} for e in element_list):
+        return None
+    if len({e['vr'] for e in element_list}) != 1 or len({len(e['Value']) for e in element_list}) != 1:
+        return None
+    value_types = {type(v) for e in element_list for v in e['Value']}
+    if value_types != {int} and value_types != {float}:
+        return None
+    if not element_list[0]['Value']:
+        return None
+    return [e['Value'] for e in element_list]
+
+
+def _run_length_encode(element_list):
+    runs = []
+    for element in element_list:
+        # 1 == 1.0 in python but not once written in json
+        if runs and runs[-1][0] == element and json.dumps(runs[-1][0]) == json.dumps(element):
+            runs[-1][1] += 1
+        else:
+            runs.append([element, 1])
+    return runs
+
+
+def encode_varying_field(element_list):
+    """
+    Encode the list of per-file DICOM json elements of a field that varies within a serie in a compact form.
+    The encodings, tried in this order, are:
+    'range': every value is an arithmetic progression (e.g. InstanceNumber, SliceLocation or ImagePositionPatient
+        in a regular volume), stored with its 'Start', 'Step' and 'Count' (one Start and Step per value of the field)
+    'rle': the list is made of long runs of identical elements, stored as [element, repetitions] pairs in 'Runs'
+    'array': numeric values, stored as a base64 encoded int64 / float64 array in 'Data' with its 'Shape'
+    If no encoding is smaller than the list, the list itself is returned. decode_varying_field reverses the encoding.
+
+    Parameters
+    ----------
+    element_list : list
+        DICOM json elements (or None for the files where the field is absent)
+
+    Returns
+    -------
+    encoded : dict or list
+        a dict containing an 'Encoding' key or element_list
+    """
+    count = len(element_list)
+    if count < 2:
+        # no encoding is smaller
+        return element_list
+    value_matrix = _numeric_value_matrix(element_list)
+    if value_matrix is not None:
+        vr = element_list[0]['vr']
+        start = value_matrix[0]
+        step = [b - a for a, b in zip(value_matrix[0], value_matrix[1])]
+        if all(row[j] == start[j] + i * step[j] for i, row in enumerate(value_matrix) for j in range(len(start))):
+            return {'Encoding': 'range', 'vr': vr, 'Start': start, 'Step': step, 'Count': count}
+    runs = _run_length_encode(element_list)
+    if len(runs) * 2 <= count:
+        return {'Encoding': 'rle', 'Runs': runs}
+    if value_matrix is not None:
+        dtype = 'int64' if isinstance(value_matrix[0][0], int) else 'float64'
+        array = np.array(value_matrix, dtype=dtype)
+        return {'Encoding': 'array', 'vr': element_list[0]['vr'], 'DType': dtype, 'Shape': list(array.shape),
+                'Data': base64.b64encode(array.tobytes()).decode('ascii')}
+    if len(runs) < count:
+        return {'Encoding': 'rle', 'Runs': runs}
+    return element_list
+
+
+def decode_varying_field(encoded):
+    """
+    Decode a field encoded by encode_varying_field into the list of per-file DICOM json elements.
+    """
+    if not isinstance(encoded, dict) or 'Encoding' not in encoded:
+        return encoded
+    encoding = encoded['Encoding']
+    if encoding == 'range':
+        start = encoded['Start']
+        step = encoded['Step']
+        return [{'vr': encoded['vr'], 'Value': [start[j] + i * step[j] for j in range(len(start))]}
+                for i in range(encoded['Count'])]
+    if encoding == 'rle':
+        element_list = []
+        for element, repetitions in encoded['Runs']:
+            element_list += [element] * repetitions
+        return element_list
+    if encoding == 'array':
+        array = np.frombuffer(base64.b64decode(encoded['Data']), dtype=encoded['DType']).reshape(encoded['Shape'])
+        return [{'vr': encoded['vr'], 'Value': row} for row in array.tolist()]
+    raise ValueError('Unknown encoding [{}] in the metadata'.format(encoding))
+
+
+def compact_metadata(metadata_json_dict):
+    """
+    Return a copy of a merged metadata dictionary where every varying field (stored as a list) is encoded with
+    encode_varying_field.
+    """
+    return {key: encode_varying_field(value) if isinstance(value, list) else value
+            for key, value in metadata_json_dict.items()}
+
+
+def expand_metadata(metadata_json_dict):
+    """
+    Reverse compact_metadata: every encoded field is decoded into its list of per-file elements. Dictionaries without
+    encoded fields are returned unchanged.
+    """
+    return {key: decode_varying_field(value) if isinstance(value, dict) and 'Encoding' in value else value
+            for key, value in metadata_json_dict.items()}
+
+
+def load_metadata_json(path):
+    """
+    Load a __dicom_metadata.json file, compact or not, with its varying fields as lists of per-file elements.
+    """
+    with open(path, 'r') as json_fd:
+        return expand_metadata(json.load(json_fd))
+
+
+class SeriesKeyFormatter(object):
+
+    def __init__(self, identifier_string):
+        """
+        dcm2niix format string compiled into a template, a getter of the header fields it uses and the translation
+        table of extra_utils.clean_string, so the identifier of the serie of a header is created without parsing the
+        format string again. Use get_series_key_formatter to share the formatters of a format string.
+
+        Parameters
+        ----------
+        identifier_string : str
+            dcm2niix format string (e.g. '%p_%t_%s')
+
+        Raises
+        ------
+        ValueError
+            if the format string contains an identifier that is not handled
+
+        Notes
+        -----
+        '%b': basename and '%c': comments are not yet handled
+        """
+        self.identifier_string = identifier_string
+        # fields used to create the identifier (StudyDate and StudyTime for %t)
+        self.header_field_list = format_header_fields(identifier_string)
+        # fields used to group the files before the format string is resolved (see group_field_series)
+        self.field_list = identifier_candidate_fields(identifier_string)
+        self._study_time_index = None
+        self._uses_folder = False
+        template = ''
+        position = 0
+        for match in re.finditer(r'%[a-z]', identifier_string):
+            template += identifier_string[position:match.start()].replace('{', '{{').replace('}', '}}')
+            position = match.end()
+            identifier = match.group()
+            if identifier in format_to_key_dict:
+                template += '{{{}!s}}'.format(self.header_field_list.index(format_to_key_dict[identifier]))
+            elif identifier == '%t':
+                self._study_time_index = self.header_field_list.index('StudyTime')
+                template += '{{{}!s}}{{{}!s}}'.format(self.header_field_list.index('StudyDate'),
+                                                      self._study_time_index)
+            elif identifier == '%a':
+                raise ValueError('%a antenna (coil) name is not present in every header and thus'
+                                 ' cannot be used in filename')
+            elif identifier == '%f':
+                self._uses_folder = True
+                template += '{folder}'
+            else:
+                raise ValueError('Error, {} identifier is not handled'.format(identifier))
+        self._template = template + identifier_string[position:].replace('{', '{{').replace('}', '}}')
+        # attrgetter returns a value instead of a tuple for a single field
+        self._header_getter = self._tuple_getter(self.header_field_list)
+        self._field_getter = self._tuple_getter(self.field_list)
+
+    @staticmethod
+    def _tuple_getter(field_list):
+        if not field_list:
+            return lambda dcm: ()
+        if len(field_list) == 1:
+            getter = operator.attrgetter(field_list[0])
+            return lambda dcm: (getter(dcm),)
+        return operator.attrgetter(*field_list)
+
+    def __call__(self, dcm, dicom_folder=''):
+        """
+        Returns
+        -------
+        serie_id : str
+            identifier of the serie of the header dcm (see create_metadata_filename)
+
+        Raises
+        ------
+        AttributeError
+            if a field of the format string is missing from dcm
+        """
+        value_list = self._header_getter(dcm)
+        if self._study_time_index is not None:
+            value_list = list(value_list)
+            value_list[self._study_time_index] = round(float(value_list[self._study_time_index]))
+        return self._format(value_list, dicom_folder)
+
+    def output_prefix(self, dcm, dicom_folder=''):
+        """
+        Returns
+        -------
+        output_prefix : str
+            name given by dcm2niix to the outputs of the serie of the header dcm. It differs from the identifier of the
+            serie for '%t': dcm2niix writes StudyDate * 1e6 + StudyTime rounded to the second, so the leading zero of
+            StudyTime is kept (e.g. 20200101080003 instead of 2020010180003). Like with dcm2niix, the fields missing
+            from dcm are empty.
+        """
+        value_list = ['' if value is None else value for value in
+                      [getattr(dcm, field, None) for field in self.header_field_list]]
+        if self._study_time_index is not None:
+            date_index = self.header_field_list.index('StudyDate')
+            try:
+                value_list[self._study_time_index] = '{:.0f}'.format(
+                    float(value_list[date_index]) * 1e6 + float(value_list[self._study_time_index]))
+                value_list[date_index] = ''
+            except ValueError:
+                pass
+        return self._format(value_list, dicom_folder)
+
+    def _format(self, value_list, dicom_folder):
+        if self._uses_folder and (dicom_folder == '' or dicom_folder is None):
+            raise ValueError('dicom_folder must be defined to be able to use the %f option')
+        return self._template.format(*value_list, folder=dicom_folder).translate(extra_utils.forbidden_char_table)
+
+    def field_values(self, dcm):
+        """
+        Same as get_field_values(dcm, self.field_list), the fields are read with a single getter when they are all
+        in the header.
+        """
+        try:
+            return tuple(None if value is None else str(value) for value in self._field_getter(dcm))
+        except AttributeError:
+            return get_field_values(dcm, self.field_list)
+
+
+@functools.lru_cache(maxsize=None)
+def get_series_key_formatter(identifier_string):
+    """
+    Returns
+    -------
+    formatter : SeriesKeyFormatter
+        the formatter of identifier_string, compiled at the first call in the process
+    """
+    return SeriesKeyFormatter(identifier_string)
+
+
+def create_metadata_filename(identifier_string, dcm, dicom_folder=''):
+    """
+    Create the identifier of the serie of a header with a dcm2niix format string (see SeriesKeyFormatter).
+
+    Parameters
+    ----------
+    identifier_string : str
+        dcm2niix format string
+    dcm : pydicom.dataset.FileDataset
+        DICOM header
+    dicom_folder : str
+        folder of the DICOM file, needed for '%f'
+
+    Returns
+    -------
+    serie_id : str
+    """
+    return get_series_key_formatter(identifier_string)(dcm, dicom_folder)
 
 
 class DicomSerie(object):
 
-    def __init__(self, dcm, identifier_string, dicom_dir):
+    def __init__(self, dcm, identifier_string, dicom_dir, prescanned=False, stop_before_pixels=True,
+                 incremental=False, compact=False, serie_id=None):
         """
-        
+
+        Parameters
+        ----------
+        dcm : pydicom.dataset.FileDataset
+            first DICOM header of the serie
+        identifier_string : str
+            dcm2niix format string used to identify the series
+        dicom_dir : str
+            folder containing the DICOM files
+        prescanned : bool
+            True if the datasets only contain the fields read by the prescan of scan_dicomdir. The complete header is
+            then only read for the first file of the serie when the metadata is generated.
+        stop_before_pixels : bool
+            used when the complete header of a prescanned serie is read
+        incremental : bool
+            True means that each header is merged into the metadata when it is appended and is not kept in memory
+            (see _fold), the memory used by the serie then does not grow with the number of files for the fields
+            that are the same in every file.
+        compact : bool
+            True means that the varying fields are written with encode_varying_field in the json file
+            (see load_metadata_json to read it)
+        serie_id : str
+            identifier of the serie if it is already known (e.g. computed by the scanner), otherwise it is created
+            from dcm with the SeriesKeyFormatter of identifier_string
         """
+        self.prescanned = prescanned
+        self.stop_before_pixels = stop_before_pixels
+        self.incremental = incremental
+        self.compact = compact
         self.identifier_string = identifier_string
         self.dicom_folder = dicom_dir
         self._datasets = Sequence()
-        self._datasets.append(dcm)
-        self._generated_prefix = create_metadata_filename(identifier_string, dcm=dcm, dicom_folder=self.dicom_folder)
+        # state of the incremental merge
+        self._merged_count = 0
+        self._constant_dict = {}
+        self._varying_dict = {}
+        self._instance_number_list = []
+        self._first_filename = None
+        self._first_instance_number = None
+        self.file_list = []
+        self.sop_instance_uid_list = []
+        self.series_instance_uid = getattr(dcm, 'SeriesInstanceUID', None)
+        if serie_id is None:
+            serie_id = get_series_key_formatter(self.identifier_string)(dcm, self.dicom_folder)
+        self._generated_prefix = serie_id
+        # names of the dcm2niix outputs of the serie (see SeriesKeyFormatter.output_prefix), set by group_field_series
+        self.output_prefix_set = set()
+        self._add_dataset(dcm)
         self._output_filename = self.generated_prefix + '_dicom_metadata.json'
-        logging.info('New dicom serie created with filename: {}'.format(self.output_filename))
+        logging.debug('New dicom serie created with filename: {}'.format(self.output_filename))
         self.metadata_json_dict = {}
         self._output_full_path = None
 
-    def append(self, dcm):
-        """ append(dcm)
-        Append a dicomfile (as a pydicom.dataset.FileDataset) to the series.
+    def append(self, dcm, serie_id=None):
+        """ append(dcm, serie_id=None)
+        Append a dicomfile (as a pydicom.dataset.FileDataset) to the series. serie_id is the identifier of the serie
+        of dcm if it is already known.
         """
-        temp_out_prefix = create_metadata_filename(self.identifier_string, dcm=dcm, dicom_folder=self.dicom_folder)
+        if serie_id is None:
+            temp_out_prefix = get_series_key_formatter(self.identifier_string)(dcm, self.dicom_folder)
+        else:
+            temp_out_prefix = serie_id
         if temp_out_prefix == self.generated_prefix:
-            self._datasets.append(dcm)
+            self._add_dataset(dcm)
             return True
         else:
             return False
 
+    def rename(self, serie_id, identifier_string):
+        """ rename(serie_id, identifier_string)
+        Change the identifier of the serie and the format string it was created with.
+        """
+        self.identifier_string = identifier_string
+        self._generated_prefix = serie_id
+        self._output_filename = self.generated_prefix + '_dicom_metadata.json'
+
+    def merge(self, other):
+        """ merge(other)
+        Add the files of another DicomSerie (created with the same options) to the serie.
+        """
+        self.file_list += other.file_list
+        self.sop_instance_uid_list += other.sop_instance_uid_list
+        self.output_prefix_set |= other.output_prefix_set
+        if not self.incremental:
+            for dcm in other._datasets:
+                self._datasets.append(dcm)
+            return
+        n, other_n = self._merged_count, other._merged_count
+
+        def per_file_values(serie, key, count):
+            if key in serie._constant_dict:
+                return [serie._constant_dict[key]] * count
+            if key in serie._varying_dict:
+                return serie._varying_dict[key]
+            return [None] * count
+
+        constant_dict = {}
+        varying_dict = {}
+        for key in set(self._constant_dict) | set(self._varying_dict) | set(other._constant_dict) | \
+                set(other._varying_dict):
+            if key in self._constant_dict and key in other._constant_dict and \
+                    self._constant_dict[key] == other._constant_dict[key]:
+                constant_dict[key] = self._constant_dict[key]
+            else:
+                varying_dict[key] = per_file_values(self, key, n) + per_file_values(other, key, other_n)
+        self._constant_dict = constant_dict
+        self._varying_dict = varying_dict
+        if self._first_filename is None or (other._first_instance_number is not None and
+                                            self._first_instance_number is not None and
+                                            other._first_instance_number < self._first_instance_number):
+            self._first_filename = other._first_filename
+            self._first_instance_number = other._first_instance_number
+        self._instance_number_list += other._instance_number_list
+        self._merged_count += other_n
+
+    def _add_dataset(self, dcm):
+        self.file_list.append(getattr(dcm, 'filename', None))
+        self.sop_instance_uid_list.append(getattr(dcm, 'SOPInstanceUID', None))
+        if self.incremental:
+            self._fold(dcm)
+        else:
+            self._datasets.append(dcm)
+
+    def _fold(self, dcm):
+        """ _fold(dcm)
+        Merge the header of dcm into the running metadata. The fields that had the same value in all the previous
+        files are kept once in _constant_dict as long as the new file has the same value, the others are stored in
+        _varying_dict with one value per file (None when the field is absent from a file).
+        """
+        json_dict = dcm.to_json_dict()
+        n = self._merged_count
+        for key in self._varying_dict:
+            self._varying_dict[key].append(json_dict.get(key))
+        for key in list(self._constant_dict):
+            if json_dict.get(key) != self._constant_dict[key]:
+                self._varying_dict[key] = [self._constant_dict.pop(key)] * n + [json_dict.get(key)]
+        for key in json_dict:
+            if key not in self._constant_dict and key not in self._varying_dict:
+                if n == 0:
+                    self._constant_dict[key] = json_dict[key]
+                else:
+                    self._varying_dict[key] = [None] * n + [json_dict[key]]
+        instance_number = getattr(dcm, 'InstanceNumber', None)
+        # the first file is the one with the lowest InstanceNumber, like after _sort
+        if self._first_filename is None or (instance_number is not None and self._first_instance_number is not None
+                                            and instance_number < self._first_instance_number):
+            self._first_filename = getattr(dcm, 'filename', None)
+            self._first_instance_number = instance_number
+        self._instance_number_list.append(instance_number)
+        self._merged_count += 1
+
+    def _generate_incremental_metadata(self):
+        order = list(range(self._merged_count))
+        if None in self._instance_number_list:
+            logging.warning('InstanceNumber cannot be found in some of the dicom headers of {}. '
+                            'Therefore, the dicom headers cannot be sorted.'.format(self.dicom_folder))
+        else:
+            order.sort(key=lambda i: self._instance_number_list[i])
+        merged_dict = dict(self._constant_dict)
+        for key in self._varying_dict:
+            merged_dict[key] = [self._varying_dict[key][i] for i in order]
+        if self.prescanned:
+            first_dcm = pydicom.dcmread(self._first_filename, defer_size=None,
+                                        stop_before_pixels=self.stop_before_pixels, force=False)
+            self.metadata_json_dict = first_dcm.to_json_dict()
+            self.metadata_json_dict.update(merged_dict)
+        else:
+            self.metadata_json_dict = merged_dict
+        return self.metadata_json_dict
+
     def _sort(self):
         """ _sort()
         Sort the datasets by instance number.
@@ -158,6 +713,13 @@ class DicomSerie(object):
     def generated_prefix(self):
         return self._generated_prefix
 
+    @property
+    def datasets(self):
+        """
+        The datasets kept by the serie (empty in incremental mode)
+        """
+        return self._datasets
+
     @property
     def identifier_string(self):
         return self._identifier_string
@@ -195,30 +757,27 @@ class DicomSerie(object):
         self._output_full_path = value
 
     def generate_metadata(self):
+        if self.incremental:
+            return self._generate_incremental_metadata()
         try:
             self._sort()
         except TypeError as e:
             logging.warning('InstanceNumber cannot be found in some of the dicom headers of {}. '
                             'Therefore, the dicom headers cannot be sorted.'.format(self.dicom_folder))
+        if self.prescanned:
+            # the complete header of the first file is used for all the fields that were not prescanned
+            first_dcm = pydicom.dcmread(self._datasets[0].filename, defer_size=None,
+                                        stop_before_pixels=self.stop_before_pixels, force=False)
+            self.metadata_json_dict = first_dcm.to_json_dict()
+            if len(self._datasets) > 1:
+                self.metadata_json_dict.update(merge_json_dicts([d.to_json_dict() for d in self._datasets]))
+            return self.metadata_json_dict
         # As the object is initialized with a Dataset, the length cannot be lower than 1
         if len(self._datasets) == 1:
             self.metadata_json_dict = self._datasets[0].to_json_dict()
             return self.metadata_json_dict
 
-        json_list = [d.to_json_dict() for d in self._datasets]
-        keys_set = set()
-        for json_dict in json_list:
-            keys_set.update(json_dict.keys())
-
-        metadata_list_dict = {key: [d[key] if key in d.keys() else None for d in json_list]
-                              for key in keys_set}
-
-        for key in metadata_list_dict:
-            if metadata_list_dict[key].count(metadata_list_dict[key][0]) == len(metadata_list_dict[key]):
-                self.metadata_json_dict[key] = metadata_list_dict[key][0]
-            else:
-                self.metadata_json_dict[key] = metadata_list_dict[key]
-
+        self.metadata_json_dict = merge_json_dicts([d.to_json_dict() for d in self._datasets])
         return self.metadata_json_dict
 
     def save_json(self, output_dir, output_filename=''):
@@ -229,11 +788,16 @@ class DicomSerie(object):
         else:
             out = self.output_filename
         self.output_full_path = os.path.join(output_dir, out)
+        if self.compact:
+            metadata_json_dict = compact_metadata(self.metadata_json_dict)
+        else:
+            metadata_json_dict = self.metadata_json_dict
         with open(self.output_full_path, 'w+') as json_fd:
-            json.dump(self.metadata_json_dict, json_fd)
+            json.dump(metadata_json_dict, json_fd)
 
 
-def scan_dicomdir(dirpath, filename_format='%t_%s', stop_before_pixels=True):
+def scan_dicomdir(dirpath, filename_format='%t_%s', stop_before_pixels=True, prescan=False, incremental=False,
+                  compact=False, cache_path=None, cache_max_bytes=header_cache.default_max_bytes):
     """
 
     Parameters
@@ -243,49 +807,179 @@ def scan_dicomdir(dirpath, filename_format='%t_%s', stop_before_pixels=True):
         existing DICOM directory to be scanned
     stop_before_pixels : bool
         True means that the actual voxel values won't be read and won't be added to the meta-data
+    prescan : bool
+        True means that only the fields needed to identify the series (see prescan_header_fields) are read to group
+        the files into series. The complete header is then only read for the first file of each serie, so the other
+        fields in the meta-data are the ones of this file.
+    incremental : bool
+        True means that the headers are merged into their DicomSerie as they are read instead of being all kept in
+        memory until the metadata is generated
+    compact : bool
+        True means that the varying fields of the metadata of the series will be saved in their compact form
+        (see encode_varying_field)
+    cache_path : str
+        path to a header_cache.HeaderCache SQLite file. The files with the same path, size and modification time as
+        in the cache are not read again. The cache is not used when stop_before_pixels is False.
+    cache_max_bytes : int
+        maximum size of the headers stored in the cache
 
     Returns
     -------
     series : dict
-        dictionary of the DicomSeries created from the DICOM directory with their StudyInstanceUID_SeriesInstanceUID
-        as key.
+        dictionary of the DicomSeries created from the DICOM directory with their identifier as key. The files are
+        grouped in one pass by the values of the candidate fields of filename_format (see identifier_candidate_fields)
+        and the identifiers are created with the format string resolved from the fields present in every header (see
+        group_field_series), which is the identifier_string of the series.
+
+    Raises
+    ------
+    ValueError
+        if the folder does not contain any DICOM file
+    AttributeError
+        if a field of filename_format is missing from some headers and cannot be replaced
     """
     logging.info('Extracting metadata from : {}'.format(dirpath))
-    series = {}
+    field_series = {}
     # identifier_list = filename_format.split('_')
     file_list = [os.path.join(dirpath, f) for f in os.listdir(dirpath) if not os.path.isdir(os.path.join(dirpath, f))]
+    formatter = get_series_key_formatter(filename_format)
+    field_list = formatter.field_list
+    specific_tags = prescan_header_fields(filename_format) if prescan else None
+    cache = None
+    if cache_path is not None and stop_before_pixels:
+        cache = header_cache.HeaderCache(cache_path, max_bytes=cache_max_bytes)
+        # the cached entries depend on the fields read and on the candidate fields
+        scan_mode = '{}|{}'.format(','.join(specific_tags) if prescan else 'full', ','.join(field_list))
+
+    try:
+        for filepath in file_list:
+            cached = None
+            if cache is not None:
+                stat_result = os.stat(filepath)
+                cached = cache.get(filepath, scan_mode, stat_result=stat_result)
+            if cached is not None:
+                cached_values, dcm = cached
+                if cached_values == '':
+                    continue  # non-dicom file
+                field_values = tuple(json.loads(cached_values))
+                if not incremental:
+                    # DicomSerie keeps pydicom Datasets
+                    json_dict = dcm.to_json_dict()
+                    dcm = pydicom.Dataset.from_json(json_dict)
+                    dcm.filename = filepath
+            else:
+                # Try loading dicom
+                try:
+                    if prescan:
+                        dcm = pydicom.dcmread(filepath, stop_before_pixels=True, force=False,
+                                              specific_tags=specific_tags)
+                    else:
+                        dcm = pydicom.dcmread(filepath, defer_size=None, stop_before_pixels=stop_before_pixels,
+                                              force=False)
+                except pydicom.filereader.InvalidDicomError:
+                    if cache is not None:
+                        cache.put(filepath, scan_mode, '', {}, stat_result=stat_result)
+                    continue  # skip non-dicom file
+                except Exception as why:
+                    logging.error('Pydicom dcmread: {}'.format(why))
+                    break
+
+                # Get identifiers and register the file with an existing or new series object
+                field_values = formatter.field_values(dcm)
+                if cache is not None:
+                    json_dict = dcm.to_json_dict()
+                    cache.put(filepath, scan_mode, json.dumps(field_values), json_dict, stat_result=stat_result)
+                    if incremental:
+                        # the header is already converted, DicomSerie can use it directly
+                        dcm = header_cache.CachedHeader(filepath, json_dict)
+            _register_header(field_series, dcm, field_values, filename_format, dirpath, prescanned=prescan,
+                             stop_before_pixels=stop_before_pixels, incremental=incremental, compact=compact)
+    finally:
+        if cache is not None:
+            cache.flush()
+            logging.debug('Header cache statistics after [{}]: {}'.format(dirpath, cache.statistics()))
+            cache.close()
+    if len(file_list) == 0 or not field_series:
+        raise ValueError('This folder does not contain any DICOM file or there is an error')
 
-    for filepath in file_list:
-        # Try loading dicom
-        try:
-            dcm = pydicom.dcmread(filepath, defer_size=None, stop_before_pixels=stop_before_pixels, force=False)
-        except pydicom.filereader.InvalidDicomError:
-            continue  # skip non-dicom file
-        except Exception as why:
-            logging.error('Pydicom dcmread:', why)
-            break
+    # for s in series:
+    #     series[s].save_json(output_dir)
 
-        # Get identifiers and register the file with an existing or new series object
-        # for i in identifier_list:
-        #     if i not in dcm:
-        #         raise ValueError('{} is not in the header of the DICOM image'.format(i))
+    return group_field_series(field_series, field_list, filename_format, dirpath)
 
-        # logging.debug('identifier list : ' + str(identifier_list))
 
-        # logging.info('metadata output_filename : ' + output_filename)
+def _register_header(field_series, dcm, field_values, filename_format, dirpath, **serie_options):
+    """
+    Add dcm to the serie of its field values in the field_series dictionary or create the serie (serie_options are
+    given to DicomSerie). The serie is renamed by group_field_series.
+    """
+    if field_values not in field_series:
+        field_series[field_values] = DicomSerie(dcm=dcm, identifier_string=filename_format, dicom_dir=dirpath,
+                                                serie_id=json.dumps(field_values), **serie_options)
+    else:
+        field_series[field_values].append(dcm, serie_id=field_series[field_values].generated_prefix)
 
-        dicom_serie_id = create_metadata_filename(identifier_string=filename_format, dcm=dcm, dicom_folder=dirpath)
-        if dicom_serie_id not in series:
-            series[dicom_serie_id] = DicomSerie(dcm=dcm, identifier_string=filename_format, dicom_dir=dirpath)
-        else:
-            series[dicom_serie_id].append(dcm)
-    if len(file_list) == 0 or not series:
-        raise ValueError('This folder does not contain any DICOM file or there is an error')
 
-    # for s in series:
-    #     series[s].save_json(output_dir)
+def scan_zip_dir(zip_chain, member_list, dirpath, filename_format='%t_%s', stop_before_pixels=True, prescan=False,
+                 incremental=False, compact=False, cache_path=None, cache_max_bytes=None):
+    """
+    Same as scan_dicomdir for the files of a folder inside a (nested) zip archive. The headers are read directly from
+    the archive, without extracting the files.
 
-    return series
+    Parameters
+    ----------
+    zip_chain : list of str
+        see extra_utils.open_zip_chain
+    member_list : list of str
+        names of the files of the folder in the innermost archive
+    dirpath : str
+        existing folder where the files will be extracted if the series are converted. The filename of each header is
+        set to its future path in dirpath.
+    filename_format
+    stop_before_pixels
+    prescan : bool
+        see scan_dicomdir. The complete header of the first file of each serie is read from dirpath, so the files
+        must be extracted before the metadata is generated.
+    incremental
+    compact
+    cache_path : str
+        not used, the zip members are not cached
+    cache_max_bytes : int
+        not used
+
+    Returns
+    -------
+    series : dict
+        dictionary of the DicomSeries created from the files with their identifier as key.
+    """
+    logging.info('Extracting metadata from : {} in {}'.format(zip_chain, dirpath))
+    field_series = {}
+    formatter = get_series_key_formatter(filename_format)
+    field_list = formatter.field_list
+    specific_tags = prescan_header_fields(filename_format) if prescan else None
+    with extra_utils.open_zip_chain(zip_chain) as zip_obj:
+        for member in member_list:
+            try:
+                # only the header is decompressed when the pixels are not read
+                with zip_obj.open(member) as member_fd:
+                    if prescan:
+                        dcm = pydicom.dcmread(member_fd, stop_before_pixels=True, force=False,
+                                              specific_tags=specific_tags)
+                    else:
+                        dcm = pydicom.dcmread(member_fd, defer_size=None, stop_before_pixels=stop_before_pixels,
+                                              force=False)
+            except pydicom.filereader.InvalidDicomError:
+                continue  # skip non-dicom file
+            except Exception as why:
+                logging.error('Pydicom dcmread: {}'.format(why))
+                break
+            dcm.filename = os.path.join(dirpath, os.path.basename(member))
+            _register_header(field_series, dcm, formatter.field_values(dcm), filename_format, dirpath,
+                             prescanned=prescan, stop_before_pixels=stop_before_pixels, incremental=incremental,
+                             compact=compact)
+    if len(member_list) == 0 or not field_series:
+        raise ValueError('This folder does not contain any DICOM file or there is an error')
+    return group_field_series(field_series, field_list, filename_format, dirpath)
 
 
 def save_dicom_metadata():
@@ -0,0 +1,291 @@
+"""
+Sources of DICOM studies (local folders, HTTP servers such as XNAT, ...) feeding dicom_to_nifti.convert_dataset, with
+the studies fetched concurrently and ahead of their conversion
+
+Authors: Chris Foulon
+"""
+import os
+import io
+import json
+import queue
+import shutil
+import logging
+import itertools
+import collections
+import http.client
+import urllib.parse
+import concurrent.futures
+
+from data_identification.modules import dicom_to_nifti, extra_utils
+
+
+class LocalSource(object):
+
+    def __init__(self, root_folder):
+        """
+        Studies stored in a local folder: each sub-folder or zip archive of root_folder is a study. The studies are
+        converted where they are, nothing is copied.
+
+        Parameters
+        ----------
+        root_folder : str
+            folder containing the studies
+        """
+        self.root_folder = root_folder
+        self.max_connections = 1
+
+    def list_studies(self):
+        return sorted([os.path.basename(p) for p in extra_utils.create_input_path_list_from_root(self.root_folder)])
+
+    def fetch(self, study, download_folder):
+        """
+        Returns
+        -------
+        path : str
+            the path of the study, to give to dicom_to_nifti.convert_dataset
+        """
+        path = os.path.join(self.root_folder, study)
+        if not os.path.exists(path):
+            raise ValueError('[{}] does not exist'.format(path))
+        return path
+
+    def release(self, path):
+        """
+        Called once the study fetched in path is converted, the local studies are kept.
+        """
+        return
+
+    def close(self):
+        return
+
+
+class HttpSource(object):
+
+    def __init__(self, base_url, study_url_template='{base_url}/{study}', list_url=None, headers=None,
+                 max_connections=4, timeout=600, retries=2, chunk_size=1024 ** 2):
+        """
+        Studies downloaded from an HTTP(S) server as zip archives (e.g. XNAT with
+        study_url_template='{base_url}/data/experiments/{study}/scans/ALL/files?format=zip'). The downloads use at most
+        max_connections persistent connections (HTTP keep-alive), shared by the threads fetching the studies.
+
+        Parameters
+        ----------
+        base_url : str
+            URL of the server (e.g. 'https://xnat.example.org')
+        study_url_template : str
+            URL of the zip archive of a study, formatted with base_url and the (quoted) study identifier
+        list_url : str
+            URL returning the list of the study identifiers as a json list or as one identifier per line (default:
+            base_url)
+        headers : dict
+            headers added to every request (e.g. {'Authorization': 'Basic ...'})
+        max_connections : int
+            maximum number of connections to the server, i.e. of studies downloaded at the same time
+        timeout : float
+            timeout of the socket operations in seconds
+        retries : int
+            number of times a failed download is tried again with a new connection
+        chunk_size : int
+            size of the chunks written while downloading
+        """
+        self.base_url = base_url.rstrip('/')
+        self.study_url_template = study_url_template
+        self.list_url = list_url if list_url is not None else self.base_url + '/'
+        self.headers = dict(headers) if headers is not None else {}
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+        self.chunk_size = chunk_size
+        # idle connections with the (scheme, netloc) of their server, the None are the connections that are not
+        # created yet
+        self._connection_pool = queue.LifoQueue()
+        for _ in range(max_connections):
+            self._connection_pool.put((None, None))
+
+    def _new_connection(self, url):
+        parsed_url = urllib.parse.urlsplit(url)
+        if parsed_url.scheme == 'https':
+            return http.client.HTTPSConnection(parsed_url.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(parsed_url.netloc, timeout=self.timeout)
+
+    def _get(self, url, output_file):
+        """
+        Download url in the opened file output_file with a connection of the pool, a failed request is tried again
+        (retries times) with a new connection. A connection opened to another server (e.g. the one of list_url) is
+        closed and replaced.
+        """
+        parsed_url = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(('', '', parsed_url.path or '/', parsed_url.query, ''))
+        server = (parsed_url.scheme, parsed_url.netloc)
+        connection_server, connection = self._connection_pool.get()
+        if connection is not None and connection_server != server:
+            connection.close()
+            connection = None
+        try:
+            for attempt in range(self.retries + 1):
+                if connection is None:
+                    connection = self._new_connection(url)
+                try:
+                    output_file.seek(0)
+                    output_file.truncate()
+                    connection.request('GET', path, headers=self.headers)
+                    response = connection.getresponse()
+                    if response.status != 200:
+                        response.read()
+                        raise ValueError('[{}] returned the HTTP status {} {}'.format(url, response.status,
+                                                                                       response.reason))
+                    shutil.copyfileobj(response, output_file, self.chunk_size)
+                    if response.will_close:
+                        connection.close()
+                        connection = None
+                    return
+                except (OSError, http.client.HTTPException) as e:
+                    connection.close()
+                    connection = None
+                    if attempt == self.retries:
+                        raise
+                    logging.warning('Download of [{}] failed ({}), trying again'.format(url, e))
+        finally:
+            self._connection_pool.put((server, connection))
+
+    def list_studies(self):
+        list_file = io.BytesIO()
+        self._get(self.list_url, list_file)
+        content = list_file.getvalue().decode('utf-8')
+        try:
+            return [str(s) for s in json.loads(content)]
+        except ValueError:
+            return [s.strip() for s in content.splitlines() if s.strip() != '']
+
+    def fetch(self, study, download_folder):
+        """
+        Download the zip archive of a study in download_folder.
+
+        Returns
+        -------
+        path : str
+            the path of the archive, to give to dicom_to_nifti.convert_dataset
+        """
+        url = self.study_url_template.format(base_url=self.base_url, study=urllib.parse.quote(study, safe=''))
+        filename = extra_utils.clean_string(study)
+        if not filename.lower().endswith('.zip'):
+            filename += '.zip'
+        path = os.path.join(download_folder, filename)
+        # the archive only gets its name once it is complete
+        partial_path = path + '.part'
+        try:
+            with open(partial_path, 'w+b') as output_file:
+                self._get(url, output_file)
+            os.replace(partial_path, path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        logging.info('[{}] downloaded in [{}]'.format(url, path))
+        return path
+
+    def release(self, path):
+        """
+        Called once the study fetched in path is converted, the archive is deleted.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+
+    def close(self):
+        while not self._connection_pool.empty():
+            _, connection = self._connection_pool.get()
+            if connection is not None:
+                connection.close()
+
+
+def create_source(location, **source_options):
+    """
+    HttpSource if location is an HTTP(S) URL, LocalSource otherwise (source_options are given to HttpSource)
+    """
+    if urllib.parse.urlsplit(location).scheme in ['http', 'https']:
+        return HttpSource(location, **source_options)
+    return LocalSource(location)
+
+
+def convert_source(source, output_folder, download_folder, study_list=None, prefetch=4, batch_size=4,
+                   keep_downloads=False, **convert_options):
+    """
+    Fetch the studies of a source and convert them with dicom_to_nifti.convert_dataset, the fetching and the
+    conversion overlapping: up to source.max_connections studies are fetched at the same time, and up to prefetch
+    studies are fetched ahead of the ones being converted.
+
+    Parameters
+    ----------
+    source : LocalSource or HttpSource
+        the source of the studies
+    output_folder : str
+        see dicom_to_nifti.convert_dataset
+    download_folder : str
+        folder where the studies are downloaded (created if it does not exist)
+    study_list : list of str
+        identifiers of the studies to convert (default: source.list_studies())
+    prefetch : int
+        number of studies fetched in advance
+    batch_size : int
+        maximum number of fetched studies given to each convert_dataset call (the studies already fetched are
+        converted together)
+    keep_downloads : bool
+        False (default) means that the downloaded studies are deleted once converted (see the release method of
+        the sources)
+    convert_options :
+        keyword arguments of dicom_to_nifti.convert_dataset (e.g. converter_options or nb_cores), rerun='delete' only
+        applies to the first batch, the next ones resume the output folder filled by the previous ones
+
+    Returns
+    -------
+    converted_dict : dict
+        the dictionaries returned by convert_dataset merged
+    failed_list : list of str
+        the studies that could not be fetched or whose batch could not be converted
+    """
+    os.makedirs(download_folder, exist_ok=True)
+    if study_list is None:
+        study_list = source.list_studies()
+    logging.info('{} studies to fetch and convert'.format(len(study_list)))
+    converted_dict = {}
+    failed_list = []
+    study_iterator = iter(study_list)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, source.max_connections)) as executor:
+
+        def submit(count):
+            for study in itertools.islice(study_iterator, count):
+                pending.append((study, executor.submit(source.fetch, study, download_folder)))
+
+        submit(prefetch + batch_size)
+        while pending:
+            # the next study in order, and the following ones if they are already fetched
+            batch = [pending.popleft()]
+            while pending and len(batch) < batch_size and pending[0][1].done():
+                batch.append(pending.popleft())
+            path_list = []
+            fetched_list = []
+            for study, future in batch:
+                try:
+                    path_list.append(future.result())
+                    fetched_list.append(study)
+                except Exception as e:
+                    logging.error('[{}] could not be fetched [FETCH ERROR: {}]'.format(study, e))
+                    failed_list.append(study)
+            # the studies of the batch are replaced in the prefetch window before converting them
+            submit(len(batch))
+            if not path_list:
+                continue
+            try:
+                converted_dict.update(dicom_to_nifti.convert_dataset(path_list, output_folder, **convert_options))
+            except Exception as e:
+                # the next batches are still converted
+                logging.exception('{} could not be converted [CONVERSION ERROR: {}]'.format(fetched_list, e))
+                failed_list += fetched_list
+            finally:
+                if convert_options.get('rerun') == 'delete':
+                    # the journal, UID index and catalog filled by this batch are kept
+                    convert_options = dict(convert_options, rerun='resume')
+                if not keep_downloads:
+                    for path in path_list:
+                        source.release(path)
+    return converted_dict, failed_list
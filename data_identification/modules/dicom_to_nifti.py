@@ -5,20 +5,43 @@ Authors: Chris Foulon
 """
 import os
 import subprocess
+import tempfile
+import threading
+import asyncio
+import functools
+import itertools
+import concurrent.futures
 import importlib.resources as rsc
 import copy
-import zipfile
 import shutil
 import json
+import hashlib
+import sqlite3
 import logging
 from multiprocessing.dummy import Pool as ThreadPool
 import multiprocessing
 
+import numpy as np
+import nibabel as nib
+import pydicom
 
-from data_identification.modules import dicom_metadata, extra_utils
+from data_identification.modules import dicom_metadata, extra_utils, run_journal, uid_index, metadata_catalog
 
 
-def dcm2niix_convert_folder(folder_path, output_folder, dcm2niix_options=None):
+# limits the number of dcm2niix processes running at the same time (see set_dcm2niix_semaphore)
+_dcm2niix_semaphore = None
+
+
+def set_dcm2niix_semaphore(semaphore):
+    """
+    Set the semaphore acquired by dcm2niix_convert_folder during each dcm2niix run (None means no limit). It has to be a
+    multiprocessing semaphore for the process pools.
+    """
+    global _dcm2niix_semaphore
+    _dcm2niix_semaphore = semaphore
+
+
+def create_dcm2niix_command(folder_path, output_folder, dcm2niix_options=None):
     if not os.path.isdir(folder_path):
         raise ValueError(str(folder_path) + ' is not a directory')
     with rsc.path('data_identification.bin', 'dcm2niix') as p:
@@ -29,12 +52,23 @@ def dcm2niix_convert_folder(folder_path, output_folder, dcm2niix_options=None):
     final_opt = dcm2niix_options
     if '-f' not in dcm2niix_options:
         final_opt = ['-f', '%p_%t_%s'] + dcm2niix_options
-    dcm2niix_command = [path_to_rsc, '-o', output_folder, *final_opt, folder_path]
+    return [path_to_rsc, '-o', output_folder, *final_opt, folder_path]
+
+
+def dcm2niix_convert_folder(folder_path, output_folder, dcm2niix_options=None):
+    dcm2niix_command = create_dcm2niix_command(folder_path, output_folder, dcm2niix_options)
 
-    process = subprocess.run(dcm2niix_command,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             universal_newlines=True)
+    semaphore = _dcm2niix_semaphore
+    if semaphore is not None:
+        semaphore.acquire()
+    try:
+        process = subprocess.run(dcm2niix_command,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+    finally:
+        if semaphore is not None:
+            semaphore.release()
     logging.info('###STDOUT dcm2niix : {}###\n'.format(process.stdout))
 
     # when dcm2niix raises an error, it does it in stdout, stderr will contain something only in case of a crash
@@ -43,13 +77,43 @@ def dcm2niix_convert_folder(folder_path, output_folder, dcm2niix_options=None):
     return process.stdout
 
 
-def convert_subdir(root_dir, output_folder, filename_format, converter_options=None, rerun='resume',
-                   stop_before_pixels=True):
+def list_zip_sources(zipfile_path, output_directory, in_memory=False):
     """
-    Convert and store the metadata of a given directory / zip archive. First, the function walks through the directory
-    to list sub-folders (and uncompress every zip archive to add its folders to the list). Then, for each sub-folder
-    of the list, the function will try to extract the metadata of every DICOM file and create the __dicom_metadata.json
-    files. If the __dicom_metadata.json are created, the function tries to convert the DICOM data.
+    List the folders of a zip archive (and of the archives it contains) to be converted.
+    Parameters
+    ----------
+    zipfile_path : str
+        path to the zip archive
+    output_directory : str
+        the folders are extracted (or will be extracted if in_memory is True) in
+        output_directory/[zip archive name]_unzip (with one [member name]_unzip sub-folder per nested archive if
+        in_memory is True, see extra_utils.get_zip_chain_dir)
+    in_memory : bool
+        False (default) extracts every file of the archive and lists the folders created, True only lists the folders
+        of the archive without extracting them (see convert_dicom_folder)
+
+    Returns
+    -------
+    source_list : list of tuple
+        (dicom_dir, zip_chain, member_list, cost) for each folder, zip_chain and member_list are None if the folder
+        has been extracted and cost is None if it has to be calculated from the folder.
+    """
+    if not in_memory:
+        logging.info('unzipping : [{}]'.format(zipfile_path))
+        return [(d, None, None, None) for d in extra_utils.unzip_recursive_and_list(zipfile_path, output_directory)]
+    logging.info('listing the content of : [{}]'.format(zipfile_path))
+    unzip_folder = os.path.join(output_directory, os.path.basename(zipfile_path) + '_unzip')
+    return [(extra_utils.get_zip_chain_dir(unzip_folder, zip_chain, member_dir), zip_chain, member_list,
+             (total_size, len(member_list)))
+            for zip_chain, member_dir, member_list, total_size in extra_utils.list_zip_member_dirs(zipfile_path)]
+
+
+def list_subdir_plans(root_dir, output_folder, filename_format, converter_options=None, rerun='resume',
+                      stop_before_pixels=True, scan_options=None, zip_in_memory=False, skipped_zip_list=None):
+    """
+    List the sub-folders of a given directory / zip archive that have to be converted. The function walks through the
+    directory in a single pass (see extra_utils.discover_inputs) to list sub-folders (and uncompress every zip archive
+    to add its folders to the list) and creates a picklable plan for each of them (see convert_dicom_folder).
     Parameters
     ----------
     root_dir : str
@@ -62,23 +126,31 @@ def convert_subdir(root_dir, output_folder, filename_format, converter_options=N
         List of options given to dcm2niix ('dcm2niix -h' to see the possible options) to apply it on
         every conversion performed
     rerun : str ['resume', 'delete', 'none']
-        Strategy to apply in case the output folder contains directories that has already been processed
-        'delete' will just delete the directory and redo the conversion from scratch
-        'resume' (default) will try to assess the integrity of the directory already present and if data is missing or
-        corrupted, it will try to convert it again
-        'none' (not recommended) does not handle the rerun
+        see convert_subdir
     stop_before_pixels : bool
         True (default) means that the header's information extracted will not contain the voxels of the dicom file
+    scan_options : dict
+        extra keyword arguments given to dicom_metadata.scan_dicomdir (e.g. {'prescan': True})
+    zip_in_memory : bool
+        True means that the zip archives are not extracted, the headers are read directly from the archives and only
+        the files of the series to convert are extracted (see list_zip_sources)
+    skipped_zip_list : list of str
+        zip archives (root_dir itself or the archives found in root_dir) that are neither listed nor extracted, e.g.
+        because they were entirely converted in a previous run (see plan_dataset)
 
     Returns
     -------
-    None
+    plan_list : list of dict
+        keyword arguments of convert_dicom_folder, with the estimated cost of each folder in 'cost' and the zip archive
+        it comes from in 'source_zip' (None for the folders of root_dir). The folders without any file are not listed.
     """
-    if os.path.basename(root_dir) == '':
-        directory_name = os.path.basename(os.path.dirname(root_dir))
-    else:
-        directory_name = os.path.basename(root_dir)
-    output_directory = os.path.join(output_folder, directory_name)
+    if converter_options is None:
+        converter_options = []
+    skipped_zip_set = set() if skipped_zip_list is None else set(skipped_zip_list)
+    if root_dir in skipped_zip_set:
+        logging.info('[{}] has already been converted, it will not be extracted again'.format(root_dir))
+        return []
+    output_directory = get_output_directory(root_dir, output_folder)
 
     if rerun == 'delete' and os.path.exists(output_directory):
         shutil.rmtree(output_directory)
@@ -89,34 +161,39 @@ def convert_subdir(root_dir, output_folder, filename_format, converter_options=N
         if all([extra_utils.check_output_integrity(d) for d, _, _ in os.walk(output_directory)]):
             logging.info(
                 'No errors found in [{}], this folder will then not be processed again'.format(output_directory))
-            return
+            return []
 
     if os.path.isdir(root_dir):
-        # We add all the subfolders to the list to process them one by one
-        subfolder_list = [root for root, _, _ in os.walk(root_dir)]
-        # We also find all the zipfile and uncompress them in case they are dicom folders
-        tmp = [[os.path.join(r, ff) for ff in f if
-                zipfile.is_zipfile(os.path.join(r, ff))] for r, _, f in os.walk(root_dir)]
-        tmp_list = []
-        for f in tmp:
-            tmp_list = tmp_list + f
-        for z in tmp_list:
+        # We add all the subfolders to the list to process them one by one and find all the zipfiles in the same pass
+        source_list = []
+        zip_list = []
+        for entry_type, path, stats in extra_utils.discover_inputs(root_dir):
+            if entry_type == 'folder':
+                source_list.append((path, None, None, stats, None))
+            elif path in skipped_zip_set:
+                logging.info('[{}] has already been converted, it will not be extracted again'.format(path))
+            else:
+                zip_list.append(path)
+        # We uncompress the zipfiles in case they are dicom folders
+        for z in zip_list:
             # So we unzipp and add the folders to the list to be processed
-            logging.info('unzipping : [{}]'.format(z))
-            subfolder_list = subfolder_list + extra_utils.unzip_recursive_and_list(z, output_directory)
-    elif zipfile.is_zipfile(root_dir):
+            source_list = source_list + [source + (z,) for source in list_zip_sources(z, output_directory,
+                                                                                      in_memory=zip_in_memory)]
+    elif extra_utils.sniff_file_type(root_dir) == 'zip':
         # easiers here as we just unzip and add the folder tree to the folders to be processed
-        logging.info('unzipping : [{}]'.format(root_dir))
-        subfolder_list = extra_utils.unzip_recursive_and_list(root_dir, output_directory)
+        source_list = [source + (root_dir,) for source in list_zip_sources(root_dir, output_directory,
+                                                                           in_memory=zip_in_memory)]
     else:
         logging.error('[{}] is not an existing directory or zip file'.format(root_dir))
-        return
+        return []
 
-    tmp_filename_format = filename_format
-    tmp_converter_options = converter_options
-    for dicom_dir in subfolder_list:
+    plan_list = []
+    for dicom_dir, zip_chain, member_list, cost, source_zip in source_list:
         subdirectory_name = os.path.basename(dicom_dir)
-        if len(subfolder_list) > 1:
+        if zip_chain is not None and len(zip_chain) > 1:
+            # the folders of the nested archives read in memory are in a sub-folder per nested archive
+            subdirectory_name = os.path.join(*zip_chain[1:], subdirectory_name)
+        if len(source_list) > 1:
             output_subdirectory = os.path.join(output_directory, subdirectory_name)
         else:
             # if there is only one folder, we don't need to create subfolders
@@ -128,106 +205,790 @@ def convert_subdir(root_dir, output_folder, filename_format, converter_options=N
                                  'this folder will be ignored'.format(output_subdirectory))
                     # if the folder contains files that correspond to the __dict_save we don't calculate it again
                     continue
-        replacement_list = copy.deepcopy(dicom_metadata.replacement_fields)
-        tmp_series = {}
-        extra_counter = 0
-        # each failed loop will delete replacement_list entries until it is empty
-        while not tmp_series and replacement_list and extra_counter < len(dicom_metadata.replacement_fields):
-            try:
-                tmp_series = dicom_metadata.scan_dicomdir(dirpath=dicom_dir,
-                                                          filename_format=tmp_filename_format,
-                                                          stop_before_pixels=stop_before_pixels)
-            except AttributeError as err:
-                header_field = [s for s in str(err).split('\'') if s != ''][-1]
-                try:
-                    logging.info('[{}] not found in a file from [{}], trying another one'.format(
-                        header_field, dicom_dir))
-                    replacement_list = [r for r in replacement_list if r != header_field]
-                    old_format_key = dicom_metadata.key_to_format_dict[header_field]
-                    new_format_key = dicom_metadata.key_to_format_dict[replacement_list[0]]
-                    tmp_filename_format = filename_format.replace(
-                        old_format_key,
-                        new_format_key)
-                except KeyError as e:
-                    raise e
-                tmp_converter_options[converter_options.index('-f') + 1] = tmp_filename_format
-                extra_counter += 1
-            except ValueError:
-                logging.info(
-                    '[{}] from root_dir: [{}] does not contain any DICOM file or issued an error, it will'
-                    ' then be skipped.'.format(dicom_dir, root_dir))
-                break
-        # it also means that tmp_series is empty, so the next bloc is skipped
-        if extra_counter >= len(dicom_metadata.replacement_fields):
-            logging.error('All the replacement fields available have been tried in [ATTRIBUTE ERROR: input {} output '
-                          '{}] but were not found in the DICOM header'.format(dicom_dir, output_subdirectory))
-
-        if tmp_series:
-            """ convert the dicom folders into nifti using dcm2niix
-            Note: dcm2niix doesn't handle more than 26 duplicates of the same filename and 
-            will stop converting if there more files would would end up with the same name. 
-            This cannot really happen now, unless one runs the scripts 26 times on the same dataset 
-            without cleaning the output folder. 
-            What can happen though is that we choose the wrong combination of DICOM header fields and 
-            end up with non unique identifiers and so some images will be erased because considered 
-            as duplicates.
-            """
-            # Then extra_utils.check_output_integrity(output_subdirectory) returned false.
-            # So it means that dicom_dir contains dicom files but that either the conversion failed or that some
-            # files are missing
-            if os.path.exists(output_subdirectory):
-                for f in os.listdir(output_subdirectory):
-                    f_path = os.path.join(output_subdirectory, f)
-                    if os.path.isfile(f_path):
-                        os.remove(f_path)
-            else:
-                os.makedirs(output_subdirectory, exist_ok=False)
-            dcm2niix_output_string = dcm2niix_convert_folder(
-                folder_path=dicom_dir,
-                output_folder=output_subdirectory,
-                dcm2niix_options=tmp_converter_options
+        if cost is None:
+            cost = extra_utils.get_folder_file_stats(dicom_dir)
+        if cost[1] == 0:
+            continue
+        plan_list.append({
+            'root_dir': root_dir,
+            'dicom_dir': dicom_dir,
+            'output_subdirectory': output_subdirectory,
+            'filename_format': filename_format,
+            'converter_options': list(converter_options),
+            'stop_before_pixels': stop_before_pixels,
+            'scan_options': scan_options,
+            'zip_chain': zip_chain,
+            'member_list': member_list,
+            'cost': cost,
+            'source_zip': source_zip
+        })
+    return plan_list
+
+
+def get_output_directory(root_dir, output_folder):
+    if os.path.basename(root_dir) == '':
+        directory_name = os.path.basename(os.path.dirname(root_dir))
+    else:
+        directory_name = os.path.basename(root_dir)
+    return os.path.join(output_folder, directory_name)
+
+
+def skip_duplicate_series(series, dicom_dir, uid_index_path):
+    """
+    Claim the instances of the series in the uid_index.UidIndex and remove the series that were already converted from
+    another folder.
+
+    Returns
+    -------
+    series, duplicate_dict : dict, dict
+        the series to convert and, for the skipped series, the folder and the serie they duplicate
+    """
+    index = uid_index.UidIndex(uid_index_path)
+    try:
+        duplicate_dict = index.claim_series(dicom_dir, {s: (series[s].series_instance_uid,
+                                                            series[s].sop_instance_uid_list) for s in series})
+    finally:
+        index.close()
+    for s in duplicate_dict:
+        logging.info('Serie [{}] from [{}] skipped, its instances were already found in serie [{}] from [{}]'.format(
+            s, dicom_dir, duplicate_dict[s][1], duplicate_dict[s][0]))
+    return {s: series[s] for s in series if s not in duplicate_dict}, duplicate_dict
+
+
+def prepare_dicom_folder(root_dir, dicom_dir, output_subdirectory, filename_format, converter_options,
+                         stop_before_pixels=True, scan_options=None, zip_chain=None, member_list=None, cost=None,
+                         source_zip=None, uid_index_path=None, native_conversion=False, catalog_path=None):
+    """
+    Extract the metadata of every DICOM file at the root of dicom_dir and prepare the output sub-directory (and the
+    DICOM files if they come from a zip archive) for the conversion of the series found.
+    Parameters
+    ----------
+    root_dir : str
+        Path to the folder / zip archive dicom_dir comes from
+    dicom_dir : str
+        Path to the folder containing the DICOM files
+    output_subdirectory : str
+        Folder where the converted files and the __dict_save file are stored
+    filename_format : str
+        file format given to dcm2niix
+    converter_options : List of str
+        List of options given to dcm2niix. It is modified if a replacement field is used, so it must not be shared.
+    stop_before_pixels : bool
+        True (default) means that the header's information extracted will not contain the voxels of the dicom file
+    scan_options : dict
+        extra keyword arguments given to dicom_metadata.scan_dicomdir (e.g. {'prescan': True})
+    zip_chain : list of str
+        if the folder is inside a zip archive that has not been extracted, the archive (see
+        extra_utils.open_zip_chain). The headers are then read from the archive, the files of the series found are
+        extracted in dicom_dir for the conversion and deleted afterwards.
+    member_list : list of str
+        the files of the folder in the archive if zip_chain is given
+    cost : tuple
+        Unused, estimated cost of the folder used to schedule the plans
+    source_zip : str
+        Unused, the zip archive the folder comes from (see get_plan_fingerprint)
+    uid_index_path : str
+        path to a uid_index.UidIndex. If given, the series whose instances were already claimed by another folder are
+        not converted (see skip_duplicate_series). When only some series of the folder are skipped, the files of the
+        other series are linked in a temporary folder of output_subdirectory given to dcm2niix.
+    native_conversion : bool
+        True means that the plain single-frame, uncompressed MR series are converted with NumPy and nibabel instead of
+        dcm2niix (see run_native_job), the other series fall back to dcm2niix
+    catalog_path : str
+        path to a metadata_catalog.MetadataCatalog. If given, the converted series are written in the catalog (see
+        complete_dicom_folder)
+
+    Returns
+    -------
+    job : dict or None
+        The series found in 'series' with the information needed by run_dcm2niix_job and complete_dicom_folder or None
+        if there is nothing to convert
+    """
+    if scan_options is None:
+        scan_options = {}
+    if zip_chain is not None:
+        # DicomSerie needs an existing folder
+        os.makedirs(dicom_dir, exist_ok=True)
+    tmp_series = {}
+    try:
+        # the series are identified in one pass, the fields of filename_format missing from some headers are
+        # replaced (see dicom_metadata.resolve_identifier_format)
+        if zip_chain is not None:
+            tmp_series = dicom_metadata.scan_zip_dir(zip_chain, member_list, dirpath=dicom_dir,
+                                                     filename_format=filename_format,
+                                                     stop_before_pixels=stop_before_pixels,
+                                                     **scan_options)
+        else:
+            tmp_series = dicom_metadata.scan_dicomdir(dirpath=dicom_dir,
+                                                      filename_format=filename_format,
+                                                      stop_before_pixels=stop_before_pixels,
+                                                      **scan_options)
+    except AttributeError as err:
+        logging.error('All the replacement fields available have been tried in [ATTRIBUTE ERROR: input {} output '
+                      '{}] but were not found in the DICOM header [{}]'.format(dicom_dir, output_subdirectory, err))
+    except ValueError:
+        logging.info(
+            '[{}] from root_dir: [{}] does not contain any DICOM file or issued an error, it will'
+            ' then be skipped.'.format(dicom_dir, root_dir))
+    if tmp_series:
+        resolved_filename_format = next(iter(tmp_series.values())).identifier_string
+        if resolved_filename_format != filename_format:
+            converter_options[converter_options.index('-f') + 1] = resolved_filename_format
+    duplicate_dict = {}
+    if tmp_series and uid_index_path is not None:
+        tmp_series, duplicate_dict = skip_duplicate_series(tmp_series, dicom_dir, uid_index_path)
+
+    if tmp_series:
+        """ convert the dicom folders into nifti using dcm2niix
+        Note: dcm2niix doesn't handle more than 26 duplicates of the same filename and 
+        will stop converting if there more files would would end up with the same name. 
+        This cannot really happen now, unless one runs the scripts 26 times on the same dataset 
+        without cleaning the output folder. 
+        What can happen though is that we choose the wrong combination of DICOM header fields and 
+        end up with non unique identifiers and so some images will be erased because considered 
+        as duplicates.
+        """
+        # Then extra_utils.check_output_integrity(output_subdirectory) returned false.
+        # So it means that dicom_dir contains dicom files but that either the conversion failed or that some
+        # files are missing
+        if os.path.exists(output_subdirectory):
+            for f in os.listdir(output_subdirectory):
+                f_path = os.path.join(output_subdirectory, f)
+                if os.path.isfile(f_path):
+                    os.remove(f_path)
+        else:
+            os.makedirs(output_subdirectory, exist_ok=False)
+        if zip_chain is not None:
+            # only the files of the series found are extracted
+            serie_file_set = {os.path.basename(f) for s in tmp_series for f in tmp_series[s].file_list}
+            extra_utils.extract_zip_members(zip_chain, [m for m in member_list
+                                                        if os.path.basename(m) in serie_file_set], dicom_dir)
+        return {'root_dir': root_dir, 'dicom_dir': dicom_dir, 'output_subdirectory': output_subdirectory,
+                'converter_options': converter_options, 'zip_chain': zip_chain, 'series': tmp_series,
+                'duplicate_dict': duplicate_dict, 'native_conversion': native_conversion,
+                'catalog_path': catalog_path}
+    return None
+
+
+def get_job_file_list(job):
+    """
+    Files of the series of a job to give to dcm2niix (the series converted by run_native_job are excluded)
+    """
+    native_series = job.get('native_series', [])
+    return [f for s in job['series'] if s not in native_series for f in job['series'][s].file_list]
+
+
+def stage_job(job):
+    """
+    Returns
+    -------
+    conversion_dir : str
+        the folder given to dcm2niix to convert the series of the job: its dicom_dir or, if some series of an
+        extracted folder were skipped as duplicates or some series were converted by run_native_job, a temporary
+        folder in its output sub-directory with links to the files of the other series
+    """
+    if (job['zip_chain'] is None and job['duplicate_dict']) or job.get('native_series'):
+        # dcm2niix only sees the files of the series that are not duplicates
+        conversion_dir = tempfile.mkdtemp(prefix='__dedup_', dir=job['output_subdirectory'])
+        extra_utils.link_files(get_job_file_list(job), conversion_dir)
+        return conversion_dir
+    return job['dicom_dir']
+
+
+def unstage_job(job, conversion_dir):
+    if conversion_dir != job['dicom_dir']:
+        shutil.rmtree(conversion_dir, ignore_errors=True)
+
+
+# SOP classes of the enhanced (multi-frame) images, converted by dcm2niix
+enhanced_sop_class_list = [
+    '1.2.840.10008.5.1.4.1.1.4.1',  # Enhanced MR Image Storage
+    '1.2.840.10008.5.1.4.1.1.4.3',  # Enhanced MR Color Image Storage
+    '1.2.840.10008.5.1.4.1.1.4.4',  # Legacy Converted Enhanced MR Image Storage
+    '1.2.840.10008.5.1.4.1.1.2.1',  # Enhanced CT Image Storage
+]
+# b-value fields of the different manufacturers, a serie with one of them is converted by dcm2niix (bval/bvec)
+diffusion_tag_list = [
+    0x00189087,  # DiffusionBValue
+    0x0019100C,  # Siemens B_value
+    0x00431039,  # GE Slop_int_6...9
+    0x20011003,  # Philips DiffusionBValue
+]
+# header fields copied in the json sidecar of the native conversions, with the factor applied to their value
+native_sidecar_field_dict = {
+    'Modality': None,
+    'MagneticFieldStrength': None,
+    'Manufacturer': None,
+    'ManufacturerModelName': None,
+    'SeriesDescription': None,
+    'ProtocolName': None,
+    'SequenceName': None,
+    'ImageType': None,
+    'SeriesNumber': None,
+    'AcquisitionTime': None,
+    'SliceThickness': None,
+    'SpacingBetweenSlices': None,
+    'EchoTime': 0.001,
+    'RepetitionTime': 0.001,
+    'InversionTime': 0.001,
+    'FlipAngle': None,
+}
+
+
+def get_native_output_options(converter_options):
+    """
+    Returns
+    -------
+    (compress, sidecar) : tuple or None
+        True if the nifti file is compressed and True if a json sidecar is written according to the dcm2niix options
+        or None if the options cannot be reproduced by the native conversion (see convert_serie_natively)
+    """
+    option_dict = {converter_options[i]: converter_options[i + 1] for i in range(len(converter_options) - 1)
+                   if converter_options[i].startswith('-')}
+    if option_dict.get('-b', 'y') not in ['y', 'n'] or option_dict.get('-e', 'n') != 'n' or \
+            option_dict.get('-x', 'n') != 'n' or option_dict.get('-l', 'n') != 'n':
+        return None
+    return option_dict.get('-z', 'n') in ['y', 'i', 'o'], option_dict.get('-b', 'y') == 'y'
+
+
+def check_native_datasets(dataset_list):
+    """
+    Check that the datasets of a serie are plain single-frame, uncompressed, MR images of one volume.
+
+    Raises
+    ------
+    ValueError
+        with the reason why the serie cannot be converted natively
+    """
+    first = dataset_list[0]
+    if getattr(first, 'Modality', None) != 'MR':
+        raise ValueError('not an MR serie')
+    for field in ['Rows', 'Columns', 'PixelSpacing', 'ImageOrientationPatient', 'RescaleSlope', 'RescaleIntercept',
+                  'EchoNumbers', 'BitsAllocated', 'PixelRepresentation']:
+        value_set = set([str(getattr(ds, field, None)) for ds in dataset_list])
+        if len(value_set) > 1:
+            raise ValueError('{} varies between the files'.format(field))
+    for ds in dataset_list:
+        if 'PixelData' not in ds:
+            raise ValueError('no pixel data')
+        if ds.file_meta.TransferSyntaxUID.is_compressed:
+            raise ValueError('compressed transfer syntax')
+        if str(getattr(ds, 'SOPClassUID', '')) in enhanced_sop_class_list or \
+                'PerFrameFunctionalGroupsSequence' in ds or int(getattr(ds, 'NumberOfFrames', 1) or 1) != 1:
+            raise ValueError('multi-frame (enhanced) image')
+        if getattr(ds, 'SamplesPerPixel', 1) != 1:
+            raise ValueError('not a grayscale image')
+        image_type = [str(t).upper() for t in getattr(ds, 'ImageType', [])]
+        if 'MOSAIC' in image_type:
+            raise ValueError('mosaic image')
+        if 'DIFFUSION' in image_type or any([tag in ds for tag in diffusion_tag_list]):
+            raise ValueError('diffusion image')
+        if 'ImagePositionPatient' not in ds or 'ImageOrientationPatient' not in ds or 'PixelSpacing' not in ds:
+            raise ValueError('missing geometry')
+
+
+def stack_native_datasets(dataset_list):
+    """
+    Stack the pixel arrays of the datasets of a serie (see check_native_datasets) sorted along the slice direction and
+    compute the affine of the volume from ImagePositionPatient, ImageOrientationPatient and PixelSpacing.
+
+    Returns
+    -------
+    data : np.ndarray
+        array of shape (Columns, Rows, number of files), the rows in reverse order like in the outputs of dcm2niix
+    affine : np.ndarray
+        4x4 voxel to RAS+ world matrix
+
+    Raises
+    ------
+    ValueError
+        if several files have the same position or the slices are not evenly spaced along a line
+    """
+    orientation = np.array(dataset_list[0].ImageOrientationPatient, dtype=float)
+    row_cosine = orientation[:3]
+    column_cosine = orientation[3:]
+    normal = np.cross(row_cosine, column_cosine)
+    position_array = np.array([ds.ImagePositionPatient for ds in dataset_list], dtype=float)
+    order = np.argsort(position_array.dot(normal))
+    position_array = position_array[order]
+    # PixelSpacing is [distance between the rows, distance between the columns]
+    row_spacing, column_spacing = [float(v) for v in dataset_list[0].PixelSpacing]
+    if len(dataset_list) > 1:
+        slice_vector = (position_array[-1] - position_array[0]) / (len(dataset_list) - 1)
+        if np.linalg.norm(slice_vector) < 1e-4:
+            raise ValueError('several files at the same position')
+        expected_array = position_array[0] + np.outer(np.arange(len(dataset_list)), slice_vector)
+        if not np.allclose(position_array, expected_array, atol=max(1e-3, 0.01 * np.linalg.norm(slice_vector))):
+            raise ValueError('the slices are not evenly spaced')
+    else:
+        first = dataset_list[0]
+        thickness = getattr(first, 'SpacingBetweenSlices', None) or getattr(first, 'SliceThickness', None) or 1.
+        slice_vector = normal * float(thickness)
+    # DICOM uses LPS+ coordinates, nifti RAS+
+    lps_affine = np.eye(4)
+    lps_affine[:3, 0] = row_cosine * column_spacing
+    lps_affine[:3, 1] = column_cosine * row_spacing
+    lps_affine[:3, 2] = slice_vector
+    lps_affine[:3, 3] = position_array[0]
+    # like dcm2niix, the rows are stored from the last one so the second axis goes against the column direction
+    # (LAS voxel order for an axial serie)
+    rows = int(dataset_list[0].Rows)
+    lps_affine[:3, 3] += (rows - 1) * lps_affine[:3, 1]
+    lps_affine[:3, 1] *= -1
+    affine = np.diag([-1., -1., 1., 1.]).dot(lps_affine)
+    # pixel_array is indexed [row, column] and the first axis of the volume follows the row direction
+    data = np.stack([dataset_list[ind].pixel_array.T[:, ::-1] for ind in order], axis=-1)
+    return data, affine
+
+
+def create_native_sidecar(dataset):
+    sidecar = {}
+    for field, factor in native_sidecar_field_dict.items():
+        value = getattr(dataset, field, None)
+        if value is None or value == '':
+            continue
+        if isinstance(value, pydicom.multival.MultiValue):
+            value = [str(v) for v in value]
+        elif factor is not None:
+            value = float(value) * factor
+        elif isinstance(value, (int, float)):
+            value = float(value) if isinstance(value, float) else int(value)
+        else:
+            value = str(value)
+        sidecar[field] = value
+    sidecar['ConversionSoftware'] = 'data_identification native conversion'
+    return sidecar
+
+
+def convert_serie_natively(serie, output_subdirectory, compress=False, sidecar=True):
+    """
+    Convert a plain single-frame, uncompressed MR serie (see check_native_datasets) with NumPy and nibabel instead of
+    dcm2niix. The datasets kept by the serie are used if they contain the pixel data (see
+    dicom_metadata.scan_dicomdir with stop_before_pixels=False), the files are read otherwise.
+
+    Parameters
+    ----------
+    serie : dicom_metadata.DicomSerie
+        the serie to convert, the outputs are named and oriented like the ones of dcm2niix (see
+        dicom_metadata.SeriesKeyFormatter.output_prefix and stack_native_datasets)
+    output_subdirectory : str
+        folder where the nifti file and its json sidecar are written
+    compress : bool
+        True means that the nifti file is gzipped
+    sidecar : bool
+        True means that a json sidecar with a few acquisition fields is written
+
+    Returns
+    -------
+    (output_pref, output_entry) : tuple
+        the prefix of the outputs (the key of the dcm2niix outputs of the serie) and the outputs in the format of
+        extra_utils.populate_output_dict
+
+    Raises
+    ------
+    ValueError
+        if the serie cannot be converted natively
+    """
+    dataset_list = [ds for ds in serie.datasets] if not serie.incremental and not serie.prescanned else []
+    if len(dataset_list) != len(serie.file_list) or any(['PixelData' not in ds for ds in dataset_list]):
+        # the first file is checked before reading the others
+        dataset_list = [pydicom.dcmread(serie.file_list[0])]
+        check_native_datasets(dataset_list)
+        dataset_list += [pydicom.dcmread(f) for f in serie.file_list[1:]]
+    check_native_datasets(dataset_list)
+    data, affine = stack_native_datasets(dataset_list)
+    if data.dtype == np.uint16 and data.max() < 2 ** 15:
+        # like dcm2niix, for the software not handling unsigned 16 bit images
+        data = data.astype(np.int16)
+    image = nib.Nifti1Image(data, affine)
+    image.header.set_qform(affine, code=1)
+    image.header.set_sform(affine, code=1)
+    image.header.set_xyzt_units('mm', 'sec')
+    slope = float(getattr(dataset_list[0], 'RescaleSlope', 1) or 1)
+    intercept = float(getattr(dataset_list[0], 'RescaleIntercept', 0) or 0)
+    if slope != 1 or intercept != 0:
+        image.header.set_slope_inter(slope, intercept)
+    output_pref = dicom_metadata.get_series_key_formatter(serie.identifier_string).output_prefix(dataset_list[0],
+                                                                                                 serie.dicom_folder)
+    output_prefix = os.path.join(output_subdirectory, output_pref)
+    output_entry = {'output_dir': output_subdirectory,
+                    'output_path': output_prefix + ('.nii.gz' if compress else '.nii')}
+    nib.save(image, output_entry['output_path'])
+    if sidecar:
+        output_entry['json'] = output_prefix + '.json'
+        with open(output_entry['json'], 'w+') as sidecar_file:
+            json.dump(create_native_sidecar(dataset_list[0]), sidecar_file, indent=4)
+    return output_pref, output_entry
+
+
+def run_native_job(job):
+    """
+    Convert the series of a job created by prepare_dicom_folder with native_conversion that can be converted without
+    dcm2niix (see convert_serie_natively). The converted series are stored in job['native_series'] so they are not
+    given to dcm2niix (see get_job_file_list), the other ones fall back to dcm2niix.
+
+    Returns
+    -------
+    output_dict : dict
+        the outputs of the series converted natively (see extra_utils.populate_output_dict)
+    """
+    if 'native_series' in job:
+        return job['native_output_dict']
+    job['native_series'] = []
+    job['native_output_dict'] = {}
+    output_options = get_native_output_options(job['converter_options'])
+    if not job.get('native_conversion') or output_options is None:
+        return job['native_output_dict']
+    for s in job['series']:
+        try:
+            output_pref, output_entry = convert_serie_natively(job['series'][s], job['output_subdirectory'],
+                                                               *output_options)
+        except Exception as e:
+            logging.debug('[{}] from [{}] will be converted with dcm2niix: {}'.format(s, job['dicom_dir'], e))
+            continue
+        logging.info('[{}] from [{}] converted without dcm2niix'.format(s, job['dicom_dir']))
+        job['native_series'].append(s)
+        job['native_output_dict'][output_pref] = output_entry
+    return job['native_output_dict']
+
+
+def run_dcm2niix_job(job):
+    """
+    Convert the series of a job created by prepare_dicom_folder with dcm2niix (the series that can be converted
+    natively are converted first by run_native_job if the job has native_conversion).
+
+    Returns
+    -------
+    output_dict : dict
+        The outputs of dcm2niix (see extra_utils.populate_output_dict)
+    """
+    native_output_dict = run_native_job(job)
+    if not get_job_file_list(job):
+        return dict(native_output_dict)
+    conversion_dir = stage_job(job)
+    try:
+        dcm2niix_output_string = dcm2niix_convert_folder(
+            folder_path=conversion_dir,
+            output_folder=job['output_subdirectory'],
+            dcm2niix_options=job['converter_options']
+        )
+    finally:
+        unstage_job(job, conversion_dir)
+    output_dict = extra_utils.populate_output_dict(dcm2niix_output_string)
+    output_dict.update(native_output_dict)
+    return output_dict
+
+
+def get_output_series(output_dict, series):
+    """
+    Serie of each output of a folder: the serie with the longest dcm2niix output prefix (see
+    dicom_metadata.DicomSerie.output_prefix_set) starting the output prefix, as dcm2niix adds suffixes such as '_e2'
+    or '_ph' to the outputs of a serie.
+
+    Parameters
+    ----------
+    output_dict : dict
+        the outputs of the folder (see extra_utils.populate_output_dict), the outputs of the series that were not
+        converted have their serie identifier as prefix
+    series : dict
+        the series of the folder (see dicom_metadata.scan_dicomdir)
+
+    Returns
+    -------
+    output_serie_dict : dict
+        output prefix: serie identifier, for the outputs linked to a serie
+    """
+    prefix_list = sorted([(output_prefix, s) for s in series for output_prefix in series[s].output_prefix_set],
+                         key=lambda item: -len(item[0]))
+    output_serie_dict = {}
+    for pref in output_dict:
+        if pref in series:
+            output_serie_dict[pref] = pref
+            continue
+        s = next((s for output_prefix, s in prefix_list if pref.startswith(output_prefix)), None)
+        if s is not None:
+            output_serie_dict[pref] = s
+    return output_serie_dict
+
+
+def complete_dicom_folder(job, output_dict):
+    """
+    Write the __dicom_metadata.json files of the series of a job created by prepare_dicom_folder and the __dict_save
+    file of its output sub-directory, and the rows of the series in the metadata catalog of the job if it has one.
+    Parameters
+    ----------
+    job : dict
+        see prepare_dicom_folder
+    output_dict : dict
+        the outputs of dcm2niix for the series of the job (see extra_utils.populate_output_dict)
+
+    Returns
+    -------
+    output_dict : dict
+        The content of the __dict_save file written in the output sub-directory
+    """
+    root_dir = job['root_dir']
+    dicom_dir = job['dicom_dir']
+    output_subdirectory = job['output_subdirectory']
+    zip_chain = job['zip_chain']
+    tmp_series = job['series']
+    if output_dict:
+        for pref in output_dict:
+            output_dict[pref]['input_folder'] = dicom_dir
+        # we store a json file in the output_subdirectory in case the final json is not written
+
+    else:
+        # it means that tmp_serie is not empty, so we should have a metadata json file
+        output_dict = {}
+        for s in tmp_series:
+            output_dict[s] = {'output_dir': output_subdirectory,
+                              'input_folder': dicom_dir}
+
+    output_serie_dict = get_output_series(output_dict, tmp_series)
+    for s in tmp_series:
+        try:
+            tmp_series[s].save_json(output_subdirectory)
+            metadata_file_field = tmp_series[s].output_full_path
+        except NotImplementedError as e:
+            # TODO find a fix to avoid pydicom to just break everything when the conversion fails ...
+            logging.info(
+                '[{}] raised a NotImplementedError [METADATA ERROR: {}]'.format(
+                    dicom_dir, e)
             )
+            metadata_file_field = 'failed to generate metadata'
+        except AttributeError as e:
+            # TODO find a fix to avoid pydicom to just break everything when the conversion fails ...
+            logging.info(
+                '[{}] raised a AttributeError [METADATA ERROR: {}]'.format(
+                    dicom_dir, e)
+            )
+            metadata_file_field = 'failed to generate metadata'
+        for pref in output_dict:
+            if output_serie_dict.get(pref) == s:
+                output_dict[pref]['metadata'] = metadata_file_field
 
-            output_dict = extra_utils.populate_output_dict(dcm2niix_output_string)
-            if output_dict:
-                for pref in output_dict:
-                    output_dict[pref]['input_folder'] = dicom_dir
-                # we store a json file in the output_subdirectory in case the final json is not written
+    if zip_chain is not None:
+        # the metadata has been generated so the extracted files are not needed anymore
+        for f in os.listdir(dicom_dir):
+            if os.path.isfile(os.path.join(dicom_dir, f)):
+                os.remove(os.path.join(dicom_dir, f))
+    if '_unzip' in dicom_dir:
+        for pref in output_dict:
+            output_dict[pref]['input_zip'] = root_dir
+    with open(os.path.join(output_subdirectory, '__dict_save'), 'w+') as out_file:
+        json.dump(output_dict, out_file, indent=4)
+    if job.get('catalog_path') is not None:
+        try:
+            catalog = metadata_catalog.MetadataCatalog(job['catalog_path'])
+            try:
+                catalog.add_series(output_subdirectory, output_dict,
+                                   {pref: tmp_series[s].metadata_json_dict for pref, s in output_serie_dict.items()})
+            finally:
+                catalog.close()
+        except sqlite3.Error as e:
+            logging.error('[{}] could not be written in the metadata catalog [CATALOG ERROR: {}]'.format(
+                output_subdirectory, e))
+    return output_dict
 
-            else:
-                # it means that tmp_serie is not empty, so we should have a metadata json file
-                output_dict = {}
-                for s in tmp_series:
-                    output_dict[s] = {'output_dir': output_subdirectory,
-                                      'input_folder': dicom_dir}
-
-            for s in tmp_series:
-                try:
-                    tmp_series[s].save_json(output_subdirectory)
-                    metadata_file_field = tmp_series[s].output_full_path
-                except NotImplementedError as e:
-                    # TODO find a fix to avoid pydicom to just break everything when the conversion fails ...
-                    logging.info(
-                        '[{}] raised a NotImplementedError [METADATA ERROR: {}]'.format(
-                            dicom_dir, e)
-                    )
-                    metadata_file_field = 'failed to generate metadata'
-                except AttributeError as e:
-                    # TODO find a fix to avoid pydicom to just break everything when the conversion fails ...
-                    logging.info(
-                        '[{}] raised a AttributeError [METADATA ERROR: {}]'.format(
-                            dicom_dir, e)
-                    )
-                    metadata_file_field = 'failed to generate metadata'
-                for pref in output_dict:
-                    if s in pref:
-                        output_dict[pref]['metadata'] = metadata_file_field
-
-            if '_unzip' in dicom_dir:
-                for pref in output_dict:
-                    output_dict[pref]['input_zip'] = root_dir
-            with open(os.path.join(output_subdirectory, '__dict_save'), 'w+') as out_file:
-                json.dump(output_dict, out_file, indent=4)
+
+def convert_dicom_folder(root_dir, dicom_dir, output_subdirectory, filename_format, converter_options,
+                         stop_before_pixels=True, scan_options=None, zip_chain=None, member_list=None, cost=None,
+                         source_zip=None, uid_index_path=None, native_conversion=False, catalog_path=None):
+    """
+    Extract the metadata of every DICOM file at the root of dicom_dir, create the __dicom_metadata.json files and, if
+    they are created, convert the DICOM data with dcm2niix.
+    Parameters
+    ----------
+    root_dir : str
+        Path to the folder / zip archive dicom_dir comes from
+    dicom_dir : str
+        Path to the folder containing the DICOM files
+    output_subdirectory : str
+        Folder where the converted files and the __dict_save file are stored
+    filename_format : str
+        file format given to dcm2niix
+    converter_options : List of str
+        List of options given to dcm2niix. It is modified if a replacement field is used, so it must not be shared.
+    stop_before_pixels : bool
+        True (default) means that the header's information extracted will not contain the voxels of the dicom file
+    scan_options : dict
+        extra keyword arguments given to dicom_metadata.scan_dicomdir (e.g. {'prescan': True})
+    zip_chain : list of str
+        if the folder is inside a zip archive that has not been extracted, the archive (see
+        extra_utils.open_zip_chain). The headers are then read from the archive, the files of the series found are
+        extracted in dicom_dir for the conversion and deleted afterwards.
+    member_list : list of str
+        the files of the folder in the archive if zip_chain is given
+    cost : tuple
+        Unused, estimated cost of the folder used to schedule the plans
+    source_zip : str
+        Unused, the zip archive the folder comes from (see get_plan_fingerprint)
+    uid_index_path : str
+        path to a uid_index.UidIndex. If given, the series whose instances were already claimed by another folder are
+        not converted (see skip_duplicate_series). When only some series of the folder are skipped, the files of the
+        other series are linked in a temporary folder of output_subdirectory given to dcm2niix.
+    native_conversion : bool
+        True means that the plain single-frame, uncompressed MR series are converted with NumPy and nibabel instead of
+        dcm2niix (see run_native_job), the other series fall back to dcm2niix
+    catalog_path : str
+        path to a metadata_catalog.MetadataCatalog. If given, the converted series are written in the catalog (see
+        complete_dicom_folder)
+
+    Returns
+    -------
+    output_dict : dict or None
+        The content of the __dict_save file written in output_subdirectory or None if nothing was converted
+    """
+    job = prepare_dicom_folder(root_dir, dicom_dir, output_subdirectory, filename_format, converter_options,
+                               stop_before_pixels=stop_before_pixels, scan_options=scan_options, zip_chain=zip_chain,
+                               member_list=member_list, uid_index_path=uid_index_path,
+                               native_conversion=native_conversion, catalog_path=catalog_path)
+    if job is None:
+        return None
+    return complete_dicom_folder(job, run_dcm2niix_job(job))
+
+
+def get_verbose_options(converter_options):
+    """
+    converter_options with the verbose mode of dcm2niix (-v 1) which prints the first DICOM file of each serie
+    converted (see extra_utils.Dcm2niixOutputParser).
+
+    Returns
+    -------
+    (verbose_options, forced) : tuple
+        forced is True if converter_options were not already verbose
+    """
+    verbose_options = list(converter_options)
+    if '-v' in verbose_options:
+        value_index = verbose_options.index('-v') + 1
+        if verbose_options[value_index] not in ['n', '0']:
+            return verbose_options, False
+        verbose_options[value_index] = '1'
+    else:
+        verbose_options += ['-v', '1']
+    return verbose_options, True
+
+
+def run_dcm2niix_batch(job_list, batch_folder):
+    """
+    Convert the series of several jobs created by prepare_dicom_folder with a single dcm2niix run. The files of the
+    jobs are linked in a temporary folder of batch_folder, named with the index of their job as prefix, and the
+    outputs of dcm2niix are moved to the output sub-directory of the job of their first DICOM file (printed by dcm2niix
+    in verbose mode, see get_verbose_options).
+    Parameters
+    ----------
+    job_list : list of dict
+        jobs with the same converter options and no serie identifier in common
+    batch_folder : str
+        folder where the temporary folder of the batch is created
+
+    Returns
+    -------
+    output_dict_list : list of dict or None
+        The outputs of dcm2niix of each job (see extra_utils.populate_output_dict) or None if an output could not be
+        assigned to one job, nothing is then moved to the output sub-directories.
+    """
+    staging_folder = tempfile.mkdtemp(prefix='__dcm2niix_batch_', dir=batch_folder)
+    try:
+        input_folder = os.path.join(staging_folder, 'input')
+        output_folder = os.path.join(staging_folder, 'output')
+        os.makedirs(output_folder)
+        for ind, job in enumerate(job_list):
+            extra_utils.link_files(get_job_file_list(job), input_folder, prefix='{}_'.format(ind))
+        verbose_options, forced = get_verbose_options(job_list[0]['converter_options'])
+        parser = extra_utils.Dcm2niixOutputParser()
+        for line in dcm2niix_convert_folder(folder_path=input_folder, output_folder=output_folder,
+                                            dcm2niix_options=verbose_options).splitlines():
+            # the details of each file printed in verbose mode are not kept if the verbose mode was not requested
+            if not forced or not (line.startswith('DICOM file') or line.startswith(' ')):
+                parser.feed_line(line)
+        batch_dict = parser.converted_files
+        owner_dict = {}
+        for pref in batch_dict:
+            owner = os.path.basename(parser.input_files.get(pref, '')).split('_', 1)[0]
+            if not owner.isdigit() or int(owner) >= len(job_list):
+                logging.info('[{}] could not be assigned to one folder of the dcm2niix batch, the folders will be '
+                             'converted separately'.format(pref))
+                return None
+            owner_dict[pref] = int(owner)
+            batch_dict[pref].update(extra_utils.dcm2niix_output_dict(os.path.join(batch_dict[pref]['output_dir'],
+                                                                                  pref)))
+        output_dict_list = [{} for _ in job_list]
+        for pref in batch_dict:
+            output_subdirectory = job_list[owner_dict[pref]]['output_subdirectory']
+            for k in batch_dict[pref]:
+                if k in extra_utils.ignored_output_dict_fields:
+                    continue
+                new_path = os.path.join(output_subdirectory, os.path.basename(batch_dict[pref][k]))
+                shutil.move(batch_dict[pref][k], new_path)
+                batch_dict[pref][k] = new_path
+            batch_dict[pref]['output_dir'] = output_subdirectory
+            output_dict_list[owner_dict[pref]][pref] = batch_dict[pref]
+        return output_dict_list
+    finally:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+
+
+def convert_dicom_folder_batch(plan_list, batch_folder):
+    """
+    Same as convert_dicom_folder for several (small) folders: the folders are scanned one by one and their series are
+    converted with a single dcm2niix run (see run_dcm2niix_batch). The folders that cannot be in the batch (different
+    dcm2niix options or serie identifiers already in the batch) or the whole batch if its outputs cannot be assigned
+    to the folders are converted separately. The series converted natively (see run_native_job) are not in the batch.
+    Parameters
+    ----------
+    plan_list : list of dict
+        keyword arguments of convert_dicom_folder for each folder
+    batch_folder : str
+        folder where the temporary folder of the batch is created
+
+    Returns
+    -------
+    output_dict_list : list
+        the value returned by convert_dicom_folder for each plan of plan_list
+    """
+    job_list = [prepare_dicom_folder(**plan) for plan in plan_list]
+    dcm2niix_output_list = [None] * len(job_list)
+    batch_index_list = []
+    separate_index_list = []
+    batch_serie_set = set()
+    for ind, job in enumerate(job_list):
+        if job is None:
+            continue
+        run_native_job(job)
+        if not get_job_file_list(job):
+            # every serie was converted natively
+            dcm2niix_output_list[ind] = dict(job['native_output_dict'])
+            continue
+        if (batch_index_list and job['converter_options'] != job_list[batch_index_list[0]]['converter_options']) or \
+                batch_serie_set.intersection(job['series']):
+            separate_index_list.append(ind)
+        else:
+            batch_index_list.append(ind)
+            batch_serie_set.update(job['series'])
+    if len(batch_index_list) > 1:
+        logging.info('Converting {} folders with one dcm2niix run'.format(len(batch_index_list)))
+        batch_output_list = run_dcm2niix_batch([job_list[ind] for ind in batch_index_list], batch_folder)
+        if batch_output_list is None:
+            separate_index_list += batch_index_list
+        else:
+            for ind, batch_output in zip(batch_index_list, batch_output_list):
+                batch_output.update(job_list[ind]['native_output_dict'])
+                dcm2niix_output_list[ind] = batch_output
+    else:
+        separate_index_list += batch_index_list
+    for ind in separate_index_list:
+        dcm2niix_output_list[ind] = run_dcm2niix_job(job_list[ind])
+    return [None if job is None else complete_dicom_folder(job, dcm2niix_output)
+            for job, dcm2niix_output in zip(job_list, dcm2niix_output_list)]
+
+
+def finalize_subdir(root_dir, output_folder):
+    """
+    Remove the empty folders and the uncompressed zip archives from the output directory of root_dir once all its
+    sub-folders have been processed.
+    """
+    output_directory = get_output_directory(root_dir, output_folder)
     # we remove all the empty folders
     extra_utils.remove_empty_folders(output_directory)
     for r, _, _ in os.walk(output_directory):
@@ -235,17 +996,21 @@ def convert_subdir(root_dir, output_folder, filename_format, converter_options=N
             shutil.rmtree(r, ignore_errors=True)
 
 
-def convert_dataset(input_path_list, output_folder, converter_options=None, rerun='resume',
-                    stop_before_pixels=True, nb_cores=-1):
+def convert_subdir(root_dir, output_folder, filename_format, converter_options=None, rerun='resume',
+                   stop_before_pixels=True, scan_options=None, zip_in_memory=False, skipped_zip_list=None):
     """
-    Format the parameters and calls the convert_subdir function in parallel to convert every zip archive and directories
-    containing DICOM images.
+    Convert and store the metadata of a given directory / zip archive. First, the function walks through the directory
+    to list sub-folders (and uncompress every zip archive to add its folders to the list). Then, for each sub-folder
+    of the list, the function will try to extract the metadata of every DICOM file and create the __dicom_metadata.json
+    files. If the __dicom_metadata.json are created, the function tries to convert the DICOM data.
     Parameters
     ----------
-    input_path_list : List of str
-        List of the absolute file paths of the folders / zip archives to be converted
+    root_dir : str
+        Path to the folder to be converted
     output_folder : str
         Absolute path to the output folder where the converted files and log files will be stored
+    filename_format : str
+        file format given to dcm2niix
     converter_options : List of str
         List of options given to dcm2niix ('dcm2niix -h' to see the possible options) to apply it on
         every conversion performed
@@ -257,10 +1022,266 @@ def convert_dataset(input_path_list, output_folder, converter_options=None, reru
         'none' (not recommended) does not handle the rerun
     stop_before_pixels : bool
         True (default) means that the header's information extracted will not contain the voxels of the dicom file
+    scan_options : dict
+        extra keyword arguments given to dicom_metadata.scan_dicomdir (e.g. {'prescan': True})
+    zip_in_memory : bool
+        True means that the headers are read directly from the zip archives (see list_subdir_plans)
+    skipped_zip_list : list of str
+        see list_subdir_plans
 
     Returns
     -------
-    None
+    converted_dict : dict
+        Keys are the output sub-directories created during this call and values are the content of the __dict_save
+        file written in each of them
+    """
+    converted_dict = {}
+    for plan in list_subdir_plans(root_dir, output_folder, filename_format, converter_options=converter_options,
+                                  rerun=rerun, stop_before_pixels=stop_before_pixels,
+                                  scan_options=scan_options, zip_in_memory=zip_in_memory,
+                                  skipped_zip_list=skipped_zip_list):
+        output_dict = convert_dicom_folder(**plan)
+        if output_dict is not None:
+            converted_dict[plan['output_subdirectory']] = output_dict
+    finalize_subdir(root_dir, output_folder)
+    return converted_dict
+
+
+def create_conversion_plan(root_dir, output_folder, filename_format, converter_options=None, rerun='resume',
+                           stop_before_pixels=True, scan_options=None, zip_in_memory=False, skipped_zip_list=None):
+    """
+    Create the picklable description of the conversion of one folder / zip archive. Each plan owns its copy of
+    the dcm2niix options so no state is shared between the workers.
+    Parameters
+    ----------
+    root_dir : str
+        Path to the folder / zip archive to be converted
+    output_folder : str
+        Absolute path to the output folder
+    filename_format : str
+        file format given to dcm2niix
+    converter_options : List of str
+        List of options given to dcm2niix
+    rerun : str ['resume', 'delete', 'none']
+        see convert_subdir
+    stop_before_pixels : bool
+        see convert_subdir
+    scan_options : dict
+        see convert_subdir
+    zip_in_memory : bool
+        see convert_subdir
+    skipped_zip_list : list of str
+        see convert_subdir
+
+    Returns
+    -------
+    plan : dict
+        keyword arguments of convert_subdir
+    """
+    if converter_options is None:
+        converter_options = []
+    return {
+        'root_dir': root_dir,
+        'output_folder': output_folder,
+        'filename_format': filename_format,
+        'converter_options': list(converter_options),
+        'rerun': rerun,
+        'stop_before_pixels': stop_before_pixels,
+        'scan_options': scan_options,
+        'zip_in_memory': zip_in_memory,
+        'skipped_zip_list': skipped_zip_list
+    }
+
+
+def run_conversion_plan(plan):
+    """
+    Execute a plan created by create_conversion_plan. Defined at the module level so it can be sent to the workers
+    of a process pool.
+    """
+    return plan['root_dir'], convert_subdir(**plan)
+
+
+def run_listing_plan(plan):
+    """
+    List the sub-folder plans of the root folder / zip archive of a plan created by create_conversion_plan.
+    """
+    return plan['root_dir'], list_subdir_plans(**plan)
+
+
+def run_folder_plan(plan):
+    """
+    Execute a sub-folder plan created by list_subdir_plans.
+    """
+    return plan['root_dir'], plan['output_subdirectory'], convert_dicom_folder(**plan)
+
+
+def get_plan_fingerprint(plan):
+    """
+    Fingerprint of the input and options of a sub-folder plan, used by the run journal to know if a folder converted
+    in a previous run has changed. The input is identified by the path, size and modification time of the zip archive
+    it comes from (whether it is extracted or read in memory) or by the modification time of the folder, and by the
+    size and number of its files.
+    """
+    if plan.get('source_zip') is not None:
+        stat_result = os.stat(plan['source_zip'])
+        input_fingerprint = [plan['source_zip'], plan.get('zip_chain'), stat_result.st_size, stat_result.st_mtime_ns]
+    else:
+        input_fingerprint = [os.stat(plan['dicom_dir']).st_mtime_ns]
+    fingerprint_list = [input_fingerprint, plan['cost'], plan['filename_format'], plan['converter_options'],
+                        plan['stop_before_pixels'], plan['scan_options']]
+    if plan.get('native_conversion'):
+        fingerprint_list.append('native_conversion')
+    return hashlib.sha1(json.dumps(fingerprint_list, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_zip_fingerprint(zip_path, option_list):
+    """
+    Fingerprint of a zip archive input (path, size and modification time) and of the options of the conversion, used
+    by the run journal to skip the archives entirely converted in a previous run (see plan_dataset).
+    """
+    stat_result = os.stat(zip_path)
+    fingerprint_list = [zip_path, stat_result.st_size, stat_result.st_mtime_ns, option_list]
+    return hashlib.sha1(json.dumps(fingerprint_list, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def record_journal_result(journal, archive_dict, plan, fingerprint, output_dict, error=None):
+    """
+    Record the end of the conversion of a sub-folder plan in the run journal: 'done' with its outputs or 'failed' if
+    nothing was converted, so it is converted again by the next run. Once every sub-folder of a zip archive of
+    archive_dict (see plan_dataset) is done, the archive is recorded as done so the next runs do not extract it.
+    """
+    if output_dict is None or error is not None:
+        journal.record_failed(plan['dicom_dir'], fingerprint, error=error)
+    else:
+        journal.record_done(plan['dicom_dir'], fingerprint, outputs=output_dict)
+    archive = archive_dict.get(plan.get('source_zip'))
+    if archive is None:
+        return
+    archive['remaining'] -= 1
+    archive['failed'] = archive['failed'] or output_dict is None or error is not None
+    if archive['remaining'] == 0 and not archive['failed']:
+        journal.record_done(plan['source_zip'], archive['fingerprint'], input_type='zip')
+
+
+def run_journaled_folder_batch(journaled_batch):
+    """
+    Execute a batch of sub-folder plans and write their 'start' records in the run journal. A batch of one plan is
+    converted with convert_dicom_folder and larger batches with convert_dicom_folder_batch.
+    Parameters
+    ----------
+    journaled_batch : tuple
+        (batch_folder, journaled_plan_list) with (journal_path, fingerprint, plan) in journaled_plan_list, journal_path
+        is None if there is no journal
+
+    Returns
+    -------
+    result_list : list of tuple
+        (plan, fingerprint, output_dict) for each plan of the batch
+    """
+    batch_folder, journaled_plan_list = journaled_batch
+    for journal_path, fingerprint, plan in journaled_plan_list:
+        if journal_path is not None:
+            run_journal.RunJournal(journal_path).record_start(plan['dicom_dir'], fingerprint)
+    plan_list = [plan for _, _, plan in journaled_plan_list]
+    if len(plan_list) == 1:
+        output_dict_list = [convert_dicom_folder(**plan_list[0])]
+    else:
+        output_dict_list = convert_dicom_folder_batch(plan_list, batch_folder)
+    return [(plan, fingerprint, output_dict) for (_, fingerprint, plan), output_dict
+            in zip(journaled_plan_list, output_dict_list)]
+
+
+def create_plan_batches(journaled_plan_list, batch_max_files=0, batch_size=32):
+    """
+    Group the plans of the folders with at most batch_max_files files (see the 'cost' of the plans) into batches of
+    at most batch_size plans, the other plans are alone in their batch. The order of journaled_plan_list is kept, the
+    batches of small folders being placed where their first plan was.
+    """
+    batch_list = []
+    current_batch = None
+    for journaled_plan in journaled_plan_list:
+        if batch_max_files > 0 and batch_size > 1 and journaled_plan[2]['cost'][1] <= batch_max_files:
+            if current_batch is None or len(current_batch) >= batch_size:
+                current_batch = []
+                batch_list.append(current_batch)
+            current_batch.append(journaled_plan)
+        else:
+            batch_list.append([journaled_plan])
+    return batch_list
+
+
+def sort_plans_by_cost(plan_list):
+    """
+    Sort the sub-folder plans from the most expensive to the cheapest so the biggest folders are started first and
+    the small ones fill the gaps at the end of the run.
+    """
+    return sorted(plan_list, key=lambda plan: plan['cost'], reverse=True)
+
+
+def imap_plans(plan_list, run_function, nb_cores, parallel_mode='thread', dcm2niix_cores=None):
+    """
+    Run every plan of plan_list with run_function in a pool of workers (see extra_utils.imap_tasks) and yield the
+    results in their order of completion.
+    Parameters
+    ----------
+    plan_list : list
+        List of picklable plans
+    run_function : function
+        module-level function taking a plan as only argument
+    nb_cores : int
+        number of workers
+    parallel_mode : str ['thread', 'process']
+        see extra_utils.imap_tasks
+    dcm2niix_cores : int
+        maximum number of dcm2niix processes running at the same time in the workers (None means nb_cores)
+
+    Yields
+    ------
+    result
+        the values returned by run_function
+    """
+    if parallel_mode == 'thread':
+        if dcm2niix_cores is not None:
+            set_dcm2niix_semaphore(threading.BoundedSemaphore(dcm2niix_cores))
+        try:
+            yield from extra_utils.imap_tasks(plan_list, run_function, nb_cores, parallel_mode=parallel_mode)
+        finally:
+            set_dcm2niix_semaphore(None)
+        return
+    # the semaphore is shared by the workers of the process pool
+    dcm2niix_semaphore = None if dcm2niix_cores is None else multiprocessing.BoundedSemaphore(dcm2niix_cores)
+    yield from extra_utils.imap_tasks(plan_list, run_function, nb_cores, parallel_mode=parallel_mode,
+                                      initializer=set_dcm2niix_semaphore, initargs=(dcm2niix_semaphore,))
+
+
+def run_plans(plan_list, run_function, nb_cores, parallel_mode='thread'):
+    """
+    Same as imap_plans but returns the list of the results once every plan has been executed.
+    """
+    return list(imap_plans(plan_list, run_function, nb_cores, parallel_mode=parallel_mode))
+
+
+def plan_dataset(input_path_list, output_folder, converter_options=None, rerun='resume', stop_before_pixels=True,
+                 nb_cores=-1, parallel_mode='thread', scan_options=None, zip_in_memory=False, use_journal=False,
+                 deduplicate=False, native_conversion=False, use_catalog=False):
+    """
+    Format the parameters of convert_dataset, list the sub-folders of the inputs in parallel (see list_subdir_plans)
+    and create the plans of the sub-folders to convert, sorted from the biggest to the smallest. The parameters are
+    described in convert_dataset.
+
+    Returns
+    -------
+    journaled_plan_list : list of tuple
+        (journal_path, fingerprint, plan) for each sub-folder to convert (see run_journaled_folder_batch)
+    root_dir_list : list of str
+        the inputs listed
+    journal : run_journal.RunJournal
+        None if use_journal is False
+    uid_index_path : str
+        path to the uid_index.UidIndex, None if deduplicate is False
+    archive_dict : dict
+        {'fingerprint', 'remaining', 'failed'} of each zip archive of the plans, with the number of its sub-folders to
+        convert in 'remaining' (see record_journal_result), empty if use_journal is False
     """
     if converter_options is None:
         # TODO try -t option
@@ -283,13 +1304,457 @@ def convert_dataset(input_path_list, output_folder, converter_options=None, reru
     # we loop through all the dicom directories provided in the input-path_list
     if nb_cores == -1:
         nb_cores = multiprocessing.cpu_count()
-    pool = ThreadPool(nb_cores)
+    journal = None
+    listing_rerun = rerun
+    zip_option_list = [filename_format, converter_options, stop_before_pixels, scan_options, zip_in_memory,
+                       native_conversion]
+    done_zip_list = []
+    if use_journal:
+        os.makedirs(output_folder, exist_ok=True)
+        journal = run_journal.RunJournal(os.path.join(output_folder, run_journal.default_journal_filename))
+        if rerun == 'delete':
+            journal.reset()
+        else:
+            journal.load()
+        if rerun == 'resume':
+            # the journal replaces the integrity checks of the output directories
+            listing_rerun = 'none'
+            # the zip archives whose sub-folders were all converted are neither listed nor extracted again
+            done_zip_list = [record['task'] for record in journal.get_done_records(input_type='zip')
+                             if os.path.isfile(record['task'])
+                             and record['fingerprint'] == get_zip_fingerprint(record['task'], zip_option_list)]
+            logging.info('{} zip archives already converted according to the run journal [{}]'.format(
+                len(done_zip_list), journal.path))
+    uid_index_path = None
+    if deduplicate:
+        os.makedirs(output_folder, exist_ok=True)
+        uid_index_path = os.path.join(output_folder, uid_index.default_index_filename)
+        if rerun == 'delete':
+            uid_index.reset_index(uid_index_path)
+        # the tables are created before the workers use the index
+        uid_index.UidIndex(uid_index_path).close()
+    catalog_path = None
+    if use_catalog:
+        os.makedirs(output_folder, exist_ok=True)
+        catalog_path = os.path.join(output_folder, metadata_catalog.default_catalog_filename)
+        if rerun == 'delete':
+            metadata_catalog.reset_catalog(catalog_path)
+        # the table is created before the workers use the catalog
+        metadata_catalog.MetadataCatalog(catalog_path).close()
+    plan_list = [create_conversion_plan(root_dir, output_folder, filename_format,
+                                        converter_options=converter_options, rerun=listing_rerun,
+                                        stop_before_pixels=stop_before_pixels,
+                                        scan_options=scan_options, zip_in_memory=zip_in_memory,
+                                        skipped_zip_list=[z for z in done_zip_list
+                                                          if z == root_dir or z.startswith(os.path.join(root_dir, ''))])
+                 for root_dir in input_path_list]
+    folder_plan_dict = dict(run_plans(plan_list, run_listing_plan, nb_cores, parallel_mode=parallel_mode))
+    journaled_plan_list = []
+    archive_dict = {}
+    skipped_counter = 0
+    for plan in sort_plans_by_cost([p for root_dir in folder_plan_dict for p in folder_plan_dict[root_dir]]):
+        if uid_index_path is not None:
+            plan['uid_index_path'] = uid_index_path
+        if native_conversion:
+            plan['native_conversion'] = True
+        if catalog_path is not None:
+            plan['catalog_path'] = catalog_path
+        if journal is None:
+            journaled_plan_list.append((None, None, plan))
+            continue
+        source_zip = plan['source_zip']
+        if source_zip is not None and source_zip not in archive_dict:
+            archive_dict[source_zip] = {'fingerprint': get_zip_fingerprint(source_zip, zip_option_list),
+                                        'remaining': 0, 'failed': False}
+        fingerprint = get_plan_fingerprint(plan)
+        if rerun == 'resume' and journal.is_done(plan['dicom_dir'], fingerprint):
+            skipped_counter += 1
+            continue
+        if source_zip is not None:
+            archive_dict[source_zip]['remaining'] += 1
+        journaled_plan_list.append((journal.path, fingerprint, plan))
+    if journal is not None:
+        logging.info('{} sub-folders already converted according to the run journal [{}]'.format(skipped_counter,
+                                                                                                journal.path))
+        for source_zip in archive_dict:
+            if archive_dict[source_zip]['remaining'] == 0:
+                journal.record_done(source_zip, archive_dict[source_zip]['fingerprint'], input_type='zip')
+    return journaled_plan_list, list(folder_plan_dict), journal, uid_index_path, archive_dict
+
+
+def count_remaining_plans(root_dir_list, journaled_plan_list, output_folder):
+    """
+    Count the sub-folders to convert for each input and finalize (see finalize_subdir) the inputs without any.
+
+    Returns
+    -------
+    remaining_dict : dict
+        number of sub-folders to convert for each input
+    """
+    remaining_dict = {root_dir: 0 for root_dir in root_dir_list}
+    for _, _, plan in journaled_plan_list:
+        remaining_dict[plan['root_dir']] += 1
+    for root_dir in remaining_dict:
+        if remaining_dict[root_dir] == 0:
+            finalize_subdir(root_dir, output_folder)
+    return remaining_dict
+
+
+def write_duplicate_report(uid_index_path, output_folder):
+    index = uid_index.UidIndex(uid_index_path)
+    report_path = os.path.join(output_folder, uid_index.default_report_filename)
+    skipped_list = index.write_report(report_path)
+    index.close()
+    logging.info('{} duplicated series ({} files) were not converted, see [{}]'.format(
+        len(skipped_list), sum([s['file_count'] for s in skipped_list]), report_path))
+    return skipped_list
+
+
+def convert_dataset(input_path_list, output_folder, converter_options=None, rerun='resume',
+                    stop_before_pixels=True, nb_cores=-1, parallel_mode='thread', scan_options=None,
+                    zip_in_memory=False, use_journal=False, aggregator=None, deduplicate=False, dcm2niix_cores=None,
+                    batch_max_files=0, batch_size=32, native_conversion=False, use_catalog=False):
+    """
+    Format the parameters and convert every zip archive and directories containing DICOM images in parallel.
+    The sub-folders of every input are first listed in parallel (see list_subdir_plans), then all the sub-folders of
+    all the inputs are put in a single queue, sorted from the biggest to the smallest, so the idle workers can take
+    the remaining sub-folders of any input. The output directory of an input is cleaned (see finalize_subdir) as
+    soon as all its sub-folders are processed.
+    Parameters
+    ----------
+    input_path_list : List of str
+        List of the absolute file paths of the folders / zip archives to be converted
+    output_folder : str
+        Absolute path to the output folder where the converted files and log files will be stored
+    converter_options : List of str
+        List of options given to dcm2niix ('dcm2niix -h' to see the possible options) to apply it on
+        every conversion performed
+    rerun : str ['resume', 'delete', 'none']
+        Strategy to apply in case the output folder contains directories that has already been processed
+        'delete' will just delete the directory and redo the conversion from scratch
+        'resume' (default) will try to assess the integrity of the directory already present and if data is missing or
+        corrupted, it will try to convert it again
+        'none' (not recommended) does not handle the rerun
+    stop_before_pixels : bool
+        True (default) means that the header's information extracted will not contain the voxels of the dicom file
+    nb_cores : int
+        number of workers (-1 (default) uses all the available cores)
+    parallel_mode : str ['thread', 'process']
+        'thread' (default) runs the conversions in a thread pool, 'process' in a process pool (the header parsing is
+        pure python so only the process pool can use several cores)
+    scan_options : dict
+        extra keyword arguments given to dicom_metadata.scan_dicomdir (e.g. {'prescan': True})
+    zip_in_memory : bool
+        True means that the headers are read directly from the zip archives and only the files of the series to
+        convert are extracted (see list_subdir_plans)
+    use_journal : bool
+        True means that the start and the end of the conversion of each sub-folder are recorded in
+        output_folder/__run_journal.jsonl (see run_journal.RunJournal). With the 'resume' rerun option, the
+        sub-folders are then skipped if they were converted in a previous run and their input did not change,
+        without checking the content of the output directories, and the zip archives whose sub-folders were all
+        converted are not extracted again. The sub-folders where nothing was converted are recorded as failed and
+        converted again by the next run. The 'delete' rerun option resets the journal.
+    aggregator : extra_utils.FinalDictAggregator
+        if not None, the output dictionary of each sub-folder is added to the aggregator as soon as it is converted
+    deduplicate : bool
+        True means that the SOPInstanceUIDs of the series are indexed in output_folder/__uid_index.sqlite during the
+        scan and that the series whose instances were all found in a serie of another folder are not converted. The
+        skipped series are listed in output_folder/__skipped_duplicates.json.
+    dcm2niix_cores : int
+        maximum number of dcm2niix processes running at the same time, independently of the number of workers
+        scanning the headers (None (default) means no other limit than nb_cores)
+    batch_max_files : int
+        the sub-folders with at most batch_max_files files are converted by batches of batch_size sub-folders with a
+        single dcm2niix run (see convert_dicom_folder_batch). 0 (default) converts every sub-folder separately.
+    batch_size : int
+        maximum number of sub-folders in a batch
+    native_conversion : bool
+        True means that the plain single-frame, uncompressed MR series are converted with NumPy and nibabel instead of
+        dcm2niix, the other series fall back to dcm2niix (see run_native_job)
+    use_catalog : bool
+        True means that each converted serie is written in output_folder/__metadata_catalog.sqlite as soon as its
+        sub-folder is converted, with indexed columns for the common acquisition fields (see
+        metadata_catalog.MetadataCatalog). The 'delete' rerun option resets the catalog.
+
+    Returns
+    -------
+    converted_dict : dict
+        Keys are the input paths and values are the dictionaries returned by convert_subdir
+    """
+    journaled_plan_list, root_dir_list, journal, uid_index_path, archive_dict = plan_dataset(
+        input_path_list, output_folder, converter_options=converter_options, rerun=rerun,
+        stop_before_pixels=stop_before_pixels, nb_cores=nb_cores, parallel_mode=parallel_mode,
+        scan_options=scan_options, zip_in_memory=zip_in_memory, use_journal=use_journal, deduplicate=deduplicate,
+        native_conversion=native_conversion, use_catalog=use_catalog)
+    if nb_cores == -1:
+        nb_cores = multiprocessing.cpu_count()
+    converted_dict = {root_dir: {} for root_dir in root_dir_list}
+    remaining_dict = count_remaining_plans(root_dir_list, journaled_plan_list, output_folder)
+    batch_list = [(output_folder, batch) for batch in create_plan_batches(journaled_plan_list,
+                                                                          batch_max_files=batch_max_files,
+                                                                          batch_size=batch_size)]
+    logging.info('{} sub-folders to convert from {} inputs in {} tasks'.format(len(journaled_plan_list),
+                                                                              len(root_dir_list), len(batch_list)))
+    for result_list in imap_plans(batch_list, run_journaled_folder_batch, nb_cores, parallel_mode=parallel_mode,
+                                  dcm2niix_cores=dcm2niix_cores):
+        for plan, fingerprint, output_dict in result_list:
+            root_dir = plan['root_dir']
+            if output_dict is not None:
+                converted_dict[root_dir][plan['output_subdirectory']] = output_dict
+                if aggregator is not None:
+                    aggregator.add_converted(plan['output_subdirectory'], output_dict)
+            if journal is not None:
+                record_journal_result(journal, archive_dict, plan, fingerprint, output_dict)
+            remaining_dict[root_dir] -= 1
+            if remaining_dict[root_dir] == 0:
+                finalize_subdir(root_dir, output_folder)
+    if uid_index_path is not None:
+        write_duplicate_report(uid_index_path, output_folder)
+    return converted_dict
+
+
+async def iter_dcm2niix_outputs(folder_path, output_folder, dcm2niix_options=None, timeout=None):
+    """
+    Run dcm2niix on folder_path without blocking the event loop and yield its outputs while it is running. The output
+    of dcm2niix is parsed line by line (see extra_utils.Dcm2niixOutputParser) and each output is yielded when the
+    next 'Convert' line (or the end of the output) shows that its files are written. dcm2niix is killed if the
+    generator is closed, cancelled or if it times out.
+    Parameters
+    ----------
+    folder_path : str
+        folder containing the DICOM files
+    output_folder : str
+        folder where dcm2niix writes the converted files
+    dcm2niix_options : list of str
+        see dcm2niix_convert_folder
+    timeout : float
+        maximum duration of the dcm2niix run in seconds (None means no limit), asyncio.TimeoutError is raised when it
+        is reached
+
+    Yields
+    ------
+    (output_pref, output_entry) : tuple
+        the prefix of an output and its dictionary (see extra_utils.populate_output_dict)
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    process = await asyncio.create_subprocess_exec(*create_dcm2niix_command(folder_path, output_folder,
+                                                                            dcm2niix_options),
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    # stderr is read at the same time so dcm2niix cannot be blocked by a full pipe
+    stderr_task = asyncio.ensure_future(process.stderr.read())
+    parser = extra_utils.Dcm2niixOutputParser()
+    stdout_list = []
+    pending = None
+    try:
+        while True:
+            remaining = None if deadline is None else max(0., deadline - loop.time())
+            try:
+                line = await asyncio.wait_for(process.stdout.readline(), remaining)
+            except asyncio.TimeoutError:
+                logging.error('dcm2niix timed out after {} seconds in folder [{}]'.format(timeout, folder_path))
+                raise
+            if not line:
+                break
+            line = line.decode(errors='replace').rstrip('\r\n')
+            stdout_list.append(line)
+            converted = parser.feed_line(line)
+            if converted is not None:
+                if pending is not None:
+                    yield pending
+                pending = converted
+        await process.wait()
+        logging.info('###STDOUT dcm2niix : {}###\n'.format('\n'.join(stdout_list)))
+        stderr = (await stderr_task).decode(errors='replace')
+        if stderr:
+            logging.error('STDERR in folder [{}]: [CONVERSION ERROR: {}]'.format(folder_path, stderr))
+        if pending is not None:
+            yield pending
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        if not stderr_task.done():
+            stderr_task.cancel()
+
+
+async def convert_dicom_folder_async(plan, executor=None, dcm2niix_semaphore=None, timeout=None, series_queue=None):
+    """
+    Same as convert_dicom_folder in an event loop: the header scan and the writing of the metadata run in executor
+    and dcm2niix is run with iter_dcm2niix_outputs.
+    Parameters
+    ----------
+    plan : dict
+        keyword arguments of convert_dicom_folder
+    executor : concurrent.futures.Executor
+        executor running the blocking steps (None means the default executor of the loop)
+    dcm2niix_semaphore : asyncio.Semaphore
+        if given, it is acquired during the dcm2niix run
+    timeout : float
+        maximum duration of the dcm2niix run in seconds, see iter_dcm2niix_outputs
+    series_queue : asyncio.Queue
+        if given, an event dictionary ('event': 'series', see convert_dataset_async) is put in the queue for each
+        output of dcm2niix
+
+    Returns
+    -------
+    output_dict : dict or None
+        see convert_dicom_folder
+    """
+    loop = asyncio.get_running_loop()
+    job = await loop.run_in_executor(executor, functools.partial(prepare_dicom_folder, **plan))
+    if job is None:
+        return None
+    output_dict = dict(await loop.run_in_executor(executor, run_native_job, job))
+    if series_queue is not None:
+        for output_pref in output_dict:
+            await series_queue.put({'event': 'series', 'root_dir': plan['root_dir'], 'dicom_dir': plan['dicom_dir'],
+                                    'output_subdirectory': plan['output_subdirectory'], 'prefix': output_pref,
+                                    'outputs': copy.deepcopy(output_dict[output_pref])})
+    if not get_job_file_list(job):
+        return await loop.run_in_executor(executor, complete_dicom_folder, job, output_dict)
+    conversion_dir = await loop.run_in_executor(executor, stage_job, job)
+    try:
+        if dcm2niix_semaphore is not None:
+            await dcm2niix_semaphore.acquire()
+        try:
+            async for output_pref, output_entry in iter_dcm2niix_outputs(conversion_dir, job['output_subdirectory'],
+                                                                         job['converter_options'], timeout=timeout):
+                output_entry.update(extra_utils.dcm2niix_output_dict(
+                    os.path.join(str(output_entry['output_dir']), output_pref)))
+                output_dict[output_pref] = output_entry
+                if series_queue is not None:
+                    await series_queue.put({'event': 'series', 'root_dir': plan['root_dir'],
+                                            'dicom_dir': plan['dicom_dir'],
+                                            'output_subdirectory': plan['output_subdirectory'],
+                                            'prefix': output_pref, 'outputs': copy.deepcopy(output_entry)})
+        finally:
+            if dcm2niix_semaphore is not None:
+                dcm2niix_semaphore.release()
+    except BaseException:
+        if job['zip_chain'] is not None:
+            # the files extracted for the conversion are not needed anymore
+            for f in os.listdir(job['dicom_dir']):
+                if os.path.isfile(os.path.join(job['dicom_dir'], f)):
+                    os.remove(os.path.join(job['dicom_dir'], f))
+        raise
+    finally:
+        unstage_job(job, conversion_dir)
+    return await loop.run_in_executor(executor, complete_dicom_folder, job, output_dict)
+
+
+async def convert_dataset_async(input_path_list, output_folder, converter_options=None, rerun='resume',
+                                stop_before_pixels=True, nb_cores=-1, scan_options=None, zip_in_memory=False,
+                                use_journal=False, aggregator=None, deduplicate=False, dcm2niix_cores=None,
+                                folder_timeout=None, executor=None, native_conversion=False,
+                                use_catalog=False):
+    """
+    Asynchronous version of convert_dataset to use in an event loop. It is an asynchronous generator yielding the
+    results as they come: an event for each output of dcm2niix and an event for each sub-folder. At most nb_cores
+    sub-folders are in progress at the same time, their headers are scanned in executor and dcm2niix runs as an
+    asyncio subprocess, so there is no thread per sub-folder in progress. Closing or cancelling the generator cancels
+    the conversions in progress and kills their dcm2niix processes.
+    Parameters
+    ----------
+    input_path_list, output_folder, converter_options, rerun, stop_before_pixels, scan_options, zip_in_memory,
+    use_journal, aggregator, deduplicate, native_conversion, use_catalog :
+        see convert_dataset
+    nb_cores : int
+        maximum number of sub-folders in progress (-1 (default) uses the number of cores)
+    dcm2niix_cores : int
+        maximum number of dcm2niix processes running at the same time (None (default) means nb_cores)
+    folder_timeout : float
+        maximum duration of the conversion of a sub-folder in seconds, from its header scan to the writing of its
+        metadata (None (default) means no limit). The sub-folders that time out are reported with the 'timeout' error
+        and are recorded as failed in the run journal, and their dcm2niix process is killed. A step running in
+        executor (e.g. a header scan) cannot be interrupted: the next sub-folder starts but the thread of the step is
+        only free once it ends.
+    executor : concurrent.futures.Executor
+        executor running the listing of the inputs, the header scans and the writing of the metadata (None (default)
+        creates a thread pool of nb_cores threads)
+
+    Yields
+    ------
+    event : dict
+        'event' is 'series' or 'folder', both have the 'root_dir', 'dicom_dir' and 'output_subdirectory' of the
+        sub-folder. 'series' events have the 'prefix' of the dcm2niix output and its 'outputs' dictionary. 'folder'
+        events have the 'output_dict' written in __dict_save (None if nothing was converted) and the 'error' (None if
+        the conversion succeeded, 'timeout' or the error message).
+    """
+    if nb_cores == -1:
+        nb_cores = multiprocessing.cpu_count()
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=nb_cores)
+    try:
+        journaled_plan_list, root_dir_list, journal, uid_index_path, archive_dict = await loop.run_in_executor(
+            executor, functools.partial(plan_dataset, input_path_list, output_folder,
+                                        converter_options=converter_options, rerun=rerun,
+                                        stop_before_pixels=stop_before_pixels, nb_cores=nb_cores,
+                                        scan_options=scan_options, zip_in_memory=zip_in_memory,
+                                        use_journal=use_journal, deduplicate=deduplicate,
+                                        native_conversion=native_conversion,
+                                        use_catalog=use_catalog))
+        remaining_dict = await loop.run_in_executor(executor, count_remaining_plans, root_dir_list,
+                                                    journaled_plan_list, output_folder)
+        logging.info('{} sub-folders to convert from {} inputs'.format(len(journaled_plan_list), len(root_dir_list)))
+        dcm2niix_semaphore = asyncio.Semaphore(nb_cores if dcm2niix_cores is None else dcm2niix_cores)
+        event_queue = asyncio.Queue()
 
-    pool.map(lambda root_dir: convert_subdir(root_dir, output_folder, filename_format,
-                                             converter_options=converter_options, rerun=rerun,
-                                             stop_before_pixels=stop_before_pixels), input_path_list)
+        async def run_folder(journal_path, fingerprint, plan):
+            if journal_path is not None:
+                run_journal.RunJournal(journal_path).record_start(plan['dicom_dir'], fingerprint)
+            output_dict = None
+            error = None
+            try:
+                output_dict = await asyncio.wait_for(
+                    convert_dicom_folder_async(plan, executor=executor, dcm2niix_semaphore=dcm2niix_semaphore,
+                                               series_queue=event_queue), folder_timeout)
+            except asyncio.TimeoutError:
+                logging.error('[{}] timed out after {} seconds'.format(plan['dicom_dir'], folder_timeout))
+                error = 'timeout'
+            except Exception as e:
+                logging.exception(e)
+                error = str(e)
+            await event_queue.put({'event': 'folder', 'root_dir': plan['root_dir'], 'dicom_dir': plan['dicom_dir'],
+                                   'output_subdirectory': plan['output_subdirectory'], 'output_dict': output_dict,
+                                   'error': error, 'fingerprint': fingerprint, 'plan': plan})
 
-    pool.close()
-    pool.join()
+        plan_iterator = iter(journaled_plan_list)
+        task_list = [asyncio.ensure_future(run_folder(*journaled_plan))
+                     for journaled_plan in itertools.islice(plan_iterator, nb_cores)]
+        done_counter = 0
+        try:
+            while done_counter < len(journaled_plan_list):
+                event = await event_queue.get()
+                if event['event'] == 'folder':
+                    done_counter += 1
+                    # a sub-folder is done so another one can start
+                    for journaled_plan in itertools.islice(plan_iterator, 1):
+                        task_list.append(asyncio.ensure_future(run_folder(*journaled_plan)))
+                    fingerprint = event.pop('fingerprint')
+                    plan = event.pop('plan')
+                    output_dict = event['output_dict']
+                    if output_dict is not None and aggregator is not None:
+                        aggregator.add_converted(event['output_subdirectory'], output_dict)
+                    if journal is not None:
+                        record_journal_result(journal, archive_dict, plan, fingerprint, output_dict,
+                                              error=event['error'])
+                    root_dir = event['root_dir']
+                    remaining_dict[root_dir] -= 1
+                    if remaining_dict[root_dir] == 0:
+                        await loop.run_in_executor(executor, finalize_subdir, root_dir, output_folder)
+                yield event
+        finally:
+            for task in task_list:
+                task.cancel()
+            await asyncio.gather(*task_list, return_exceptions=True)
+        if uid_index_path is not None:
+            await loop.run_in_executor(executor, write_duplicate_report, uid_index_path, output_folder)
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
 
 #%%
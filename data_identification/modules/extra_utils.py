@@ -1,4 +1,5 @@
 import os
+import io
 import numpy as np
 from glob import glob
 import re
@@ -6,13 +7,21 @@ import zipfile
 import csv
 import json
 import logging
+import logging.handlers
 import shutil
-import copy
+import struct
+import time
+import zlib
+import contextlib
 
 from multiprocessing.dummy import Pool as ThreadPool
 import multiprocessing
 
+from data_identification.modules import metadata_catalog
+
 ignored_output_dict_fields = ['output_dir', 'warning', 'info', 'input_folder', 'input_zip']
+# local file header and end of central directory (empty archive) signatures
+zip_signature_list = [b'PK\x03\x04', b'PK\x05\x06']
 
 
 def read_bval_file(path):
@@ -66,12 +75,246 @@ def unzip_recursive_and_list(zipfile_path, output_folder, only_keep_folder_paths
     return file_list
 
 
+@contextlib.contextmanager
+def open_zip_chain(zip_chain):
+    """
+    Open the innermost archive of a chain of nested zip archives (to use in a with statement, every archive of the
+    chain is closed at the end).
+
+    Parameters
+    ----------
+    zip_chain : list of str
+        path to a zip archive followed by the names of the nested zip archives members (each one inside the
+        previous one)
+
+    Yields
+    ------
+    zip_obj : zipfile.ZipFile
+        the nested archives are read in memory
+    """
+    with contextlib.ExitStack() as stack:
+        zip_obj = stack.enter_context(zipfile.ZipFile(zip_chain[0]))
+        for member in zip_chain[1:]:
+            member_buffer = stack.enter_context(io.BytesIO(zip_obj.read(member)))
+            zip_obj = stack.enter_context(zipfile.ZipFile(member_buffer))
+        yield zip_obj
+
+
+def get_zip_chain_dir(unzip_folder, zip_chain, member_dir):
+    """
+    Folder where the files of member_dir, in the innermost archive of zip_chain, are extracted: each nested archive
+    has its own [member name]_unzip folder in unzip_folder (e.g. unzip_folder/a.zip_unzip/scan) so the folders with
+    the same path in different nested archives are not mixed.
+    """
+    return os.path.normpath(os.path.join(unzip_folder, *[member + '_unzip' for member in zip_chain[1:]], member_dir))
+
+
+def _is_zip_member_archive(zip_obj, zipinfo):
+    with zip_obj.open(zipinfo) as member:
+        return member.read(4) == b'PK\x03\x04'
+
+
+def list_zip_member_dirs(zipfile_path):
+    """
+    List, without extracting anything, the folders of a zip archive and of the zip archives it contains (recursively)
+    that contain files.
+
+    Parameters
+    ----------
+    zipfile_path : str
+        path to the zip archive
+
+    Returns
+    -------
+    member_dir_list : list of tuple
+        (zip_chain, member_dir, member_list, total_size) for each folder, with zip_chain the argument of open_zip_chain,
+        member_dir the path of the folder in the innermost archive ('' for its root) and member_list the names of its
+        files
+    """
+    if not zipfile.is_zipfile(zipfile_path):
+        raise ValueError('[{}] is not a zip archive file'.format(zipfile_path))
+    member_dir_list = []
+    chain_list = [[zipfile_path]]
+    while chain_list:
+        zip_chain = chain_list.pop()
+        dir_dict = {}
+        with open_zip_chain(zip_chain) as zip_obj:
+            for zipinfo in zip_obj.infolist():
+                if zipinfo.is_dir():
+                    continue
+                if _is_zip_member_archive(zip_obj, zipinfo):
+                    chain_list.append(zip_chain + [zipinfo.filename])
+                    continue
+                member_dir = os.path.dirname(zipinfo.filename)
+                if member_dir not in dir_dict:
+                    dir_dict[member_dir] = [[], 0]
+                dir_dict[member_dir][0].append(zipinfo.filename)
+                dir_dict[member_dir][1] += zipinfo.file_size
+        for member_dir in dir_dict:
+            member_dir_list.append((zip_chain, member_dir, dir_dict[member_dir][0], dir_dict[member_dir][1]))
+    return member_dir_list
+
+
+def extract_zip_members(zip_chain, member_list, output_folder):
+    """
+    Extract some files of a (nested) zip archive directly in output_folder (the paths inside the archive are not
+    kept, so the members must have different basenames).
+
+    Returns
+    -------
+    output_path_list : list of str
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    output_path_list = []
+    with open_zip_chain(zip_chain) as zip_obj:
+        for member in member_list:
+            output_path = os.path.join(output_folder, os.path.basename(member))
+            with zip_obj.open(member) as member_fd, open(output_path, 'wb') as out_fd:
+                shutil.copyfileobj(member_fd, out_fd)
+            output_path_list.append(output_path)
+    return output_path_list
+
+
+def _init_process_worker(log_queue, log_level, initializer=None, initargs=()):
+    """
+    Initializer of the process pool workers of imap_tasks: every log record is sent to the parent process through
+    log_queue instead of being written by the worker, then initializer(*initargs) is called if it is given.
+    """
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(log_level)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def imap_tasks(task_list, run_function, nb_cores, parallel_mode='thread', initializer=None, initargs=()):
+    """
+    Run every task of task_list with run_function in a pool of workers and yield the results in their order of
+    completion. The tasks are sent one by one to the workers, in the order of task_list, each time a worker is idle.
+    Parameters
+    ----------
+    task_list : list
+        List of picklable tasks
+    run_function : function
+        module-level function taking a task as only argument
+    nb_cores : int
+        number of workers
+    parallel_mode : str ['thread', 'process']
+        'thread' (default) uses a thread pool, 'process' uses a pool of processes, the log records of the processes
+        are then handled by the handlers of the parent's root logger
+    initializer : function
+        called with initargs in each process of the pool (not used by the thread pool)
+    initargs : tuple
+        arguments of initializer
+
+    Yields
+    ------
+    result
+        the values returned by run_function
+    """
+    if parallel_mode == 'thread':
+        pool = ThreadPool(nb_cores)
+        try:
+            yield from pool.imap_unordered(run_function, task_list)
+        finally:
+            pool.close()
+            pool.join()
+        return
+    if parallel_mode != 'process':
+        raise ValueError('Unknown parallel mode [{}], it must be "thread" or "process"'.format(parallel_mode))
+    root_logger = logging.getLogger()
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        pool = multiprocessing.Pool(nb_cores, initializer=_init_process_worker,
+                                    initargs=(log_queue, root_logger.getEffectiveLevel(), initializer, initargs))
+        try:
+            # chunksize=1 because the duration of the tasks is very heterogeneous
+            yield from pool.imap_unordered(run_function, task_list, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        listener.stop()
+
+
+def sniff_file_type(path):
+    """
+    Guess the type of a file from its first bytes: the local file header signature of a zip archive or the 'DICM'
+    prefix following the 128 bytes preamble of a DICOM file. Only the files with a zip signature are checked further
+    with zipfile.is_zipfile.
+
+    Returns
+    -------
+    file_type : str ['zip', 'dicom', 'other']
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(132)
+    except OSError:
+        return 'other'
+    if head[:4] in zip_signature_list:
+        return 'zip' if zipfile.is_zipfile(path) else 'other'
+    if head[128:132] == b'DICM':
+        return 'dicom'
+    return 'other'
+
+
+def discover_inputs(root_dir, sniff_zipfiles=True):
+    """
+    Walk through root_dir in a single pass with os.scandir and yield its folders and zip archives as they are found.
+    The symbolic links to folders are not followed (like os.walk).
+
+    Parameters
+    ----------
+    root_dir : str
+        existing directory
+    sniff_zipfiles : bool
+        True (default) checks the first bytes of every file to find the zip archives (see sniff_file_type)
+
+    Yields
+    ------
+    (entry_type, path, stats) : tuple
+        entry_type is 'folder' or 'zip'. For the folders, stats is (total_size, file_count) of the files at the root
+        of the folder (except the zip archives), like get_folder_file_stats. For the archives, stats is their size.
+    """
+    folder_stack = [root_dir]
+    while folder_stack:
+        folder = folder_stack.pop()
+        total_size = 0
+        file_count = 0
+        subfolder_list = []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolder_list.append(entry.path)
+                    elif entry.is_file():
+                        size = entry.stat().st_size
+                        if sniff_zipfiles and sniff_file_type(entry.path) == 'zip':
+                            yield 'zip', entry.path, size
+                        else:
+                            total_size += size
+                            file_count += 1
+        except OSError as e:
+            logging.error('[{}] cannot be listed [OSError: {}]'.format(folder, e))
+            continue
+        yield 'folder', folder, (total_size, file_count)
+        # reversed so the folders are explored in the order given by scandir
+        folder_stack += reversed(subfolder_list)
+
+
 def create_input_path_list_from_root(root_folder_path, allow_zipfiles=True):
     if not os.path.isdir(root_folder_path):
         raise ValueError(root_folder_path + ' does not exist or is not a directory')
-    input_path_list = [os.path.join(root_folder_path, p) for p in os.listdir(root_folder_path)
-                       if os.path.isdir(os.path.join(root_folder_path, p)) or
-                       (allow_zipfiles and zipfile.is_zipfile(os.path.join(root_folder_path, p)))]
+    input_path_list = []
+    with os.scandir(root_folder_path) as it:
+        for entry in it:
+            if entry.is_dir() or (allow_zipfiles and entry.is_file() and sniff_file_type(entry.path) == 'zip'):
+                input_path_list.append(entry.path)
     return input_path_list
 
 
@@ -83,11 +326,13 @@ def dcm2niix_options_filename_format(option_lst):
     return option_lst[index]
 
 
+forbidden_char_list = [' ', '<', '>', ':', '"', '/', '\\', '|', '?', '*']
+# translation table replacing each forbidden character by '_'
+forbidden_char_table = str.maketrans({c: '_' for c in forbidden_char_list})
+
+
 def clean_string(string):
-    forbidden_char_list = [' ', '<', '>', ':', '"', '/', '\\', '|', '?', '*']
-    for c in forbidden_char_list:
-        string = string.replace(c, '_')
-    return string
+    return string.translate(forbidden_char_table)
 
 
 def is_duplicate(filename, file_list):
@@ -198,6 +443,104 @@ def get_folder_size(path):
     return total_size
 
 
+def link_files(file_list, output_folder, prefix=''):
+    """
+    Create a hard link (or a symbolic link if a hard link cannot be created, e.g. across file systems) to each file of
+    file_list in output_folder. The links are named prefix + the filename.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    for f in file_list:
+        link_path = os.path.join(output_folder, prefix + os.path.basename(f))
+        try:
+            os.link(f, link_path)
+        except OSError:
+            os.symlink(os.path.abspath(f), link_path)
+
+
+def get_folder_file_stats(path):
+    """
+    Size in bytes and number of the files at the root of a folder (the sub-folders are not explored), used as an
+    estimation of the cost of the conversion of the folder.
+
+    Returns
+    -------
+    (total_size, file_count) : tuple of int
+    """
+    total_size = 0
+    file_count = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file():
+                total_size += entry.stat().st_size
+                file_count += 1
+    return total_size, file_count
+
+
+# size of the blocks compressed in parallel by write_parallel_gzip and of the window each block inherits from the
+# previous one (the maximum distance of a deflate back-reference)
+gzip_block_size = 128 * 1024
+gzip_window_size = 32 * 1024
+
+
+def _deflate_block(task):
+    data, start, end, compress_level = task
+    # like pigz, each block is primed with the end of the previous block so the compression ratio is not reduced
+    if start > 0:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zdict=data[max(0, start - gzip_window_size):start])
+    else:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # the blocks end on a byte boundary (sync flush) so their raw deflate streams can be concatenated, the last block
+    # ends the stream
+    return compressor.compress(data[start:end]) + compressor.flush(zlib.Z_FINISH if end == len(data)
+                                                                   else zlib.Z_SYNC_FLUSH)
+
+
+def write_parallel_gzip(path, data, compress_level=6, pool=None, nb_threads=-1, block_size=gzip_block_size):
+    """
+    Write data in a gzip file compressed in parallel, in the style of pigz: data is cut in blocks of block_size bytes
+    that are compressed independently in a pool of threads (zlib releases the GIL while compressing) and concatenated
+    in a single deflate stream, which any gzip reader can decompress.
+
+    Parameters
+    ----------
+    path : str
+        path of the gzip file
+    data : bytes
+        uncompressed content of the file
+    compress_level : int
+        zlib compression level (1 to 9)
+    pool : multiprocessing.pool.ThreadPool
+        pool used to compress the blocks, to share it between several files (default: a pool of nb_threads threads
+        created for this file)
+    nb_threads : int
+        number of threads of the pool created when pool is None (-1 means the number of cores)
+    block_size : int
+        size of the blocks compressed independently
+    """
+    data = memoryview(data).cast('B')
+    task_list = [(data, start, min(start + block_size, len(data)), compress_level)
+                 for start in range(0, max(len(data), 1), block_size)]
+    if pool is None and len(task_list) > 1:
+        block_pool = ThreadPool(multiprocessing.cpu_count() if nb_threads == -1 else nb_threads)
+        try:
+            block_list = block_pool.map(_deflate_block, task_list)
+        finally:
+            block_pool.close()
+            block_pool.join()
+    elif pool is None:
+        block_list = [_deflate_block(t) for t in task_list]
+    else:
+        block_list = pool.map(_deflate_block, task_list)
+    with open(path, 'wb') as gzip_file:
+        # gzip header (RFC 1952): no optional field, the extra flags give the compression level
+        extra_flags = 2 if compress_level == 9 else (4 if compress_level == 1 else 0)
+        gzip_file.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, zlib.DEFLATED, 0, int(time.time()), extra_flags, 255))
+        for block in block_list:
+            gzip_file.write(block)
+        gzip_file.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff))
+
+
 def clean_folder_lists(folder_list):
     found_list = []
     for f in folder_list:
@@ -263,10 +606,7 @@ def dcm2niix_output_dict(output_prefix):
     return output_dict
 
 
-def parse_dcm2niix_output(string):
-    lines = string.splitlines()
-    begin = -1
-    end = len(lines)
+class Dcm2niixOutputParser(object):
     """ Structure of a dcm2niix output
     Software version
     Found X DICOM file(s)
@@ -278,34 +618,69 @@ def parse_dcm2niix_output(string):
     .
     .
     Conversion required [execution time]
+
+    The lines are given one by one to feed_line (e.g. while dcm2niix is running), the information and warnings
+    printed before a 'Convert' line are attached to its output. In verbose mode (-v y), dcm2niix prints
+    'Converting [first DICOM file]' before the outputs of each serie, this file is kept in input_files.
     """
-    info_warnings = {}
-    converted_files = {}
-    for ind, s in enumerate(lines):
-        if re.match(r'^Found .* DICOM file\(s\)$', s):
-            begin = ind
-            info_warnings = {}
-        if s.startswith('Conversion required'):
-            end = ind
-        if begin < ind < end:
-            if not s.startswith('Convert'):
-                if s.startswith('Warning'):
-                    if 'warning' not in info_warnings.keys():
-                        info_warnings['warning'] = []
-                    info_warnings['warning'].append(s)
-                else:
-                    if 'info' not in info_warnings.keys():
-                        info_warnings['info'] = []
-                    info_warnings['info'].append(s)
+
+    def __init__(self):
+        self.converted_files = {}
+        self.input_files = {}
+        self._info_warnings = {}
+        self._input_file = None
+        self._begun = False
+        self._ended = False
+
+    def feed_line(self, line):
+        """
+        Parse the next line of the dcm2niix output.
+
+        Returns
+        -------
+        (output_pref, output_entry) : tuple or None
+            the prefix of the output and its dictionary ('output_dir', 'info', 'warning') if the line is a 'Convert'
+            line, None otherwise
+        """
+        if re.match(r'^Found .* DICOM file\(s\)$', line):
+            self._begun = True
+            self._info_warnings = {}
+            return None
+        if line.startswith('Conversion required'):
+            self._ended = True
+            return None
+        if not self._begun or self._ended:
+            return None
+        if line.startswith('Converting '):
+            self._input_file = line[len('Converting '):].strip()
+            return None
+        if not line.startswith('Convert '):
+            if line.startswith('Warning'):
+                if 'warning' not in self._info_warnings.keys():
+                    self._info_warnings['warning'] = []
+                self._info_warnings['warning'].append(line)
             else:
-                parts = s.split(' ')
-                output = next(s for s in parts if os.sep in s)
-                output_dir = os.path.dirname(output)
-                output_pref = os.path.basename(output)
-                converted_files[output_pref] = info_warnings
-                converted_files[output_pref]['output_dir'] = output_dir
-                info_warnings = {}
-    return converted_files
+                if 'info' not in self._info_warnings.keys():
+                    self._info_warnings['info'] = []
+                self._info_warnings['info'].append(line)
+            return None
+        parts = line.split(' ')
+        output = next(s for s in parts if os.sep in s)
+        output_dir = os.path.dirname(output)
+        output_pref = os.path.basename(output)
+        self.converted_files[output_pref] = self._info_warnings
+        self.converted_files[output_pref]['output_dir'] = output_dir
+        if self._input_file is not None:
+            self.input_files[output_pref] = self._input_file
+        self._info_warnings = {}
+        return output_pref, self.converted_files[output_pref]
+
+
+def parse_dcm2niix_output(string):
+    parser = Dcm2niixOutputParser()
+    for line in string.splitlines():
+        parser.feed_line(line)
+    return parser.converted_files
 
 
 def populate_output_dict(string):
@@ -337,6 +712,20 @@ def check_missing_output_folders(output_dict):
     return missing_output
 
 
+def check_output_dict_files(dict_save):
+    """
+    True if all the files listed in a __dict_save dictionary exist
+    """
+    for key in dict_save:
+        for k in dict_save[key]:
+            if k in ignored_output_dict_fields:
+                continue
+            else:
+                if not os.path.exists(dict_save[key][k]):
+                    return False
+    return True
+
+
 def check_output_integrity(output_folder):
     json_file = os.path.join(output_folder, '__dict_save')
     file_list = os.listdir(output_folder)
@@ -351,14 +740,7 @@ def check_output_integrity(output_folder):
         logging.info('The json {} cannot be loaded properly, [JSON error: {}]. We thus run the '
                      'conversion again.'.format(json_file, err))
         return False
-    for key in dict_save:
-        for k in dict_save[key]:
-            if k in ignored_output_dict_fields:
-                continue
-            else:
-                if not os.path.exists(dict_save[key][k]):
-                    return False
-    return True
+    return check_output_dict_files(dict_save)
 
 
 def handle_duplicate(duplicate_dict_save, duplicate_key, conflict_opt='keep_first_found'):
@@ -396,7 +778,194 @@ def handle_duplicate(duplicate_dict_save, duplicate_key, conflict_opt='keep_firs
     #         if k in duplicate_dict:
 
 
-def create_final_dict(output_folder, conflict_opt='keep_first_found', check_integrity=False):
+def handle_duplicate_list(duplicate_dict_save, duplicate_key_list, conflict_opt='keep_first_found'):
+    """
+    Same as handle_duplicate for several keys of the same __dict_save, the __dict_save file is rewritten only once.
+    """
+    if conflict_opt == 'keep_first_found':
+        output_dir = duplicate_dict_save[duplicate_key_list[0]]['output_dir']
+        for duplicate_key in duplicate_key_list:
+            for k in duplicate_dict_save[duplicate_key]:
+                if k in ignored_output_dict_fields or k == 'metadata':
+                    continue
+                if os.path.isfile(duplicate_dict_save[duplicate_key][k]):
+                    logging.info('removing duplicate: ' + duplicate_dict_save[duplicate_key][k])
+                    os.remove(duplicate_dict_save[duplicate_key][k])
+        duplicate_meta_data_set = set([duplicate_dict_save[k]['metadata'] for k in duplicate_key_list
+                                       if 'metadata' in duplicate_dict_save[k]])
+        for duplicate_key in duplicate_key_list:
+            del duplicate_dict_save[duplicate_key]
+        # we check if the metadata file is not used for another file in the folder before removing it
+        for duplicate_meta_data in duplicate_meta_data_set:
+            metadata_used_elsewhere = any([duplicate_dict_save[k].get('metadata') == duplicate_meta_data
+                                           for k in duplicate_dict_save])
+            if not metadata_used_elsewhere and os.path.exists(duplicate_meta_data):
+                os.remove(duplicate_meta_data)
+        # so only __dict_save remains
+        if len(os.listdir(output_dir)) == 1:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        elif duplicate_dict_save:
+            with open(os.path.join(output_dir, '__dict_save'), 'w') as out_file:
+                json.dump(duplicate_dict_save, out_file, indent=4)
+        else:
+            os.remove(os.path.join(output_dir, '__dict_save'))
+
+
+def read_dict_save(dirpath, check_integrity=False):
+    """
+    Returns
+    -------
+    (dirpath, dict_save) : tuple
+        dict_save is None if check_integrity is True and the folder fails check_output_integrity
+    """
+    if check_integrity and not check_output_integrity(dirpath):
+        return dirpath, None
+    with open(os.path.join(dirpath, '__dict_save'), 'r') as out_file:
+        return dirpath, json.load(out_file)
+
+
+class FinalDictAggregator(object):
+
+    def __init__(self, output_folder, conflict_opt='keep_first_found', check_integrity=False, nb_cores=-1,
+                 catalog_path=None):
+        """
+        Build the final dictionary of a dicom_to_nifti.convert_dataset run. The content of the __dict_save files can
+        be added as the sub-folders are converted (see add_converted) and the remaining __dict_save files of the output
+        folder are read in parallel by finalize. The duplicates are indexed by their key in memory and removed in
+        finalize, each __dict_save file containing duplicates being rewritten only once. The copy of a duplicate that
+        is kept is the one of the first output sub-directory in sorted order, so it does not depend on the order in
+        which the sub-folders are converted or added.
+
+        Parameters
+        ----------
+        output_folder : str
+            Output folder of a dicom_to_nifti.convert_dataset run
+        conflict_opt : str
+            (default : 'keep_first_found') strategy to handle the duplicates, the first found is the first output
+            sub-directory in sorted order
+        check_integrity : bool
+            (default : False) check (or not) if the folder has been converted properly and if not, adds this
+            directory to the error list instead
+        nb_cores : int
+            number of threads reading the __dict_save files (-1 means the number of cpus)
+        catalog_path : str
+            path to the metadata_catalog.MetadataCatalog of the conversion, if given the rows of the duplicates removed
+            are deleted from the catalog
+        """
+        self.output_folder = output_folder
+        self.conflict_opt = conflict_opt
+        self.check_integrity = check_integrity
+        self.nb_cores = multiprocessing.cpu_count() if nb_cores == -1 else nb_cores
+        self.catalog_path = catalog_path
+        self.final_dict = {}
+        self.error_list = []
+        # dirpath: (dict_save, list of the duplicate keys)
+        self._duplicate_dict = {}
+        # key: dirpath of the copy in final_dict
+        self._owner_dict = {}
+        # dirpath: dict_save of the folders added
+        self._dict_save_dict = {}
+
+    def _add_error(self, dirpath):
+        logging.warning('__dict_save in folder [{}] was not added to final dict because of a mismatch '
+                        'between __dict_save and the content or an error during the conversion. '
+                        'The list of failed conversions / metadata extraction can be found in '
+                        '{}/__error_directories.txt'.format(dirpath, self.output_folder))
+        self.error_list.append(dirpath)
+
+    def add(self, dirpath, dict_save):
+        """
+        Add the content of the __dict_save file of dirpath to the final dictionary (ignored if dirpath was already
+        added).
+        """
+        dirpath = os.path.normpath(dirpath)
+        if dirpath in self._dict_save_dict:
+            return
+        self._dict_save_dict[dirpath] = dict_save
+        if dict_save is None:
+            self._add_error(dirpath)
+            return
+        for key in dict_save:
+            owner = self._owner_dict.get(key)
+            if owner is not None and owner < dirpath:
+                self._add_duplicate(dirpath, key)
+                continue
+            if owner is not None:
+                # the copy added before comes after this one in sorted order
+                self._add_duplicate(owner, key)
+            self._owner_dict[key] = dirpath
+            self.final_dict[key] = dict_save[key]
+
+    def _add_duplicate(self, dirpath, key):
+        if dirpath not in self._duplicate_dict:
+            self._duplicate_dict[dirpath] = (self._dict_save_dict[dirpath], [])
+        self._duplicate_dict[dirpath][1].append(key)
+
+    def add_converted(self, dirpath, output_dict):
+        """
+        Add the output dictionary of a sub-folder that was just converted (the content of its __dict_save)
+        """
+        if self.check_integrity and not check_output_dict_files(output_dict):
+            output_dict = None
+        self.add(dirpath, output_dict)
+
+    def list_remaining_folders(self):
+        dirpath_list = []
+        for dirpath, _, filenames in os.walk(self.output_folder):
+            if '__dict_save' in filenames and os.path.normpath(dirpath) not in self._dict_save_dict:
+                dirpath_list.append(dirpath)
+        return dirpath_list
+
+    def add_folder_list(self, dirpath_list):
+        """
+        Read the __dict_save files of dirpath_list in parallel and add them in the order of dirpath_list
+        """
+        if not dirpath_list:
+            return
+        pool = ThreadPool(max(1, min(self.nb_cores, len(dirpath_list))))
+        try:
+            for dirpath, dict_save in pool.imap(lambda d: read_dict_save(d, self.check_integrity), dirpath_list,
+                                                chunksize=16):
+                self.add(dirpath, dict_save)
+        finally:
+            pool.close()
+            pool.join()
+
+    def resolve_duplicates(self):
+        logging.info('Removing the duplicates of {} folders'.format(len(self._duplicate_dict)))
+        catalog = None
+        if self.catalog_path is not None and self._duplicate_dict:
+            catalog = metadata_catalog.MetadataCatalog(self.catalog_path)
+        try:
+            for dirpath in self._duplicate_dict:
+                dict_save, duplicate_key_list = self._duplicate_dict[dirpath]
+                handle_duplicate_list(dict_save, duplicate_key_list, conflict_opt=self.conflict_opt)
+                if catalog is not None:
+                    catalog.remove_series(dirpath, duplicate_key_list)
+        finally:
+            if catalog is not None:
+                catalog.close()
+        self._duplicate_dict = {}
+
+    def finalize(self):
+        """
+        Add the __dict_save files that were not added yet, remove the duplicates and the empty folders.
+
+        Returns
+        -------
+        final_dict, error_list : dict, list
+            see create_final_dict
+        """
+        if not os.path.exists(self.output_folder):
+            raise ValueError('[{}] does not exist'.format(self.output_folder))
+        self.add_folder_list(self.list_remaining_folders())
+        self.resolve_duplicates()
+        logging.info('Removing empty folders from [{}]'.format(self.output_folder))
+        remove_empty_folders(self.output_folder)
+        return self.final_dict, self.error_list
+
+
+def create_final_dict(output_folder, conflict_opt='keep_first_found', check_integrity=False, nb_cores=-1):
     """
 
     Parameters
@@ -408,6 +977,8 @@ def create_final_dict(output_folder, conflict_opt='keep_first_found', check_inte
     check_integrity : bool
         (default : False) check (or not) if the folder has been converted properly and if not, adds this directory to
         the error file instead
+    nb_cores : int
+        (default : -1, the number of cpus) number of threads reading the __dict_save files
 
     Returns
     -------
@@ -426,29 +997,5 @@ def create_final_dict(output_folder, conflict_opt='keep_first_found', check_inte
     error_dict : list
         List of the directory paths that failed the check_output_integrity
     """
-    if not os.path.exists(output_folder):
-        raise ValueError('[{}] does not exist'.format(output_folder))
-    final_dict = {}
-    error_list = []
-    for dirpath, _, _ in os.walk(output_folder):
-        json_file = os.path.join(dirpath, '__dict_save')
-        if os.path.exists(json_file):
-            if check_integrity and not check_output_integrity(dirpath):
-                logging.warning('__dict_save in folder [{}] was not added to final dict because of a mismatch '
-                                'between __dict_save and the content or an error during the conversion. '
-                                'The list of failed conversions / metadata extraction can be found in '
-                                '{}/__error_directories.txt'.format(dirpath, output_folder))
-                error_list.append(dirpath)
-            else:
-                with open(json_file, 'r') as out_file:
-                    dict_save = json.load(out_file)
-                temp_dict = copy.deepcopy(dict_save)
-                for key in temp_dict:
-                    if key in final_dict:
-                        # with the default option it's not very efficient but in case we add different option ...
-                        handle_duplicate(dict_save, key, conflict_opt=conflict_opt)
-                    else:
-                        final_dict.update({key: temp_dict[key]})
-    logging.info('Removing empty folders from [{}]'.format(output_folder))
-    remove_empty_folders(output_folder)
-    return final_dict, error_list
+    return FinalDictAggregator(output_folder, conflict_opt=conflict_opt, check_integrity=check_integrity,
+                               nb_cores=nb_cores).finalize()
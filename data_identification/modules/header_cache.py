@@ -0,0 +1,178 @@
+"""
+Persistent cache of the DICOM headers read by dicom_metadata.scan_dicomdir
+
+Authors: Chris Foulon
+"""
+import os
+import json
+import sqlite3
+import logging
+import time
+
+default_cache_filename = '__header_cache.sqlite'
+# 4 GiB of serialized headers
+default_max_bytes = 4 * 1024 ** 3
+
+
+class CachedHeader(object):
+    """
+    Header read from the cache. It has the attributes of a pydicom.dataset.FileDataset used by DicomSerie in
+    incremental mode: filename, InstanceNumber, SOPInstanceUID, SeriesInstanceUID and to_json_dict().
+    """
+
+    def __init__(self, filename, json_dict):
+        self.filename = filename
+        self._json_dict = json_dict
+        instance_number = json_dict.get('00200013', {}).get('Value')
+        self.InstanceNumber = instance_number[0] if instance_number else None
+        sop_instance_uid = json_dict.get('00080018', {}).get('Value')
+        self.SOPInstanceUID = sop_instance_uid[0] if sop_instance_uid else None
+        series_instance_uid = json_dict.get('0020000E', {}).get('Value')
+        self.SeriesInstanceUID = series_instance_uid[0] if series_instance_uid else None
+
+    def to_json_dict(self):
+        return self._json_dict
+
+
+class HeaderCache(object):
+
+    def __init__(self, path, max_bytes=default_max_bytes):
+        """
+        SQLite cache mapping (file path, size, mtime_ns) to the identifier of the serie of a DICOM file and its
+        serialized header. The cache is shared by all the workers of a conversion (one connection each) and the least
+        recently used headers are evicted when the serialized headers exceed max_bytes.
+
+        Parameters
+        ----------
+        path : str
+            path to the SQLite file (created if it does not exist)
+        max_bytes : int
+            maximum total size of the serialized headers stored in the cache
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending_list = []
+        self._accessed_list = []
+        self._connection = sqlite3.connect(path, timeout=600)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA recursive_triggers=ON')
+        with self._connection:
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS headers (
+                    path TEXT NOT NULL,
+                    scan_mode TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    serie_id TEXT NOT NULL,
+                    header TEXT NOT NULL,
+                    nbytes INTEGER NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (path, scan_mode));
+                CREATE INDEX IF NOT EXISTS headers_last_access ON headers (last_access);
+                CREATE TABLE IF NOT EXISTS cache_info (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    total_bytes INTEGER NOT NULL,
+                    hits INTEGER NOT NULL,
+                    misses INTEGER NOT NULL,
+                    evictions INTEGER NOT NULL);
+                INSERT OR IGNORE INTO cache_info VALUES (0, 0, 0, 0, 0);
+                CREATE TRIGGER IF NOT EXISTS headers_insert AFTER INSERT ON headers BEGIN
+                    UPDATE cache_info SET total_bytes = total_bytes + NEW.nbytes WHERE id = 0;
+                END;
+                CREATE TRIGGER IF NOT EXISTS headers_delete AFTER DELETE ON headers BEGIN
+                    UPDATE cache_info SET total_bytes = total_bytes - OLD.nbytes WHERE id = 0;
+                END;
+            ''')
+
+    def get(self, filepath, scan_mode, stat_result=None):
+        """
+        Return (serie_id, CachedHeader) if filepath is in the cache with the same size and modification time or None.
+        """
+        if stat_result is None:
+            stat_result = os.stat(filepath)
+        row = self._connection.execute(
+            'SELECT size, mtime_ns, serie_id, header FROM headers WHERE path = ? AND scan_mode = ?',
+            (filepath, scan_mode)).fetchone()
+        if row is None or row[0] != stat_result.st_size or row[1] != stat_result.st_mtime_ns:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._accessed_list.append((time.time(), filepath, scan_mode))
+        return row[2], CachedHeader(filepath, json.loads(row[3]))
+
+    def put(self, filepath, scan_mode, serie_id, json_dict, stat_result=None):
+        """
+        Store the serie identifier and the header (as returned by pydicom.Dataset.to_json_dict) of filepath. The
+        headers are written when flush is called.
+        """
+        if stat_result is None:
+            stat_result = os.stat(filepath)
+        header = json.dumps(json_dict)
+        self._pending_list.append((filepath, scan_mode, stat_result.st_size, stat_result.st_mtime_ns, serie_id,
+                                   header, len(header), time.time()))
+
+    def flush(self):
+        """
+        Write the pending headers and access times in one transaction and evict the least recently used headers if
+        the cache is too big.
+        """
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                         self._pending_list)
+            self._connection.executemany('UPDATE headers SET last_access = ? WHERE path = ? AND scan_mode = ?',
+                                         self._accessed_list)
+            total_bytes = self._connection.execute('SELECT total_bytes FROM cache_info WHERE id = 0').fetchone()[0]
+            evicted = 0
+            if total_bytes > self.max_bytes:
+                # we free a bit more than needed to avoid evicting at every flush
+                to_free = total_bytes - int(self.max_bytes * 0.9)
+                freed = 0
+                eviction_list = []
+                for path, scan_mode, nbytes in self._connection.execute(
+                        'SELECT path, scan_mode, nbytes FROM headers ORDER BY last_access'):
+                    if freed >= to_free:
+                        break
+                    eviction_list.append((path, scan_mode))
+                    freed += nbytes
+                self._connection.executemany('DELETE FROM headers WHERE path = ? AND scan_mode = ?', eviction_list)
+                evicted = len(eviction_list)
+                logging.info('{} headers evicted from the header cache [{}]'.format(evicted, self.path))
+            self._connection.execute(
+                'UPDATE cache_info SET hits = hits + ?, misses = misses + ?, evictions = evictions + ? WHERE id = 0',
+                (self.hits, self.misses, evicted))
+        self.evictions += evicted
+        self._pending_list = []
+        self._accessed_list = []
+        # the counters of the instance are now in the database
+        self.hits = 0
+        self.misses = 0
+
+    def statistics(self):
+        """
+        Cumulated statistics of the cache since its creation (including the unflushed hits and misses).
+
+        Returns
+        -------
+        stats : dict
+            'entries', 'total_bytes', 'hits', 'misses', 'evictions' and 'hit_rate'
+        """
+        total_bytes, hits, misses, evictions = self._connection.execute(
+            'SELECT total_bytes, hits, misses, evictions FROM cache_info WHERE id = 0').fetchone()
+        hits += self.hits
+        misses += self.misses
+        entries = self._connection.execute('SELECT COUNT(*) FROM headers').fetchone()[0]
+        return {
+            'entries': entries,
+            'total_bytes': total_bytes,
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.
+        }
+
+    def close(self):
+        self.flush()
+        self._connection.close()
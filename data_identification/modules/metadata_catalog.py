@@ -0,0 +1,199 @@
+"""
+Dataset-wide SQLite catalog of the series converted by dicom_to_nifti.convert_dataset, with one row per serie and
+indexed columns for the common acquisition fields
+
+Authors: Chris Foulon
+"""
+import os
+import json
+import sqlite3
+import time
+
+default_catalog_filename = '__metadata_catalog.sqlite'
+
+# column: (tag of the field in the DICOM json dictionaries, SQLite type)
+catalog_field_dict = {
+    'PatientID': ('00100020', 'TEXT'),
+    'StudyInstanceUID': ('0020000D', 'TEXT'),
+    'SeriesInstanceUID': ('0020000E', 'TEXT'),
+    'StudyDate': ('00080020', 'TEXT'),
+    'SeriesNumber': ('00200011', 'INTEGER'),
+    'Modality': ('00080060', 'TEXT'),
+    'Manufacturer': ('00080070', 'TEXT'),
+    'ManufacturerModelName': ('00081090', 'TEXT'),
+    'MagneticFieldStrength': ('00180087', 'REAL'),
+    'SeriesDescription': ('0008103E', 'TEXT'),
+    'ProtocolName': ('00181030', 'TEXT'),
+    'SequenceName': ('00180024', 'TEXT'),
+    'ImageType': ('00080008', 'TEXT'),
+    'EchoTime': ('00180081', 'REAL'),
+    'RepetitionTime': ('00180080', 'REAL'),
+    'InversionTime': ('00180082', 'REAL'),
+    'FlipAngle': ('00181314', 'REAL'),
+    'SliceThickness': ('00180050', 'REAL'),
+    'SpacingBetweenSlices': ('00180088', 'REAL'),
+    'Rows': ('00280010', 'INTEGER'),
+    'Columns': ('00280011', 'INTEGER'),
+}
+# columns of the outputs of the serie (see extra_utils.populate_output_dict)
+output_column_list = ['input_folder', 'input_zip', 'output_path', 'json', 'bval', 'bvec', 'metadata']
+
+
+def get_element_value(metadata_json_dict, tag):
+    """
+    Value of a field in a merged metadata dictionary (see dicom_metadata.DicomSerie.generate_metadata). The value of
+    the first file is used for the fields that vary within the serie, the multi-valued fields are joined with '\\'
+    like in the DICOM files.
+
+    Returns
+    -------
+    value : str, int, float or None
+        None if the field is absent or empty
+    """
+    element = metadata_json_dict.get(tag)
+    if isinstance(element, list):
+        element = next((e for e in element if e is not None), None)
+    if not isinstance(element, dict) or not element.get('Value'):
+        return None
+    value_list = element['Value']
+    # PN values are stored as {'Alphabetic': name}
+    value_list = [v.get('Alphabetic') if isinstance(v, dict) else v for v in value_list]
+    if len(value_list) == 1:
+        return value_list[0]
+    return '\\'.join([str(v) for v in value_list])
+
+
+def get_file_count(metadata_json_dict):
+    """
+    Number of files of a serie, from the length of its varying fields (1 if no field varies)
+    """
+    return max([len(v) for v in metadata_json_dict.values() if isinstance(v, list)] + [1])
+
+
+class MetadataCatalog(object):
+
+    def __init__(self, path):
+        """
+        SQLite catalog with one row per converted serie: its output sub-directory, output prefix and files, its number
+        of DICOM files and one indexed column per field of catalog_field_dict. The catalog is shared by all the
+        workers of a conversion (one connection each) and the rows of a sub-directory are replaced in a single
+        transaction when it is converted.
+
+        Parameters
+        ----------
+        path : str
+            path to the SQLite file (created if it does not exist)
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        column_list = ['output_subdirectory TEXT NOT NULL', 'prefix TEXT NOT NULL'] + \
+                      ['{} TEXT'.format(c) for c in output_column_list] + \
+                      ['file_count INTEGER'] + \
+                      ['{} {}'.format(c, catalog_field_dict[c][1]) for c in catalog_field_dict] + \
+                      ['outputs TEXT', 'updated REAL', 'PRIMARY KEY (output_subdirectory, prefix)']
+        script = 'CREATE TABLE IF NOT EXISTS series ({});\n'.format(', '.join(column_list))
+        for c in catalog_field_dict:
+            script += 'CREATE INDEX IF NOT EXISTS series_{0} ON series ({0});\n'.format(c)
+        self._connection.executescript(script)
+
+    def add_series(self, output_subdirectory, output_dict, metadata_dict):
+        """
+        Replace the rows of an output sub-directory with its converted series.
+
+        Parameters
+        ----------
+        output_subdirectory : str
+            the output sub-directory of the series (stored normalized with os.path.normpath)
+        output_dict : dict
+            the content of the __dict_save file of the sub-directory (see dicom_to_nifti.complete_dicom_folder)
+        metadata_dict : dict
+            output prefix: merged metadata dictionary of the serie of the output (see
+            dicom_to_nifti.get_output_series), the outputs missing from it have no metadata
+
+        Returns
+        -------
+        row_count : int
+            number of rows written
+        """
+        output_subdirectory = os.path.normpath(output_subdirectory)
+        row_list = []
+        for pref in output_dict:
+            metadata_json_dict = metadata_dict.get(pref, {})
+            row = [output_subdirectory, pref] + [output_dict[pref].get(c) for c in output_column_list] + \
+                  [get_file_count(metadata_json_dict) if metadata_json_dict else None] + \
+                  [get_element_value(metadata_json_dict, catalog_field_dict[c][0]) for c in catalog_field_dict] + \
+                  [json.dumps(output_dict[pref]), time.time()]
+            row_list.append(row)
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            self._connection.execute('DELETE FROM series WHERE output_subdirectory = ?', (output_subdirectory,))
+            if row_list:
+                self._connection.executemany('INSERT OR REPLACE INTO series VALUES ({})'.format(
+                    ','.join('?' * len(row_list[0]))), row_list)
+            self._connection.execute('COMMIT')
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        return len(row_list)
+
+    def remove_series(self, output_subdirectory, prefix_list):
+        """
+        Delete the rows of some series of an output sub-directory (e.g. the duplicates removed by
+        extra_utils.FinalDictAggregator).
+
+        Returns
+        -------
+        row_count : int
+            number of rows deleted
+        """
+        output_subdirectory = os.path.normpath(output_subdirectory)
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            row_count = 0
+            for pref in prefix_list:
+                row_count += self._connection.execute(
+                    'DELETE FROM series WHERE output_subdirectory = ? AND prefix = ?',
+                    (output_subdirectory, pref)).rowcount
+            self._connection.execute('COMMIT')
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        return row_count
+
+    def select(self, where='', parameters=()):
+        """
+        Select the series matching an SQL condition on the columns of the catalog.
+
+        Parameters
+        ----------
+        where : str
+            SQL condition (e.g. 'EchoTime < ? AND Manufacturer = ?'), empty to select every serie
+        parameters : tuple
+            values of the placeholders of the condition
+
+        Returns
+        -------
+        row_list : list of dict
+            the rows of the series with the column names as keys ('outputs' is decoded)
+        """
+        query = 'SELECT * FROM series'
+        if where:
+            query += ' WHERE ' + where
+        cursor = self._connection.execute(query + ' ORDER BY output_subdirectory, prefix', parameters)
+        column_list = [d[0] for d in cursor.description]
+        row_list = []
+        for row in cursor:
+            row_dict = dict(zip(column_list, row))
+            row_dict['outputs'] = json.loads(row_dict['outputs']) if row_dict['outputs'] else None
+            row_list.append(row_dict)
+        return row_list
+
+    def close(self):
+        self._connection.close()
+
+
+def reset_catalog(path):
+    for p in [path, path + '-wal', path + '-shm']:
+        if os.path.exists(p):
+            os.remove(p)
@@ -0,0 +1,295 @@
+"""
+Persistent inverted index of the metadata of the series of a conversion output folder, used to filter the converted
+files on their header fields without reading the _dicom_metadata.json files at each query
+
+Authors: Chris Foulon
+"""
+import os
+import json
+import re
+import sqlite3
+import logging
+
+from pydicom import datadict
+
+from data_identification.modules import dicom_metadata
+
+default_index_filename = '__metadata_index.sqlite'
+# the values longer than that are not indexed (e.g. CSA headers stored as text)
+max_value_length = 256
+# value representations that are not indexed
+ignored_vr_list = ['SQ', 'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN']
+# the fields varying within a serie with more distinct values than that are not indexed (e.g. SOPInstanceUID or
+# ImagePositionPatient, which have one value per file)
+max_varying_values = 8
+# operators of the predicates (see parse_predicate), the longest first
+operator_list = ['<=', '>=', '!=', '=', '<', '>', '~']
+
+
+def field_name(tag):
+    """
+    DICOM keyword of a tag of the json dictionaries (e.g. '00180081' -> 'EchoTime'), the tag itself if it has no
+    keyword (e.g. private tags)
+    """
+    try:
+        keyword = datadict.keyword_for_tag(int(tag, 16))
+    except ValueError:
+        keyword = ''
+    return keyword if keyword else tag.upper()
+
+
+def list_element_values(element):
+    """
+    Returns
+    -------
+    value_list : list
+        the values of a DICOM json element, an empty list if the element is not indexed
+    """
+    if not isinstance(element, dict) or element.get('vr') in ignored_vr_list or not element.get('Value'):
+        return []
+    value_list = []
+    for value in element['Value']:
+        if isinstance(value, dict):
+            # PN values
+            value = value.get('Alphabetic')
+        if value is None or isinstance(value, (dict, list)):
+            continue
+        if isinstance(value, str) and len(value) > max_value_length:
+            continue
+        value_list.append(value)
+    return value_list
+
+
+def list_metadata_values(metadata_json_dict):
+    """
+    Returns
+    -------
+    value_set : set of tuple
+        the distinct (field, value) pairs of a merged metadata dictionary (see dicom_metadata.load_metadata_json), the
+        fields varying within the serie have the values of their files, unless they have more than
+        max_varying_values distinct values so the size of the index does not grow with the number of files
+    """
+    value_set = set()
+    for tag, element in metadata_json_dict.items():
+        element_list = element if isinstance(element, list) else [element]
+        field_value_set = set([value for e in element_list for value in list_element_values(e)])
+        if len(element_list) > 1 and len(field_value_set) > max_varying_values:
+            continue
+        name = field_name(tag)
+        value_set.update([(name, value) for value in field_value_set])
+    return value_set
+
+
+def to_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_predicate(predicate):
+    """
+    Parse a predicate on a header field like 'EchoTime<10', 'Manufacturer=SIEMENS' or 'SeriesDescription~T1' ('~'
+    matches the values containing the text, case insensitive, '%' and '_' being ordinary characters).
+
+    Returns
+    -------
+    (field, operator, value) : tuple of str
+
+    Raises
+    ------
+    ValueError
+        if the predicate does not contain any operator of operator_list
+    """
+    match = re.match(r'^\s*([^<>=!~\s]+)\s*({})\s*(.*?)\s*$'.format('|'.join([re.escape(o) for o in operator_list])),
+                     predicate)
+    if match is None:
+        raise ValueError('[{}] is not a predicate (field, operator among {} and value)'.format(
+            predicate, operator_list))
+    field, operator, value = match.groups()
+    if re.match(r'^[0-9a-fA-F]{8}$', field):
+        field = field_name(field)
+    return field, operator, value
+
+
+class MetadataIndex(object):
+
+    def __init__(self, path):
+        """
+        SQLite inverted index of the metadata of the series of a conversion output folder. Each (field, value) pair of
+        the _dicom_metadata.json of a serie is a row of the 'field_values' table, indexed on (field, value) and on
+        (field, number) for the numeric values. The __dict_save files indexed are recorded with their size and
+        modification time so update only reads the metadata of the sub-directories converted since the last update.
+
+        Parameters
+        ----------
+        path : str
+            path to the SQLite file (created if it does not exist)
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS sources (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS series (
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL,
+                prefix TEXT NOT NULL,
+                output_path TEXT,
+                metadata TEXT,
+                UNIQUE (source, prefix));
+            CREATE TABLE IF NOT EXISTS field_values (
+                field TEXT NOT NULL,
+                value TEXT,
+                number REAL,
+                series_id INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS field_values_value ON field_values (field, value);
+            CREATE INDEX IF NOT EXISTS field_values_number ON field_values (field, number);
+            CREATE INDEX IF NOT EXISTS field_values_series ON field_values (series_id);
+            CREATE INDEX IF NOT EXISTS series_source ON series (source);
+        ''')
+
+    def _remove_source(self, source):
+        self._connection.execute('DELETE FROM field_values WHERE series_id IN (SELECT id FROM series WHERE source = ?)',
+                                 (source,))
+        self._connection.execute('DELETE FROM series WHERE source = ?', (source,))
+        self._connection.execute('DELETE FROM sources WHERE path = ?', (source,))
+
+    def _add_source(self, source, stat_result):
+        try:
+            with open(source, 'r') as dict_save_file:
+                dict_save = json.load(dict_save_file)
+        except (OSError, ValueError) as e:
+            logging.warning('[{}] cannot be indexed [JSON error: {}]'.format(source, e))
+            return 0
+        metadata_cache = {}
+        for pref in dict_save:
+            entry = dict_save[pref]
+            metadata_path = entry.get('metadata')
+            cursor = self._connection.execute(
+                'INSERT INTO series (source, prefix, output_path, metadata) VALUES (?, ?, ?, ?)',
+                (source, pref, entry.get('output_path'), metadata_path))
+            if metadata_path is None or not os.path.isfile(metadata_path):
+                continue
+            # several outputs of dcm2niix can share the metadata of their serie
+            if metadata_path not in metadata_cache:
+                try:
+                    metadata_cache[metadata_path] = list_metadata_values(
+                        dicom_metadata.load_metadata_json(metadata_path))
+                except (OSError, ValueError) as e:
+                    logging.warning('[{}] cannot be indexed [JSON error: {}]'.format(metadata_path, e))
+                    metadata_cache[metadata_path] = []
+            self._connection.executemany(
+                'INSERT INTO field_values VALUES (?, ?, ?, ?)',
+                [(field, str(value), to_number(value), cursor.lastrowid)
+                 for field, value in metadata_cache[metadata_path]])
+        self._connection.execute('INSERT INTO sources VALUES (?, ?, ?)',
+                                 (source, stat_result.st_size, stat_result.st_mtime_ns))
+        return len(dict_save)
+
+    def update(self, output_folder, commit_every=1000):
+        """
+        Index the __dict_save files of output_folder that are new or changed since the last update and remove the
+        ones that do not exist anymore. Only the stat of the __dict_save files is needed for the sub-directories that
+        did not change.
+
+        Parameters
+        ----------
+        output_folder : str
+            the output folder of a conversion (see dicom_to_nifti.convert_dataset)
+        commit_every : int
+            number of __dict_save files indexed per transaction
+
+        Returns
+        -------
+        stats : dict
+            number of 'added', 'updated', 'removed' and 'unchanged' __dict_save files
+        """
+        known_dict = {path: (size, mtime_ns) for path, size, mtime_ns in
+                      self._connection.execute('SELECT path, size, mtime_ns FROM sources')}
+        stats = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+        pending = 0
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            for dirpath, _, filenames in os.walk(output_folder):
+                if '__dict_save' not in filenames:
+                    continue
+                source = os.path.join(dirpath, '__dict_save')
+                stat_result = os.stat(source)
+                known = known_dict.pop(source, None)
+                if known == (stat_result.st_size, stat_result.st_mtime_ns):
+                    stats['unchanged'] += 1
+                    continue
+                if known is not None:
+                    self._remove_source(source)
+                    stats['updated'] += 1
+                else:
+                    stats['added'] += 1
+                self._add_source(source, stat_result)
+                pending += 1
+                if pending >= commit_every:
+                    self._connection.execute('COMMIT')
+                    self._connection.execute('BEGIN IMMEDIATE')
+                    pending = 0
+            for source in known_dict:
+                self._remove_source(source)
+                stats['removed'] += 1
+            self._connection.execute('COMMIT')
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        return stats
+
+    def query(self, predicate_list):
+        """
+        Select the series matching all the predicates. A serie matches a predicate if one of the values of the field
+        in its files matches it, except for '!=' which selects the series without this value (including the series
+        without the field). The comparisons are numeric if the value of the predicate is a number. The fields with
+        too many values in a serie (see list_metadata_values) cannot be queried.
+
+        Parameters
+        ----------
+        predicate_list : list of tuple or str
+            (field, operator, value) or predicates parsed with parse_predicate
+
+        Returns
+        -------
+        series_list : list of dict
+            'source' (the __dict_save file), 'prefix', 'output_path' and 'metadata' of the matching series
+        """
+        condition_list = []
+        parameter_list = []
+        for predicate in predicate_list:
+            if isinstance(predicate, str):
+                predicate = parse_predicate(predicate)
+            field, operator, value = predicate
+            number = to_number(value)
+            column = 'value' if number is None else 'number'
+            if operator == '~':
+                # the wildcards of LIKE in the text are matched literally
+                condition_list.append("SELECT series_id FROM field_values WHERE field = ? AND value LIKE ? ESCAPE '\\'")
+                parameter_list += [field, '%{}%'.format(re.sub(r'([\\%_])', r'\\\1', value))]
+            elif operator == '!=':
+                condition_list.append('SELECT id FROM series EXCEPT SELECT series_id FROM field_values '
+                                      'WHERE field = ? AND {} = ?'.format(column))
+                parameter_list += [field, value if number is None else number]
+            else:
+                condition_list.append('SELECT series_id FROM field_values WHERE field = ? AND {} {} ?'.format(
+                    column, operator))
+                parameter_list += [field, value if number is None else number]
+        query = 'SELECT source, prefix, output_path, metadata FROM series'
+        if condition_list:
+            query += ' WHERE id IN ({})'.format(' INTERSECT '.join(condition_list))
+        keys = ['source', 'prefix', 'output_path', 'metadata']
+        return [dict(zip(keys, row)) for row in self._connection.execute(query + ' ORDER BY source, prefix',
+                                                                           parameter_list)]
+
+    def close(self):
+        self._connection.close()
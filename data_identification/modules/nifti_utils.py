@@ -1,11 +1,26 @@
 import os
+import gzip
+import json
+import time
 import numpy as np
 from shutil import copyfile
 from copy import deepcopy
 import logging
+import multiprocessing
+import collections
+from multiprocessing.dummy import Pool as ThreadPool
 
 import nibabel as nib
-from nilearn.image import iter_img
+from nilearn.image import new_img_like
+
+from data_identification.modules import extra_utils, run_journal
+
+# extension of the split outputs for each compression: 'gzip' (zlib on one thread), 'parallel' (blocks compressed on
+# several threads, see extra_utils.write_parallel_gzip) or 'none' (uncompressed, for scratch outputs)
+output_extension_dict = {'gzip': '.nii.gz', 'parallel': '.nii.gz', 'none': '.nii'}
+default_split_journal_filename = '__split_journal.jsonl'
+# separator between the path of a 4D image and the index of a volume in the handles of the virtual splits
+volume_handle_separator = '#vol'
 
 
 def has_bval(path):
@@ -17,18 +32,109 @@ def has_bval(path):
     return os.path.exists(bval_path)
 
 
-def split_4d_and_label(img_path, label_list, output_folder):
+def load_streamable(img_path):
+    """
+    Load an image so its volumes can be read one by one from img.dataobj: the file is kept open, so the volumes of a
+    .nii.gz are read from the same decompression stream instead of decompressing the file from its beginning for each
+    volume (the volumes of an uncompressed .nii are read directly at their offset in the file).
+    """
+    return nib.load(img_path, keep_file_open=True)
+
+
+def iter_volumes(img):
+    """
+    Yield the 3D volumes of a 4D image (see load_streamable) in order. Each volume is only read from the file when it
+    is requested, so unlike nilearn.image.iter_img the 4D array is never loaded and only one volume is in memory at a
+    time if it is saved before the next one is requested.
+    """
+    for ind in range(img.shape[3]):
+        yield new_img_like(img, np.asanyarray(img.dataobj[..., ind]), img.affine)
+
+
+def save_nifti(img, out_file_path, compression='gzip', compress_level=1, pool=None):
+    """
+    Save a nifti image with the given compression.
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image
+    out_file_path : str
+        output path, with the extension of the compression in output_extension_dict
+    compression : str ['gzip', 'parallel', 'none']
+        see output_extension_dict
+    compress_level : int
+        zlib compression level (1 to 9), 1 by default like nib.save
+    pool : multiprocessing.pool.ThreadPool
+        pool of threads compressing the file with the 'parallel' compression (see extra_utils.write_parallel_gzip)
+    """
+    if compression not in output_extension_dict:
+        raise ValueError('Unknown compression [{}], it must be in {}'.format(compression, list(output_extension_dict)))
+    if compression == 'none':
+        nib.save(img, out_file_path)
+    elif compression == 'parallel':
+        extra_utils.write_parallel_gzip(out_file_path, img.to_bytes(), compress_level=compress_level, pool=pool)
+    else:
+        with gzip.open(out_file_path, 'wb', compresslevel=compress_level) as out_file:
+            out_file.write(img.to_bytes())
+
+
+def save_volumes(img, out_file_path_list, compression='gzip', compress_level=1, nb_threads=-1):
+    """
+    Save each volume of a 4D image in the corresponding path of out_file_path_list before reading the next volume
+    (see save_nifti for the compression options, nb_threads is the number of threads of the 'parallel' compression).
+    """
+    if len(out_file_path_list) != img.shape[3]:
+        raise ValueError('4th dimension of the image must be the same as the number of output paths')
+    pool = None
+    if compression == 'parallel':
+        pool = ThreadPool(multiprocessing.cpu_count() if nb_threads == -1 else nb_threads)
+    try:
+        for vol, out_file_path in zip(iter_volumes(img), out_file_path_list):
+            save_nifti(vol, out_file_path, compression=compression, compress_level=compress_level, pool=pool)
+            logging.info('New file saved: {}'.format(out_file_path))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def volume_handle(img_path, ind):
+    """
+    Handle of the volume ind of a 4D image in the virtual splits (e.g. 'dwi.nii#vol3'), to load with VolumeLoader
+    """
+    return '{}{}{}'.format(img_path, volume_handle_separator, ind)
+
+
+def parse_volume_handle(handle):
+    """
+    Returns
+    -------
+    (img_path, ind) : tuple
+        the path of the image and the index of the volume, None for the handles of 3D images (their path)
+    """
+    img_path, separator, ind = handle.rpartition(volume_handle_separator)
+    if separator == '' or not ind.isdigit():
+        return handle, None
+    return img_path, int(ind)
+
+
+def split_4d_and_label(img_path, label_list, output_folder, compression='gzip', compress_level=1, nb_threads=-1,
+                       virtual=False):
+    """
+    Split a 4D image into one file per volume, named with the label of the volume. With virtual=True, nothing is
+    written and the volumes are referenced by their handle (see volume_handle and VolumeLoader) in the returned
+    dictionary.
+    """
     logging.debug('splitting [{}] into {} if necessary'.format(img_path, output_folder))
     print(str(label_list))
     copy_label_list = deepcopy(label_list)
     if not os.path.isdir(output_folder):
         raise ValueError(str(output_folder) + ' does not exist or is not a directory')
-    hdr = nib.load(img_path)
+    hdr = load_streamable(img_path)
 
     paths_labels_dict = {}
     if len(hdr.shape) == 4:
         logging.debug('4d image found, splitting in into 3d images.')
-        imgs = [img for img in iter_img(hdr)]
     else:
         logging.debug('only 1 dimension in the nifti, we just return the file path')
         if isinstance(label_list, list):
@@ -40,7 +146,7 @@ def split_4d_and_label(img_path, label_list, output_folder):
             paths_labels_dict[img_path] = label_list
 
         return paths_labels_dict
-    if len(imgs) != len(label_list):
+    if hdr.shape[3] != len(label_list):
         raise ValueError('4th dimension of the images must be the same as the number of labels')
     # Ensure the labels will be strings and replace the float dots by 'dot' to avoid messing up the filenames
     copy_label_list = [str(c).replace('.', 'dot') for c in copy_label_list]
@@ -53,18 +159,25 @@ def split_4d_and_label(img_path, label_list, output_folder):
         if n >= 0:
             copy_label_list[i] = '{}_{}'.format(str(e), str(n))
             unique_dict[e] -= 1
+    if virtual:
+        for ind in range(hdr.shape[3]):
+            paths_labels_dict[volume_handle(img_path, ind)] = copy_label_list[ind]
+        return paths_labels_dict
     input_name = os.path.basename(img_path).split('.')[0]
-    for ind in range(len(imgs)):
+    out_file_path_list = []
+    for ind in range(hdr.shape[3]):
         out_file_path = os.path.join(output_folder,
-                                     '{}_label{}_vol{}.nii.gz'.format(str(input_name), str(copy_label_list[ind]), ind))
-
-        nib.save(imgs[ind], out_file_path)
-        logging.info('New file saved: {}'.format(out_file_path))
+                                     '{}_label{}_vol{}{}'.format(str(input_name), str(copy_label_list[ind]), ind,
+                                                                 output_extension_dict[compression]))
+        out_file_path_list.append(out_file_path)
         paths_labels_dict[out_file_path] = copy_label_list[ind]
+    save_volumes(hdr, out_file_path_list, compression=compression, compress_level=compress_level,
+                 nb_threads=nb_threads)
     return paths_labels_dict
 
 
-def split_dwi4d_and_label(img_path, output_folder):
+def split_dwi4d_and_label(img_path, output_folder, compression='gzip', compress_level=1, nb_threads=-1,
+                          virtual=False):
     logging.info('DWI splitting [{}] into {} is necessary'.format(img_path, output_folder))
     input_name = os.path.basename(img_path).split('.')[0]
     input_folder = os.path.dirname(img_path)
@@ -74,40 +187,282 @@ def split_dwi4d_and_label(img_path, output_folder):
         print(img_path + ' has neither been split nor added to the label dictionary')
         return {}
     bvalues = np.loadtxt(bval_path)
-    return split_4d_and_label(img_path, bvalues, output_folder)
+    return split_4d_and_label(img_path, bvalues, output_folder, compression=compression,
+                              compress_level=compress_level, nb_threads=nb_threads, virtual=virtual)
 
 
-def split_unlabelled(img_path, output_folder):
+def split_unlabelled(img_path, output_folder, compression='gzip', compress_level=1, nb_threads=-1, virtual=False):
     if not os.path.exists(img_path):
         raise ValueError(str(img_path) + ' does not exist)')
     if not os.path.isdir(output_folder):
         raise ValueError(str(output_folder) + ' does not exist or is not a directory')
-    hdr = nib.load(img_path)
+    hdr = load_streamable(img_path)
     input_name = os.path.basename(img_path).split('.')[0]
+    extension = output_extension_dict[compression]
     paths_labels_dict = {}
+    if virtual:
+        # the 3D images are referenced by their path
+        for ind in range(hdr.shape[3] if len(hdr.shape) == 4 else 0):
+            paths_labels_dict[volume_handle(img_path, ind)] = 'unlabelled'
+        return paths_labels_dict if paths_labels_dict else {img_path: 'unlabelled'}
     if len(hdr.shape) == 4:
-        imgs = [img for img in iter_img(hdr)]
-        for ind in range(len(imgs)):
-            out_file_path = os.path.join(output_folder, '{}_unlabelled_{}.nii.gz'.format(str(input_name), str(ind)))
-            nib.save(imgs[ind], out_file_path)
+        for ind in range(hdr.shape[3]):
+            out_file_path = os.path.join(output_folder, '{}_unlabelled_{}{}'.format(str(input_name), str(ind),
+                                                                                    extension))
             paths_labels_dict[out_file_path] = 'unlabelled'
+        save_volumes(hdr, list(paths_labels_dict), compression=compression, compress_level=compress_level,
+                     nb_threads=nb_threads)
     else:
         paths_labels_dict[img_path] = 'unlabelled'
-        copyfile(img_path, os.path.join(output_folder, '{}_unlabelled.nii.gz'.format(str(input_name))))
+        out_file_path = os.path.join(output_folder, '{}_unlabelled{}'.format(str(input_name), extension))
+        if img_path.endswith(extension):
+            copyfile(img_path, out_file_path)
+        else:
+            # the file is not compressed like the outputs
+            save_nifti(hdr, out_file_path, compression=compression, compress_level=compress_level)
 
     return paths_labels_dict
 
 
 #%%
-def split_unlabelled_dataset(path_list, output_folder):
+def split_unlabelled_dataset(path_list, output_folder, compression='gzip', compress_level=1, nb_threads=-1,
+                             virtual=False):
     paths_labels_dict = {}
     for f in path_list:
-        paths_labels_dict.update(split_unlabelled(img_path=f, output_folder=output_folder))
+        paths_labels_dict.update(split_unlabelled(img_path=f, output_folder=output_folder, compression=compression,
+                                                  compress_level=compress_level, nb_threads=nb_threads,
+                                                  virtual=virtual))
     return paths_labels_dict
 
 
-def split_dwi4d_dataset(path_list, output_folder):
+def split_dwi4d_dataset(path_list, output_folder, compression='gzip', compress_level=1, nb_threads=-1,
+                        virtual=False):
     paths_labels_dict = {}
     for f in path_list:
-        paths_labels_dict.update(split_dwi4d_and_label(img_path=f, output_folder=output_folder))
+        paths_labels_dict.update(split_dwi4d_and_label(img_path=f, output_folder=output_folder,
+                                                       compression=compression, compress_level=compress_level,
+                                                       nb_threads=nb_threads, virtual=virtual))
     return paths_labels_dict
+
+
+split_function_dict = {'dwi': split_dwi4d_and_label, 'unlabelled': split_unlabelled}
+
+
+def get_split_fingerprint(img_path, split_type, output_folder, split_options):
+    """
+    Fingerprint of the split of an image: its size and modification time (and the ones of its .bval file), the type
+    of split, the output folder and the split options, so the images modified since they were split or split
+    differently are split again.
+    """
+    stat_list = []
+    for path in [img_path, os.path.join(os.path.dirname(img_path), os.path.basename(img_path).split('.')[0] + '.bval')]:
+        if os.path.exists(path):
+            stat_result = os.stat(path)
+            stat_list.append([stat_result.st_size, stat_result.st_mtime_ns])
+    return json.dumps([stat_list, split_type, os.path.abspath(output_folder), split_options], sort_keys=True)
+
+
+def run_split_task(task):
+    """
+    Split one image of split_dataset (module-level so it can run in a process pool). The exceptions are returned
+    instead of being raised so one image cannot stop the split of the dataset.
+
+    Returns
+    -------
+    (task, paths_labels_dict, error) : tuple
+        paths_labels_dict is None and error is a description of the exception if the split failed
+    """
+    try:
+        paths_labels_dict = split_function_dict[task['split_type']](task['img_path'], task['output_folder'],
+                                                                    **task['split_options'])
+    except Exception as e:
+        logging.error('[{}] could not be split [{}: {}]'.format(task['img_path'], type(e).__name__, e))
+        return task, None, '{}: {}'.format(type(e).__name__, e)
+    # the labels of the 3D images can be numpy values
+    return task, {p: (l.tolist() if hasattr(l, 'tolist') else l) for p, l in paths_labels_dict.items()}, None
+
+
+def split_dataset(path_list, output_folder, split_type='dwi', nb_cores=-1, parallel_mode='process',
+                  journal_path=None, resume=True, compression='gzip', compress_level=1, nb_threads=1,
+                  progress_every=100, virtual=False):
+    """
+    Split the images of a dataset in parallel (see split_dwi4d_and_label and split_unlabelled). The images are given
+    one by one to the workers of extra_utils.imap_tasks, so at most nb_cores images are split at the same time and
+    each worker only holds one volume in memory (see save_volumes). The outputs of each image are appended to a journal
+    (see run_journal.RunJournal) as soon as the image is split, so the split can be resumed after an interruption, and
+    the images that fail are recorded without stopping the others.
+
+    Parameters
+    ----------
+    path_list : list of str
+        paths to the images
+    output_folder : str
+        existing folder where the volumes are written
+    split_type : str ['dwi', 'unlabelled']
+        'dwi' labels the volumes with the b-values of the .bval file of each image (split_dwi4d_and_label)
+    nb_cores : int
+        number of images split at the same time (-1 means the number of cores)
+    parallel_mode : str ['process', 'thread']
+        see extra_utils.imap_tasks
+    journal_path : str
+        path to the journal (default: output_folder/__split_journal.jsonl), one json record per line with the
+        'outputs' (path: label) of each image or its 'error'
+    resume : bool
+        True (default) means that the images already split with the same fingerprint (see get_split_fingerprint)
+        according to the journal are not split again, False resets the journal
+    compression : str
+        see save_nifti
+    compress_level : int
+        see save_nifti
+    nb_threads : int
+        number of threads compressing each image with the 'parallel' compression
+    progress_every : int
+        number of images between two progress messages
+    virtual : bool
+        True means that the volumes are not written, the journal and the returned dictionary reference them by their
+        handle instead (see VolumeLoader)
+
+    Returns
+    -------
+    paths_labels_dict : dict
+        path: label of the volumes of all the images split
+    failed_dict : dict
+        path: error of the images that could not be split
+    """
+    if split_type not in split_function_dict:
+        raise ValueError('Unknown split type [{}], it must be in {}'.format(split_type, list(split_function_dict)))
+    if not os.path.isdir(output_folder):
+        raise ValueError(str(output_folder) + ' does not exist or is not a directory')
+    if nb_cores == -1:
+        nb_cores = multiprocessing.cpu_count()
+    if journal_path is None:
+        journal_path = os.path.join(output_folder, default_split_journal_filename)
+    journal = run_journal.RunJournal(journal_path)
+    if resume:
+        journal.load()
+    else:
+        journal.reset()
+    split_options = {'compression': compression, 'compress_level': compress_level, 'nb_threads': nb_threads,
+                     'virtual': virtual}
+    paths_labels_dict = {}
+    failed_dict = {}
+    task_list = []
+    for img_path in path_list:
+        if not os.path.exists(img_path):
+            failed_dict[img_path] = 'does not exist'
+            continue
+        fingerprint = get_split_fingerprint(img_path, split_type, output_folder, split_options)
+        if journal.is_done(img_path, fingerprint):
+            paths_labels_dict.update(journal.get_outputs(img_path))
+            continue
+        task_list.append({'split_type': split_type, 'img_path': img_path, 'output_folder': output_folder,
+                          'split_options': split_options, 'fingerprint': fingerprint})
+    logging.info('{} images to split ({} already split, {} missing)'.format(
+        len(task_list), len(path_list) - len(task_list) - len(failed_dict), len(failed_dict)))
+
+    start_time = time.time()
+    split_count = 0
+    volume_count = 0
+    for task, task_dict, error in extra_utils.imap_tasks(task_list, run_split_task, nb_cores,
+                                                         parallel_mode=parallel_mode):
+        split_count += 1
+        if error is not None:
+            failed_dict[task['img_path']] = error
+            journal.record_failed(task['img_path'], task['fingerprint'], error=error)
+        else:
+            paths_labels_dict.update(task_dict)
+            volume_count += len(task_dict)
+            journal.record_done(task['img_path'], task['fingerprint'], outputs=task_dict)
+        if split_count % progress_every == 0 or split_count == len(task_list):
+            elapsed = time.time() - start_time
+            logging.info('{}/{} images split in {:.0f}s ({:.2f} images/s, {:.1f} volumes/s, {} errors)'.format(
+                split_count, len(task_list), elapsed, split_count / max(elapsed, 1e-6),
+                volume_count / max(elapsed, 1e-6), len(failed_dict)))
+    return paths_labels_dict, failed_dict
+
+
+class VolumeLoader(object):
+
+    def __init__(self, max_cache_bytes=2 * 1024 ** 3):
+        """
+        Load the volumes referenced by the handles of the virtual splits (see volume_handle) without split files. The
+        volumes of an uncompressed, unscaled .nii are views of a read-only memory map of the file. The other images
+        (.nii.gz or scaled data) are decompressed once and kept in a least recently used cache, so the volumes of the
+        same image are then views of the cached array. The images bigger than the cache are read volume by volume.
+
+        Parameters
+        ----------
+        max_cache_bytes : int
+            maximum size of the decompressed images kept in the cache
+        """
+        self.max_cache_bytes = max_cache_bytes
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        self._memmap_dict = {}
+
+    def _load_array(self, img_path):
+        """
+        Returns
+        -------
+        (img, data) : tuple
+            the image and its memory mapped or cached data, data is None if the image is too big for the cache
+        """
+        if img_path in self._memmap_dict:
+            return self._memmap_dict[img_path]
+        if img_path in self._cache:
+            self._cache.move_to_end(img_path)
+            return self._cache[img_path]
+        img = nib.load(img_path, mmap='r')
+        # the scaled data is not memory mapped, it is read as float
+        scaled = getattr(img.dataobj, 'slope', 1.) != 1 or getattr(img.dataobj, 'inter', 0.) != 0
+        data = None
+        if not img_path.endswith('.gz') and not scaled:
+            data = np.asanyarray(img.dataobj)
+            if isinstance(data, np.memmap):
+                self._memmap_dict[img_path] = (img, data)
+                return img, data
+        itemsize = np.dtype(np.float64).itemsize if scaled else img.get_data_dtype().itemsize
+        if int(np.prod(img.shape)) * itemsize > self.max_cache_bytes:
+            return img, None
+        if data is None:
+            data = np.asanyarray(img.dataobj)
+        # the volumes are views of the cached array
+        data.flags.writeable = False
+        while self._cache and self._cache_bytes + data.nbytes > self.max_cache_bytes:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted.nbytes
+        self._cache[img_path] = (img, data)
+        self._cache_bytes += data.nbytes
+        return img, data
+
+    def load(self, handle):
+        """
+        Returns
+        -------
+        data : numpy.ndarray
+            the volume of the handle (or the 3D image of the path), a read-only view of the memory map or of the
+            cache when possible, so it must be copied before being modified
+        """
+        img_path, ind = parse_volume_handle(handle)
+        img, data = self._load_array(img_path)
+        if ind is None:
+            return data if data is not None else np.asanyarray(img.dataobj)
+        if data is None:
+            return np.asanyarray(img.dataobj[..., ind])
+        return data[..., ind]
+
+    def load_img(self, handle):
+        """
+        Returns
+        -------
+        img : nibabel.Nifti1Image
+            the volume of the handle as an image, like the split files
+        """
+        img_path, _ = parse_volume_handle(handle)
+        img, _ = self._load_array(img_path)
+        return new_img_like(img, self.load(handle), img.affine)
+
+    def clear(self):
+        self._cache.clear()
+        self._cache_bytes = 0
+        self._memmap_dict.clear()
@@ -0,0 +1,99 @@
+"""
+Append-only journal of the sub-folder conversions of dicom_to_nifti.convert_dataset
+
+Authors: Chris Foulon
+"""
+import os
+import json
+import time
+import logging
+
+default_journal_filename = '__run_journal.jsonl'
+
+
+class RunJournal(object):
+
+    def __init__(self, path):
+        """
+        Journal stored as one json record per line. Each record has an 'event' ('start', 'done' or 'failed'), a
+        'task' identifier, the 'fingerprint' of the task input and a 'time'. The 'done' records also contain the
+        'outputs' of the task. The records are appended with a single write so the workers of a conversion can share
+        the file.
+
+        Parameters
+        ----------
+        path : str
+            path to the journal file (created when the first record is written)
+        """
+        self.path = path
+        self._done_dict = {}
+
+    def load(self):
+        """
+        Read the journal and index the last 'done' record of each task, unless the task failed afterwards. Truncated
+        lines (e.g. after a crash) are ignored.
+
+        Returns
+        -------
+        self
+        """
+        self._done_dict = {}
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path, 'r') as journal_fd:
+            for line in journal_fd:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning('Corrupted line ignored in the run journal [{}]'.format(self.path))
+                    continue
+                if record.get('event') == 'done':
+                    self._done_dict[record['task']] = record
+                elif record.get('event') == 'failed':
+                    self._done_dict.pop(record['task'], None)
+        return self
+
+    def append(self, event, task, fingerprint, **fields):
+        record = {'event': event, 'task': task, 'fingerprint': fingerprint, 'time': time.time()}
+        record.update(fields)
+        line = json.dumps(record) + '\n'
+        with open(self.path, 'a') as journal_fd:
+            journal_fd.write(line)
+        return record
+
+    def record_start(self, task, fingerprint):
+        return self.append('start', task, fingerprint)
+
+    def record_done(self, task, fingerprint, outputs=None, **fields):
+        record = self.append('done', task, fingerprint, outputs=outputs, **fields)
+        self._done_dict[task] = record
+        return record
+
+    def record_failed(self, task, fingerprint, error=None):
+        record = self.append('failed', task, fingerprint, error=error)
+        self._done_dict.pop(task, None)
+        return record
+
+    def is_done(self, task, fingerprint):
+        """
+        True if the last 'done' record of the task has the same input fingerprint (only the records read by load or
+        written by this instance are considered).
+        """
+        record = self._done_dict.get(task)
+        return record is not None and record['fingerprint'] == fingerprint
+
+    def get_done_records(self, **fields):
+        """
+        The last 'done' record of each task having the given field values (e.g. input_type='zip')
+        """
+        return [record for record in self._done_dict.values()
+                if all([record.get(k) == fields[k] for k in fields])]
+
+    def get_outputs(self, task):
+        record = self._done_dict.get(task)
+        return None if record is None else record.get('outputs')
+
+    def reset(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._done_dict = {}
@@ -0,0 +1,132 @@
+"""
+Dataset-wide index of the SOPInstanceUIDs converted by dicom_to_nifti.convert_dataset, used to skip the duplicated
+series before their conversion
+
+Authors: Chris Foulon
+"""
+import os
+import json
+import sqlite3
+
+default_index_filename = '__uid_index.sqlite'
+default_report_filename = '__skipped_duplicates.json'
+
+
+class UidIndex(object):
+
+    def __init__(self, path):
+        """
+        SQLite index mapping each SOPInstanceUID to the serie (and the folder) that claimed it first. The index is
+        shared by all the workers of a conversion (one connection each), the claims of a folder are done in a single
+        write transaction so two copies of a serie scanned at the same time cannot both be converted.
+
+        Parameters
+        ----------
+        path : str
+            path to the SQLite file (created if it does not exist)
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS instances (
+                sop_instance_uid TEXT PRIMARY KEY,
+                series_instance_uid TEXT,
+                owner TEXT NOT NULL,
+                serie_id TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS skipped (
+                owner TEXT NOT NULL,
+                serie_id TEXT NOT NULL,
+                series_instance_uid TEXT,
+                duplicate_of_owner TEXT NOT NULL,
+                duplicate_of_serie_id TEXT NOT NULL,
+                file_count INTEGER NOT NULL,
+                PRIMARY KEY (owner, serie_id));
+        ''')
+
+    def claim_series(self, owner, serie_dict):
+        """
+        Claim the instances of the series of a folder. A serie is a duplicate if all its instances were already
+        claimed by one serie of another folder (or another serie of the same folder), it is then recorded in the
+        skipped table and not claimed. A serie partially overlapping the claimed instances is converted and the series
+        with files without SOPInstanceUID are never duplicates.
+
+        Parameters
+        ----------
+        owner : str
+            identifier of the folder (the claims of the same owner are replaced, e.g. when the folder is converted
+            again)
+        serie_dict : dict
+            serie identifier: (SeriesInstanceUID, list of the SOPInstanceUIDs of its files)
+
+        Returns
+        -------
+        duplicate_dict : dict
+            serie identifier: (owner, serie identifier) of the serie it duplicates, for the skipped series
+        """
+        duplicate_dict = {}
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            self._connection.execute('DELETE FROM instances WHERE owner = ?', (owner,))
+            self._connection.execute('DELETE FROM skipped WHERE owner = ?', (owner,))
+            for serie_id in sorted(serie_dict):
+                series_instance_uid, sop_instance_uid_list = serie_dict[serie_id]
+                if series_instance_uid is not None:
+                    series_instance_uid = str(series_instance_uid)
+                sop_instance_uid_list = [None if uid is None else str(uid) for uid in sop_instance_uid_list]
+                if sop_instance_uid_list and None not in sop_instance_uid_list:
+                    uid_list = sorted(set(sop_instance_uid_list))
+                    claimant_set = set()
+                    found_counter = 0
+                    for i in range(0, len(uid_list), 500):
+                        chunk = uid_list[i:i + 500]
+                        row_list = self._connection.execute(
+                            'SELECT owner, serie_id FROM instances WHERE sop_instance_uid IN ({})'.format(
+                                ','.join('?' * len(chunk))), chunk).fetchall()
+                        found_counter += len(row_list)
+                        claimant_set.update(row_list)
+                    # all the instances were claimed by the same serie: it is a duplicate
+                    if found_counter == len(uid_list) and len(claimant_set) == 1:
+                        duplicate_of = claimant_set.pop()
+                        self._connection.execute('INSERT INTO skipped VALUES (?, ?, ?, ?, ?, ?)',
+                                                 (owner, serie_id, series_instance_uid, duplicate_of[0],
+                                                  duplicate_of[1], len(sop_instance_uid_list)))
+                        duplicate_dict[serie_id] = duplicate_of
+                        continue
+                self._connection.executemany(
+                    'INSERT OR IGNORE INTO instances VALUES (?, ?, ?, ?)',
+                    [(uid, series_instance_uid, owner, serie_id) for uid in sop_instance_uid_list if uid is not None])
+            self._connection.execute('COMMIT')
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        return duplicate_dict
+
+    def skipped_list(self):
+        """
+        Returns
+        -------
+        skipped_list : list of dict
+            the skipped series with the keys 'input_folder', 'serie_id', 'series_instance_uid', 'duplicate_of_folder',
+            'duplicate_of_serie_id' and 'file_count'
+        """
+        keys = ['input_folder', 'serie_id', 'series_instance_uid', 'duplicate_of_folder', 'duplicate_of_serie_id',
+                'file_count']
+        return [dict(zip(keys, row)) for row in self._connection.execute(
+            'SELECT owner, serie_id, series_instance_uid, duplicate_of_owner, duplicate_of_serie_id, file_count '
+            'FROM skipped ORDER BY owner, serie_id')]
+
+    def write_report(self, path):
+        skipped_list = self.skipped_list()
+        with open(path, 'w+') as report_file:
+            json.dump(skipped_list, report_file, indent=4)
+        return skipped_list
+
+    def close(self):
+        self._connection.close()
+
+
+def reset_index(path):
+    for p in [path, path + '-wal', path + '-shm']:
+        if os.path.exists(p):
+            os.remove(p)
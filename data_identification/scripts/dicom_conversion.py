@@ -13,7 +13,7 @@ from datetime import datetime
 
 import numpy as np
 
-from data_identification.modules import dicom_to_nifti, extra_utils
+from data_identification.modules import dicom_to_nifti, extra_utils, header_cache, metadata_catalog
 
 
 """ for the -f option:
@@ -48,6 +48,45 @@ def main():
     parser.add_argument('-o', '--output', type=str, help='output folder')
     parser.add_argument('-lpd', '--load_pixel_data', action='store_true',
                         help='pydicom option to load the voxel data when the metadata is read')
+    parser.add_argument('-ps', '--prescan', action='store_true',
+                        help='only read the header fields of the dcm2niix filename format to group the files into '
+                             'series, the complete header is then only read for the first file of each serie')
+    parser.add_argument('-im', '--incremental_merge', action='store_true',
+                        help='merge each DICOM header into the metadata of its serie as soon as it is read instead of '
+                             'keeping all the headers of the serie in memory')
+    parser.add_argument('-cm', '--compact_metadata', action='store_true',
+                        help='store the header fields that vary between the files of a serie in a compact form in '
+                             'the _dicom_metadata.json files (read them with dicom_metadata.load_metadata_json)')
+    parser.add_argument('-hc', '--header_cache', type=str, nargs='?', const='', default=None,
+                        help='keep the DICOM headers in a SQLite cache so the files that did not change are not read '
+                             'again when the conversion is run again (default path: '
+                             '[output]/{})'.format(header_cache.default_cache_filename))
+    parser.add_argument('-hcs', '--header_cache_size', type=int, default=header_cache.default_max_bytes // 1024 ** 2,
+                        help='maximum size of the header cache in MB')
+    parser.add_argument('-zm', '--zip_in_memory', action='store_true',
+                        help='read the DICOM headers directly from the zip archives and only extract the files of '
+                             'the series to convert')
+    parser.add_argument('-j', '--journal', action='store_true',
+                        help='record the conversion of each folder in [output]/__run_journal.jsonl so the "resume" '
+                             'rerun option can skip the folders already converted without checking the output '
+                             'directories')
+    parser.add_argument('-dd', '--deduplicate', action='store_true',
+                        help='index the SOPInstanceUIDs of all the inputs and do not convert the series already found '
+                             'in another folder (listed in [output]/__skipped_duplicates.json)')
+    parser.add_argument('-mc', '--metadata_catalog', action='store_true',
+                        help='write each converted serie in the SQLite catalog [output]/{} with indexed columns for '
+                             'the common acquisition fields'.format(metadata_catalog.default_catalog_filename))
+    parser.add_argument('-dc', '--dcm2niix_cores', type=int, default=None,
+                        help='maximum number of dcm2niix processes running at the same time (default: number_of_cores)')
+    parser.add_argument('-bf', '--batch_max_files', type=int, default=0,
+                        help='the folders with at most this number of files are converted by batches with a single '
+                             'dcm2niix run (default: 0, no batch)')
+    parser.add_argument('-bs', '--batch_size', type=int, default=32,
+                        help='maximum number of folders in a dcm2niix batch (default: 32)')
+    parser.add_argument('-nt', '--native_conversion', action='store_true',
+                        help='convert the plain single-frame, uncompressed MR series with NumPy and nibabel instead of '
+                             'dcm2niix (the other series are still converted with dcm2niix), the nifti files have the '
+                             'names and the voxel order of the ones of dcm2niix')
     parser.add_argument('-do', '--dcm2niix_options', type=str, default='',
                         help='add options to the dcm2niix call between quotes (e.g. "-v y")')
 
@@ -60,6 +99,9 @@ def main():
                              'not already been processed or do we do nothing?')
     parser.add_argument('-nc', '--number_of_cores', type=int, default=-1,
                         help='maximum number of cores used during the multiprocessing')
+    parser.add_argument('-pm', '--parallel_mode', default='thread', choices=['thread', 'process'], type=str,
+                        help='run the conversions in a pool of threads [default] or in a pool of processes (the '
+                             'header parsing is then spread on several cores)')
     args = parser.parse_args()
     now = datetime.now()
     log_filename = ''.join(['__conversion_log_file_', now.strftime("%m%d%Y%H%M%S"), '.txt'])
@@ -87,7 +129,8 @@ def main():
     else:
         logging.basicConfig(filename=log_file_path, level=logging.INFO)
 
-    log_formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
+    log_formatter = logging.Formatter("%(asctime)s [%(processName)-12.12s] [%(threadName)-12.12s] "
+                                      "[%(levelname)-5.5s]  %(message)s")
     file_handler = logging.StreamHandler(sys.stdout)
     file_handler.setFormatter(log_formatter)
     logging.getLogger().addHandler(file_handler)
@@ -116,18 +159,41 @@ def main():
 
     dcm2niix_options = [o for o in args.dcm2niix_options.split(' ') if o != '']
     stop_before_pixel = not args.load_pixel_data
+    scan_options = {'prescan': args.prescan, 'incremental': args.incremental_merge,
+                    'compact': args.compact_metadata}
+    cache_path = None
+    if args.header_cache is not None:
+        cache_path = args.header_cache
+        if cache_path == '':
+            cache_path = os.path.join(args.output, header_cache.default_cache_filename)
+        scan_options['cache_path'] = cache_path
+        scan_options['cache_max_bytes'] = args.header_cache_size * 1024 ** 2
     logging.info('Running dicom_to_nifti.convert_dataset with output in "{}", dcm2niix option "{}" and '
                  'rerun option "{}"'.format(args.output, dcm2niix_options, args.rerun))
+    catalog_path = None
+    if args.metadata_catalog:
+        catalog_path = os.path.join(args.output, metadata_catalog.default_catalog_filename)
+    aggregator = extra_utils.FinalDictAggregator(args.output, conflict_opt='keep_first_found', check_integrity=True,
+                                                 nb_cores=args.number_of_cores, catalog_path=catalog_path)
     try:
         dicom_to_nifti.convert_dataset(dir_list, args.output, converter_options=dcm2niix_options,
                                        rerun=args.rerun, stop_before_pixels=stop_before_pixel,
-                                       nb_cores=args.number_of_cores)
+                                       nb_cores=args.number_of_cores, parallel_mode=args.parallel_mode,
+                                       scan_options=scan_options, zip_in_memory=args.zip_in_memory,
+                                       use_journal=args.journal, aggregator=aggregator,
+                                       deduplicate=args.deduplicate, dcm2niix_cores=args.dcm2niix_cores,
+                                       batch_max_files=args.batch_max_files, batch_size=args.batch_size,
+                                       native_conversion=args.native_conversion,
+                                       use_catalog=args.metadata_catalog)
     except Exception as e:
         logging.exception(e)
         raise
+    if cache_path is not None:
+        cache = header_cache.HeaderCache(cache_path, max_bytes=args.header_cache_size * 1024 ** 2)
+        logging.info('Header cache statistics: {}'.format(cache.statistics()))
+        cache.close()
     try:
-        out_dict, error_list = extra_utils.create_final_dict(args.output, conflict_opt='keep_first_found',
-                                                             check_integrity=True)
+        out_dict, error_list = aggregator.finalize()
     except Exception as e:
         logging.exception(e)
         raise
@@ -2,4 +2,186 @@
 Simple preprocessing of the DICOM before conversion
 
 Authors: Chris Foulon
-"""
\ No newline at end of file
+"""
+import os
+import sys
+import shutil
+import argparse
+import logging
+import multiprocessing
+from multiprocessing.dummy import Pool as ThreadPool
+
+from data_identification.modules import dicom_metadata, extra_utils
+
+
+def clear_staged_folder(staging_dir):
+    """
+    Remove the links staged in staging_dir by a previous run (its files and its serie folders, the staged sub-folders
+    of the DICOM directory are kept)
+    """
+    if not os.path.isdir(staging_dir):
+        return
+    with os.scandir(staging_dir) as it:
+        for entry in it:
+            if entry.name.startswith('__serie_') and entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            elif not entry.is_dir(follow_symlinks=False):
+                os.remove(entry.path)
+
+
+def stage_dicom_folder(dicom_dir, staging_dir, filename_format='%p_%t_%s', scan_options=None):
+    """
+    Link the DICOM files of dicom_dir into staging_dir with one folder per serie ('__serie_' + the serie identifier)
+    so dicom_to_nifti converts the series of the folder in parallel instead of in a single dcm2niix run. The files
+    are grouped with dicom_metadata.scan_dicomdir, which only reads the fields of filename_format (prescan). The files
+    are hard linked (or symbolically linked if they are on another file system, see extra_utils.link_files), so
+    nothing is copied. A folder with a single serie is linked as it is in staging_dir.
+
+    Parameters
+    ----------
+    dicom_dir : str
+        folder containing DICOM files
+    staging_dir : str
+        folder where the links are created (created if it does not exist)
+    filename_format : str
+        dcm2niix format string used to group the files into series, it should be the one of the conversion
+    scan_options : dict
+        extra keyword arguments given to dicom_metadata.scan_dicomdir (e.g. {'cache_path': ...})
+
+    Returns
+    -------
+    staged_dict : dict
+        folder: number of files linked in the folder
+    """
+    if scan_options is None:
+        scan_options = {}
+    scan_options = dict(scan_options, prescan=True, stop_before_pixels=True)
+    try:
+        series = dicom_metadata.scan_dicomdir(dicom_dir, filename_format, **scan_options)
+    except (ValueError, AttributeError) as e:
+        logging.warning('[{}] cannot be split into series, it is not staged [{}]'.format(dicom_dir, e))
+        return {}
+    os.makedirs(staging_dir, exist_ok=True)
+    clear_staged_folder(staging_dir)
+    if len(series) == 1:
+        file_list = next(iter(series.values())).file_list
+        extra_utils.link_files(file_list, staging_dir)
+        return {staging_dir: len(file_list)}
+    staged_dict = {}
+    for serie_id in series:
+        serie_dir = os.path.join(staging_dir, '__serie_' + extra_utils.clean_string(serie_id))
+        extra_utils.link_files(series[serie_id].file_list, serie_dir)
+        staged_dict[serie_dir] = len(series[serie_id].file_list)
+    logging.info('[{}] split into {} series in [{}]'.format(dicom_dir, len(series), staging_dir))
+    return staged_dict
+
+
+def _run_stage_task(task):
+    return stage_dicom_folder(*task)
+
+
+def stage_dataset(input_path_list, staging_folder, filename_format='%p_%t_%s', nb_cores=-1, scan_options=None):
+    """
+    Stage every input of a dataset in staging_folder: the folder tree of each input directory is reproduced in
+    staging_folder/[input name] with the files of each DICOM folder split into one folder per serie (see
+    stage_dicom_folder) and the zip archives linked as they are. The DICOM folders are staged in parallel. The staged
+    dataset is then converted like the original one (e.g. with dicom_conversion.py -p staging_folder), the outputs of
+    the split folders being in one sub-directory per serie.
+
+    Parameters
+    ----------
+    input_path_list : list of str
+        DICOM directories and zip archives (see dicom_to_nifti.convert_dataset)
+    staging_folder : str
+        folder of the staged dataset, it must be on the same file system as the inputs to use hard links
+    filename_format : str
+        see stage_dicom_folder
+    nb_cores : int
+        number of folders staged at the same time (-1 means the number of cores)
+    scan_options : dict
+        see stage_dicom_folder
+
+    Returns
+    -------
+    staged_path_list : list of str
+        the staged inputs, to give to dicom_to_nifti.convert_dataset
+    """
+    if nb_cores == -1:
+        nb_cores = multiprocessing.cpu_count()
+    os.makedirs(staging_folder, exist_ok=True)
+    task_list = []
+    staged_path_list = []
+    for input_path in input_path_list:
+        input_name = os.path.basename(os.path.normpath(input_path))
+        staged_path = os.path.join(staging_folder, input_name)
+        if os.path.isdir(input_path):
+            for entry_type, path, stats in extra_utils.discover_inputs(input_path):
+                staging_dir = os.path.join(staged_path, os.path.relpath(path, input_path))
+                if entry_type == 'zip':
+                    os.makedirs(os.path.dirname(staging_dir), exist_ok=True)
+                    if os.path.lexists(staging_dir):
+                        os.remove(staging_dir)
+                    extra_utils.link_files([path], os.path.dirname(staging_dir))
+                elif stats[1] > 0:
+                    task_list.append((stats[1], (path, os.path.normpath(staging_dir), filename_format, scan_options)))
+        elif os.path.isfile(input_path):
+            if os.path.lexists(staged_path):
+                os.remove(staged_path)
+            extra_utils.link_files([input_path], staging_folder)
+        else:
+            logging.error('[{}] is not an existing directory or zip file'.format(input_path))
+            continue
+        staged_path_list.append(staged_path)
+    # the biggest folders first so they do not end the staging alone, with the number of files found while listing
+    # the inputs
+    task_list = [task for _, task in sorted(task_list, key=lambda item: -item[0])]
+    serie_count = 0
+    pool = ThreadPool(nb_cores)
+    try:
+        for staged_dict in pool.imap_unordered(_run_stage_task, task_list):
+            serie_count += len(staged_dict)
+    finally:
+        pool.close()
+        pool.join()
+    logging.info('{} DICOM folders staged in {} folders in [{}]'.format(len(task_list), serie_count, staging_folder))
+    return staged_path_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stage a DICOM dataset with one folder of links per serie so the '
+                                                 'series of the big flat folders are converted in parallel')
+    paths_group = parser.add_mutually_exclusive_group(required=True)
+    paths_group.add_argument('-p', '--input_path', type=str, help='Root folder of the dataset')
+    paths_group.add_argument('-li', '--input_list', type=str,
+                             help='Text file containing the list of DICOM folders (one per line)')
+    parser.add_argument('-s', '--staging_folder', type=str, required=True,
+                        help='folder of the staged dataset (on the same file system as the dataset so the files are '
+                             'hard linked), to convert with dicom_conversion.py -p [staging_folder]')
+    parser.add_argument('-f', '--filename_format', type=str, default='%p_%t_%s',
+                        help='dcm2niix format string used to split the folders into series, use the -f option of the '
+                             'conversion (default: "%%p_%%t_%%s")')
+    parser.add_argument('-nc', '--number_of_cores', type=int, default=-1,
+                        help='number of folders staged at the same time')
+    parser.add_argument('-v', '--verbose', default='info', choices=['none', 'info', 'debug'], nargs='?', const='info',
+                        type=str, help='print info or debugging messages [default is "info"] ')
+    args = parser.parse_args()
+    if args.verbose == 'debug':
+        logging.basicConfig(level=logging.DEBUG, stream=sys.stdout)
+    elif args.verbose == 'none':
+        logging.basicConfig(level=logging.CRITICAL, stream=sys.stdout)
+    else:
+        logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    if args.input_path is not None:
+        input_path_list = extra_utils.create_input_path_list_from_root(args.input_path)
+    else:
+        if not os.path.exists(args.input_list):
+            raise ValueError(args.input_list + ' does not exist.')
+        with open(args.input_list, 'r') as input_file:
+            input_path_list = [line.strip() for line in input_file if line.strip() != '']
+    stage_dataset(input_path_list, args.staging_folder, filename_format=args.filename_format,
+                  nb_cores=args.number_of_cores)
+
+
+if __name__ == '__main__':
+    main()
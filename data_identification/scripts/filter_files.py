@@ -2,4 +2,98 @@
 Filter a list of files with their corresponding metadata
 
 Authors: Chris Foulon
-"""
\ No newline at end of file
+"""
+import os
+import argparse
+import json
+import logging
+
+from data_identification.modules import metadata_index
+
+
+def filter_output_folder(output_folder, predicate_list, index_path=None, update=True, existing_only=True):
+    """
+    Select the converted files of a conversion output folder whose metadata match all the predicates, using the
+    persistent index of the folder (see metadata_index.MetadataIndex).
+
+    Parameters
+    ----------
+    output_folder : str
+        the output folder of a conversion (see dicom_to_nifti.convert_dataset)
+    predicate_list : list of str
+        predicates on the header fields (see metadata_index.parse_predicate)
+    index_path : str
+        path to the index (default: output_folder/__metadata_index.sqlite)
+    update : bool
+        True (default) means that the index is updated with the sub-directories converted since the last update
+        before the query
+    existing_only : bool
+        True (default) means that the series whose output file does not exist anymore are not returned
+
+    Returns
+    -------
+    series_list : list of dict
+        'source', 'prefix', 'output_path' and 'metadata' of the matching series
+    """
+    if index_path is None:
+        index_path = os.path.join(output_folder, metadata_index.default_index_filename)
+    # the predicates are checked before the index is updated
+    parsed_list = [metadata_index.parse_predicate(p) for p in predicate_list]
+    index = metadata_index.MetadataIndex(index_path)
+    try:
+        if update:
+            logging.info('Metadata index updated: {}'.format(index.update(output_folder)))
+        series_list = index.query(parsed_list)
+    finally:
+        index.close()
+    if existing_only:
+        series_list = [s for s in series_list if s['output_path'] is not None and os.path.exists(s['output_path'])]
+    return series_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Filter the converted files of a dicom_conversion output folder with '
+                                                 'their metadata')
+    parser.add_argument('-o', '--output', type=str, required=True, help='output folder of dicom_conversion')
+    parser.add_argument('-w', '--where', type=str, nargs='*', default=[],
+                        help='predicates on the DICOM header fields that all the selected series match, e.g. '
+                             '"EchoTime<10" "Manufacturer=SIEMENS" "SeriesDescription~t1" (~ means contains). The '
+                             'operators are {}'.format(' '.join(metadata_index.operator_list)))
+    parser.add_argument('-i', '--index', type=str, default=None,
+                        help='path to the metadata index (default: [output]/{})'.format(
+                            metadata_index.default_index_filename))
+    parser.add_argument('-nu', '--no_update', action='store_true',
+                        help='query the index without indexing the folders converted since its last update')
+    parser.add_argument('-km', '--keep_missing', action='store_true',
+                        help='also list the series whose output file does not exist anymore')
+    parser.add_argument('-f', '--output_file', type=str, default=None,
+                        help='write the selected paths in a text file (or the selected series in a json file if the '
+                             'path ends with .json) instead of printing the paths')
+    parser.add_argument('-v', '--verbose', default='info', choices=['none', 'info', 'debug'], nargs='?', const='info',
+                        type=str, help='print info or debugging messages [default is "info"] ')
+    args = parser.parse_args()
+    if args.verbose == 'debug':
+        logging.basicConfig(level=logging.DEBUG)
+    elif args.verbose == 'none':
+        logging.basicConfig(level=logging.CRITICAL)
+    else:
+        logging.basicConfig(level=logging.INFO)
+    if not os.path.isdir(args.output):
+        raise ValueError('{} is not a directory'.format(args.output))
+
+    series_list = filter_output_folder(args.output, args.where, index_path=args.index, update=not args.no_update,
+                                       existing_only=not args.keep_missing)
+    logging.info('{} series selected'.format(len(series_list)))
+    if args.output_file is None:
+        for s in series_list:
+            print(s['output_path'])
+    elif args.output_file.endswith('.json'):
+        with open(args.output_file, 'w+') as out_file:
+            json.dump(series_list, out_file, indent=4)
+    else:
+        with open(args.output_file, 'w+') as out_file:
+            out_file.write(''.join(['{}\n'.format(s['output_path']) for s in series_list]))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,4 +2,101 @@
 Access the files wherever they are (XNAT, local, ...)
 
 Authors: Chris Foulon
-"""
\ No newline at end of file
+"""
+import os
+import sys
+import argparse
+import json
+import logging
+from datetime import datetime
+
+from data_identification.modules import dicom_sources, extra_utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetch DICOM studies from a local folder or an HTTP server and '
+                                                 'convert them to nifti while the next studies are fetched')
+    parser.add_argument('-s', '--source', type=str, required=True,
+                        help='local folder containing the studies or URL of the HTTP server')
+    parser.add_argument('-o', '--output', type=str, required=True, help='output folder')
+    parser.add_argument('-dl', '--download_folder', type=str, default=None,
+                        help='folder where the studies are downloaded (default: [output]/__downloads)')
+    parser.add_argument('-sl', '--study_list', type=str, default=None,
+                        help='text file with one study identifier per line (default: all the studies of the source)')
+    parser.add_argument('-su', '--study_url', type=str, default='{base_url}/{study}',
+                        help='URL template of the zip archive of a study (default: "{base_url}/{study}", e.g. '
+                             '"{base_url}/data/experiments/{study}/scans/ALL/files?format=zip" for XNAT)')
+    parser.add_argument('-lu', '--list_url', type=str, default=None,
+                        help='URL returning the list of the studies (default: the source URL)')
+    parser.add_argument('-H', '--header', type=str, nargs='*', default=[],
+                        help='HTTP headers added to the requests (e.g. "Authorization: Basic ...")')
+    parser.add_argument('-mc', '--max_connections', type=int, default=4,
+                        help='maximum number of connections to the HTTP server (default: 4)')
+    parser.add_argument('-pf', '--prefetch', type=int, default=4,
+                        help='number of studies fetched in advance while converting (default: 4)')
+    parser.add_argument('-bs', '--batch_size', type=int, default=4,
+                        help='maximum number of fetched studies converted together (default: 4)')
+    parser.add_argument('-kd', '--keep_downloads', action='store_true',
+                        help='keep the downloaded archives once converted')
+    parser.add_argument('-do', '--dcm2niix_options', type=str, default='',
+                        help='add options to the dcm2niix call between quotes (e.g. "-v y")')
+    parser.add_argument('-re', '--rerun', default='resume', choices=['delete', 'resume', 'none'], type=str,
+                        help='see dicom_conversion.py')
+    parser.add_argument('-nc', '--number_of_cores', type=int, default=-1,
+                        help='maximum number of cores used during the conversion')
+    parser.add_argument('-v', '--verbose', default='info', choices=['none', 'info', 'debug'], nargs='?', const='info',
+                        type=str, help='print info or debugging messages [default is "info"] ')
+    args = parser.parse_args()
+    os.makedirs(args.output, exist_ok=True)
+    log_file_path = os.path.join(args.output, ''.join(['__request_log_file_', datetime.now().strftime("%m%d%Y%H%M%S"),
+                                                       '.txt']))
+    if args.verbose == 'debug':
+        logging.basicConfig(filename=log_file_path, level=logging.DEBUG)
+    elif args.verbose == 'none':
+        logging.basicConfig(filename=log_file_path, level=logging.CRITICAL)
+    else:
+        logging.basicConfig(filename=log_file_path, level=logging.INFO)
+    log_formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(log_formatter)
+    logging.getLogger().addHandler(stream_handler)
+
+    header_dict = {}
+    for header in args.header:
+        name, _, value = header.partition(':')
+        header_dict[name.strip()] = value.strip()
+    source = dicom_sources.create_source(args.source, study_url_template=args.study_url, list_url=args.list_url,
+                                         headers=header_dict, max_connections=args.max_connections)
+    study_list = None
+    if args.study_list is not None:
+        with open(args.study_list, 'r') as study_file:
+            study_list = [s.strip() for s in study_file if s.strip() != '']
+    download_folder = args.download_folder
+    if download_folder is None:
+        download_folder = os.path.join(args.output, '__downloads')
+    dcm2niix_options = [o for o in args.dcm2niix_options.split(' ') if o != '']
+    aggregator = extra_utils.FinalDictAggregator(args.output, conflict_opt='keep_first_found', check_integrity=True,
+                                                 nb_cores=args.number_of_cores)
+    try:
+        _, failed_list = dicom_sources.convert_source(
+            source, args.output, download_folder, study_list=study_list, prefetch=args.prefetch,
+            batch_size=args.batch_size, keep_downloads=args.keep_downloads, converter_options=dcm2niix_options,
+            rerun=args.rerun, nb_cores=args.number_of_cores, aggregator=aggregator)
+    except Exception as e:
+        logging.exception(e)
+        raise
+    finally:
+        source.close()
+    if failed_list:
+        with open(os.path.join(args.output, '__failed_studies.txt'), 'w+') as failed_file:
+            failed_file.write(''.join(['{}\n'.format(s) for s in failed_list]))
+    out_dict, error_list = aggregator.finalize()
+    if error_list:
+        with open(os.path.join(args.output, '__error_directories.txt'), 'w+') as error_file:
+            json.dump(error_list, error_file)
+    with open(os.path.join(args.output, '__image_label_dict.json'), 'w+') as out_file:
+        json.dump(out_dict, out_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+import pytest
+
+from benchmarks import synthetic_dicom
+
+
+@pytest.fixture
+def dicom_dataset(tmp_path):
+    """
+    Factory of small synthetic DICOM datasets (see synthetic_dicom.generate_dataset) written in tmp_path/dicom
+    """
+    def create(**parameters):
+        parameters = dict({'study_count': 2, 'serie_count': 2, 'slice_count': 3, 'matrix_size': 8}, **parameters)
+        return synthetic_dicom.generate_dataset(str(tmp_path / 'dicom'), **parameters)
+    return create
@@ -0,0 +1,147 @@
+import os
+import re
+import json
+
+import pytest
+import pydicom
+
+from data_identification.modules import dicom_metadata, extra_utils
+from benchmarks import synthetic_dicom
+
+
+def element(vr, *values):
+    return {'vr': vr, 'Value': list(values)}
+
+
+rng_values = [0.1, 2.5, -3.25, 7.0, 1e-3, 42.125]
+encoding_case_list = [
+    # InstanceNumber
+    ('range', [element('IS', i) for i in range(1, 11)]),
+    # ImagePositionPatient of a regular volume
+    ('range', [element('DS', -32.0, -32.0, 2.0 * i) for i in range(6)]),
+    ('rle', [element('CS', 'M')] * 4 + [None] * 3 + [element('CS', 'P')] * 5),
+    ('array', [element('DS', v) for v in rng_values]),
+    ('array', [element('US', i * i) for i in range(6)]),
+    # 1 and 1.0 are the same in python but not in json
+    ('rle', [element('DS', 1)] * 3 + [element('DS', 1.0)] * 3),
+    # mixed types
+    ('rle', [element('DS', 1), element('DS', 1), element('DS', 2.5), element('DS', 2.5), element('LO', 'a'),
+             element('LO', 'a')]),
+    (None, [element('DS', 1), element('DS', 2.5), element('LO', 'a'), None, element('DS', 1.5, 2)]),
+    (None, []),
+    (None, [element('IS', 3)]),
+]
+
+
+@pytest.mark.parametrize('encoding, element_list', encoding_case_list)
+def test_varying_field_round_trip(encoding, element_list):
+    encoded = dicom_metadata.encode_varying_field(element_list)
+    if encoding is None:
+        assert encoded == element_list
+    else:
+        assert encoded['Encoding'] == encoding
+    # the metadata is written in json
+    decoded = dicom_metadata.decode_varying_field(json.loads(json.dumps(encoded)))
+    assert json.dumps(decoded) == json.dumps(element_list)
+
+
+def test_compact_metadata_round_trip():
+    metadata_json_dict = {'00080060': element('CS', 'MR'),
+                          '00200013': [element('IS', i) for i in range(1, 6)],
+                          '00080008': [element('CS', 'ORIGINAL', 'PRIMARY')] * 4 + [element('CS', 'DERIVED')]}
+    compact_dict = json.loads(json.dumps(dicom_metadata.compact_metadata(metadata_json_dict)))
+    assert compact_dict['00080060'] == metadata_json_dict['00080060']
+    assert compact_dict['00200013']['Encoding'] == 'range'
+    assert dicom_metadata.expand_metadata(compact_dict) == metadata_json_dict
+
+
+def baseline_key(identifier_string, dcm, dicom_folder):
+    """
+    Series key of the original create_metadata_filename (format string parsed for every header)
+    """
+    filename = identifier_string
+    for identifier in re.findall(r'%[a-z]', identifier_string):
+        if identifier == '%t':
+            value = '{}{}'.format(dcm.StudyDate, str(round(float(dcm.StudyTime))))
+        elif identifier == '%f':
+            value = dicom_folder
+        else:
+            value = str(getattr(dcm, dicom_metadata.format_to_key_dict[identifier]))
+        filename = filename.replace(identifier, value)
+    return extra_utils.clean_string(filename)
+
+
+def baseline_scan(dicom_dir, identifier_string):
+    """
+    Original scan: every header is completely read, the folder is scanned again with the next replacement field
+    each time a field of the format string is missing from a header, and the headers of each serie are merged once
+    they are all read.
+
+    Returns
+    -------
+    baseline_dict : dict
+        serie identifier: (sorted file names, merged metadata)
+    """
+    replacement_list = list(dicom_metadata.replacement_fields)
+    while True:
+        header_dict = {}
+        try:
+            for f in sorted(os.listdir(dicom_dir)):
+                dcm = pydicom.dcmread(os.path.join(dicom_dir, f), defer_size=None, stop_before_pixels=True)
+                header_dict.setdefault(baseline_key(identifier_string, dcm, dicom_dir), []).append(dcm)
+            break
+        except AttributeError as err:
+            missing_field = re.search(r"'(\w+)'$", str(err)).group(1)
+            replacement_list = [r for r in replacement_list if r != missing_field]
+            identifier_string = identifier_string.replace(dicom_metadata.key_to_format_dict[missing_field],
+                                                          dicom_metadata.key_to_format_dict[replacement_list[0]])
+    baseline_dict = {}
+    for key, dcm_list in header_dict.items():
+        dcm_list.sort(key=lambda dcm: dcm.InstanceNumber)
+        json_list = [dcm.to_json_dict() for dcm in dcm_list]
+        merged_dict = {}
+        for tag in set([tag for json_dict in json_list for tag in json_dict]):
+            value_list = [json_dict.get(tag) for json_dict in json_list]
+            merged_dict[tag] = value_list[0] if value_list.count(value_list[0]) == len(value_list) else value_list
+        baseline_dict[key] = (sorted([os.path.basename(dcm.filename) for dcm in dcm_list]), merged_dict)
+    return baseline_dict
+
+
+@pytest.fixture
+def flat_folder(tmp_path):
+    """
+    Flat folder of 3 series, the last one without SequenceName
+    """
+    dicom_dir = str(tmp_path / 'flat')
+    synthetic_dicom.generate_study(dicom_dir, 0, serie_count=3, slice_count=4, matrix_size=4, flat=True)
+    for f in os.listdir(dicom_dir):
+        if f.startswith('s003_'):
+            ds = pydicom.dcmread(os.path.join(dicom_dir, f))
+            del ds.SequenceName
+            ds.save_as(os.path.join(dicom_dir, f))
+    return dicom_dir
+
+
+@pytest.mark.parametrize('identifier_string', ['%p_%t_%s', '%p_%z_%s'])
+@pytest.mark.parametrize('scan_options', [{}, {'incremental': True}, {'prescan': True},
+                                          {'prescan': True, 'incremental': True}])
+def test_scan_matches_the_baseline(flat_folder, identifier_string, scan_options):
+    baseline_dict = baseline_scan(flat_folder, identifier_string)
+    series = dicom_metadata.scan_dicomdir(flat_folder, identifier_string, **scan_options)
+    assert sorted(series) == sorted(baseline_dict)
+    for s in series:
+        file_list, baseline_metadata = baseline_dict[s]
+        assert sorted([os.path.basename(f) for f in series[s].file_list]) == file_list
+        metadata = series[s].generate_metadata()
+        if scan_options.get('prescan'):
+            # the fields that are not prescanned come from the first file
+            prescanned_tag_list = [tag for tag in metadata if isinstance(metadata[tag], list)]
+            assert set(prescanned_tag_list) <= set([tag for tag in baseline_metadata
+                                                    if isinstance(baseline_metadata[tag], list)])
+            for tag in baseline_metadata:
+                expected = baseline_metadata[tag]
+                if isinstance(expected, list) and tag not in prescanned_tag_list:
+                    expected = expected[0]
+                assert metadata[tag] == expected
+        else:
+            assert metadata == baseline_metadata
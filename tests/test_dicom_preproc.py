@@ -0,0 +1,25 @@
+import os
+
+from data_identification.modules import extra_utils
+from data_identification.scripts import dicom_preproc
+
+
+def test_stage_dataset_does_not_list_the_folders_again(dicom_dataset, tmp_path, monkeypatch):
+    dataset = dicom_dataset(study_count=2, serie_count=3, flat=True)
+    stats_list = []
+    get_folder_file_stats = extra_utils.get_folder_file_stats
+
+    def counted_get_folder_file_stats(folder, *args, **kwargs):
+        stats_list.append(folder)
+        return get_folder_file_stats(folder, *args, **kwargs)
+    monkeypatch.setattr(extra_utils, 'get_folder_file_stats', counted_get_folder_file_stats)
+    staging_folder = str(tmp_path / 'staging')
+    staged_path_list = dicom_preproc.stage_dataset([os.path.dirname(dataset['input_list'][0])], staging_folder,
+                                                   nb_cores=1)
+    assert stats_list == []
+    assert staged_path_list == [os.path.join(staging_folder, 'dicom')]
+    for study_index in range(2):
+        study_folder = os.path.join(staging_folder, 'dicom', 'study_{:05d}'.format(study_index))
+        serie_folder_list = sorted(os.listdir(study_folder))
+        assert len(serie_folder_list) == 3 and all([f.startswith('__serie_') for f in serie_folder_list])
+        assert sum([len(os.listdir(os.path.join(study_folder, f))) for f in serie_folder_list]) == 9
@@ -0,0 +1,72 @@
+import io
+import threading
+import http.server
+
+from data_identification.modules import dicom_sources, dicom_to_nifti
+
+
+class StudyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = '{} {}'.format(self.server.server_port, self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        return
+
+
+def test_connections_are_reused_for_their_server():
+    server_list = [http.server.ThreadingHTTPServer(('127.0.0.1', 0), StudyHandler) for _ in range(2)]
+    for server in server_list:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    url_list = ['http://127.0.0.1:{}'.format(server.server_port) for server in server_list]
+    source = dicom_sources.HttpSource(url_list[0], list_url=url_list[1] + '/list', max_connections=1)
+    try:
+        for url in [url_list[0] + '/a', url_list[1] + '/list', url_list[0] + '/b']:
+            output_file = io.BytesIO()
+            source._get(url, output_file)
+            port, path = url.split(':')[-1].split('/', 1)
+            assert output_file.getvalue().decode('utf-8') == '{} /{}'.format(port, path)
+    finally:
+        source.close()
+        for server in server_list:
+            server.shutdown()
+            server.server_close()
+
+
+def test_failed_batch_does_not_stop_the_conversion(dicom_dataset, tmp_path, monkeypatch):
+    dataset = dicom_dataset(study_count=2)
+    convert_dataset = dicom_to_nifti.convert_dataset
+
+    def failing_convert_dataset(path_list, *args, **kwargs):
+        if any([p.endswith('study_00000') for p in path_list]):
+            raise RuntimeError('conversion error')
+        return convert_dataset(path_list, *args, **kwargs)
+    monkeypatch.setattr(dicom_to_nifti, 'convert_dataset', failing_convert_dataset)
+    source = dicom_sources.LocalSource(str(tmp_path / 'dicom'))
+    converted_dict, failed_list = dicom_sources.convert_source(
+        source, str(tmp_path / 'nifti'), str(tmp_path / 'downloads'), batch_size=1, nb_cores=1)
+    assert failed_list == ['study_00000']
+    assert list(converted_dict) == [str(tmp_path / 'dicom' / 'study_00001')]
+
+
+def test_only_the_first_batch_deletes_the_outputs(dicom_dataset, tmp_path, monkeypatch):
+    dicom_dataset(study_count=3)
+    rerun_list = []
+    convert_dataset = dicom_to_nifti.convert_dataset
+
+    def recorded_convert_dataset(path_list, *args, **kwargs):
+        rerun_list.append(kwargs.get('rerun'))
+        return convert_dataset(path_list, *args, **kwargs)
+    monkeypatch.setattr(dicom_to_nifti, 'convert_dataset', recorded_convert_dataset)
+    source = dicom_sources.LocalSource(str(tmp_path / 'dicom'))
+    converted_dict, failed_list = dicom_sources.convert_source(
+        source, str(tmp_path / 'nifti'), str(tmp_path / 'downloads'), batch_size=1, rerun='delete', nb_cores=1,
+        use_journal=True)
+    assert rerun_list == ['delete', 'resume', 'resume']
+    assert failed_list == []
+    assert len(converted_dict) == 3
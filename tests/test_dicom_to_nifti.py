@@ -0,0 +1,150 @@
+import io
+import os
+import time
+import asyncio
+import json
+import shutil
+import zipfile
+
+import numpy as np
+import nibabel as nib
+
+from data_identification.modules import dicom_to_nifti, extra_utils, run_journal
+from benchmarks import synthetic_dicom
+
+
+def count_dcm2niix_runs(monkeypatch):
+    run_list = []
+    dcm2niix_convert_folder = dicom_to_nifti.dcm2niix_convert_folder
+
+    def counted_convert_folder(*args, **kwargs):
+        run_list.append(args or kwargs)
+        return dcm2niix_convert_folder(*args, **kwargs)
+    monkeypatch.setattr(dicom_to_nifti, 'dcm2niix_convert_folder', counted_convert_folder)
+    return run_list
+
+
+def test_batch_with_morning_study_time(dicom_dataset, tmp_path, monkeypatch):
+    # the synthetic studies are acquired at 08:00:0x, dcm2niix writes the time with its leading zero
+    dataset = dicom_dataset(study_count=3)
+    run_list = count_dcm2niix_runs(monkeypatch)
+    output_folder = str(tmp_path / 'nifti')
+    converted_dict = dicom_to_nifti.convert_dataset(dataset['input_list'], output_folder, nb_cores=1,
+                                                    batch_max_files=100)
+    assert len(run_list) == 1
+    output_subdirectory_list = []
+    for root_dir in converted_dict:
+        for output_subdirectory, output_dict in converted_dict[root_dir].items():
+            assert len(output_dict) == 1
+            pref = next(iter(output_dict))
+            # study[i]_serie[j] comes from study_0000[i]/serie_00[j + 1]
+            study_index, serie_index = [int(s[-1]) for s in pref.split('_')[:2]]
+            assert output_subdirectory == os.path.join(output_folder, 'study_{:05d}'.format(study_index),
+                                                       'serie_{:03d}'.format(serie_index + 1))
+            assert os.path.dirname(output_dict[pref]['output_path']) == output_subdirectory
+            assert os.path.exists(output_dict[pref]['output_path'])
+            output_subdirectory_list.append(output_subdirectory)
+    assert len(output_subdirectory_list) == 6
+
+
+def test_nested_zip_folders_with_the_same_path(tmp_path):
+    # outer.zip contains a.zip and b.zip, each one with a different study in a 'scan' folder
+    outer_path = str(tmp_path / 'outer.zip')
+    with zipfile.ZipFile(outer_path, 'w') as outer_zip:
+        for study_index, name in enumerate(['a', 'b']):
+            scan_folder = str(tmp_path / name / 'scan')
+            synthetic_dicom.generate_study(scan_folder, study_index, serie_count=1, slice_count=3, matrix_size=8,
+                                           flat=True)
+            inner_buffer = io.BytesIO()
+            with zipfile.ZipFile(inner_buffer, 'w') as inner_zip:
+                inner_zip.write(scan_folder, 'scan')
+                for f in os.listdir(scan_folder):
+                    inner_zip.write(os.path.join(scan_folder, f), 'scan/' + f)
+            outer_zip.writestr(name + '.zip', inner_buffer.getvalue())
+            shutil.rmtree(str(tmp_path / name))
+    output_folder = str(tmp_path / 'nifti')
+    converted_dict = dicom_to_nifti.convert_dataset([outer_path], output_folder, nb_cores=1, zip_in_memory=True)
+    output_dict_dict = converted_dict[outer_path]
+    assert sorted(output_dict_dict) == [os.path.join(output_folder, 'outer.zip', name + '.zip', 'scan')
+                                        for name in ['a', 'b']]
+    pref_list = [pref for output_dict in output_dict_dict.values() for pref in output_dict]
+    assert sorted([pref.split('_')[0] for pref in pref_list]) == ['study0', 'study1']
+    for output_dict in output_dict_dict.values():
+        for pref in output_dict:
+            assert os.path.exists(output_dict[pref]['output_path'])
+
+
+def test_resume_skips_zip_inputs(dicom_dataset, tmp_path, monkeypatch):
+    dataset = dicom_dataset(study_count=4, zip_fraction=0.5)
+    # the output folder does not exist before the first run
+    output_folder = str(tmp_path / 'nifti' / 'run')
+    first_dict = dicom_to_nifti.convert_dataset(dataset['input_list'], output_folder, nb_cores=1, use_journal=True)
+    assert sum([len(first_dict[root_dir]) for root_dir in first_dict]) == 8
+    run_list = count_dcm2niix_runs(monkeypatch)
+    unzipped_list = []
+    unzip_recursive_and_list = extra_utils.unzip_recursive_and_list
+
+    def counted_unzip(zipfile_path, *args, **kwargs):
+        unzipped_list.append(zipfile_path)
+        return unzip_recursive_and_list(zipfile_path, *args, **kwargs)
+    monkeypatch.setattr(extra_utils, 'unzip_recursive_and_list', counted_unzip)
+    second_dict = dicom_to_nifti.convert_dataset(dataset['input_list'], output_folder, nb_cores=1, use_journal=True)
+    assert sum([len(second_dict[root_dir]) for root_dir in second_dict]) == 0
+    assert run_list == []
+    assert unzipped_list == []
+    # a modified archive is converted again
+    zip_path = next(p for p in dataset['input_list'] if p.endswith('.zip'))
+    os.utime(zip_path, ns=(os.stat(zip_path).st_atime_ns, os.stat(zip_path).st_mtime_ns + 10 ** 9))
+    third_dict = dicom_to_nifti.convert_dataset(dataset['input_list'], output_folder, nb_cores=1, use_journal=True)
+    assert unzipped_list == [zip_path]
+    assert len(third_dict[zip_path]) == 2
+
+
+def test_failed_folder_is_not_done(tmp_path):
+    input_folder = tmp_path / 'no_dicom'
+    input_folder.mkdir()
+    (input_folder / 'notes.txt').write_text('not a DICOM file')
+    output_folder = str(tmp_path / 'nifti')
+    dicom_to_nifti.convert_dataset([str(input_folder)], output_folder, nb_cores=1, use_journal=True)
+    journal = run_journal.RunJournal(os.path.join(output_folder, run_journal.default_journal_filename)).load()
+    assert journal.get_done_records() == []
+    with open(journal.path, 'r') as journal_fd:
+        assert '"failed"' in journal_fd.read()
+
+
+def test_native_outputs_match_dcm2niix(dicom_dataset, tmp_path):
+    dataset = dicom_dataset(study_count=1, serie_count=1)
+    dcm2niix_dict = dicom_to_nifti.convert_dataset(dataset['input_list'], str(tmp_path / 'dcm2niix'), nb_cores=1)
+    native_dict = dicom_to_nifti.convert_dataset(dataset['input_list'], str(tmp_path / 'native'), nb_cores=1,
+                                                 native_conversion=True)
+    dcm2niix_pref, dcm2niix_entry = next(iter(next(iter(dcm2niix_dict.values())).values())).popitem()
+    native_pref, native_entry = next(iter(next(iter(native_dict.values())).values())).popitem()
+    with open(native_entry['json'], 'r') as sidecar_file:
+        assert json.load(sidecar_file)['ConversionSoftware'] == 'data_identification native conversion'
+    # the final dictionaries have the same keys
+    assert native_pref == dcm2niix_pref
+    assert os.path.basename(native_entry['output_path']) == os.path.basename(dcm2niix_entry['output_path'])
+    assert os.path.basename(native_entry['metadata']) == os.path.basename(dcm2niix_entry['metadata'])
+    dcm2niix_image = nib.load(dcm2niix_entry['output_path'])
+    native_image = nib.load(native_entry['output_path'])
+    assert np.array_equal(native_image.get_fdata(), dcm2niix_image.get_fdata())
+    assert np.allclose(native_image.affine, dcm2niix_image.affine)
+
+
+def test_folder_timeout_covers_the_header_scan(dicom_dataset, tmp_path, monkeypatch):
+    dataset = dicom_dataset(study_count=1, serie_count=1)
+    prepare_dicom_folder = dicom_to_nifti.prepare_dicom_folder
+
+    def slow_prepare_dicom_folder(**plan):
+        time.sleep(1)
+        return prepare_dicom_folder(**plan)
+    monkeypatch.setattr(dicom_to_nifti, 'prepare_dicom_folder', slow_prepare_dicom_folder)
+
+    async def collect_events():
+        return [event async for event in dicom_to_nifti.convert_dataset_async(
+            dataset['input_list'], str(tmp_path / 'nifti'), nb_cores=2, folder_timeout=0.2)]
+    start = time.monotonic()
+    # the scan keeps one thread of the executor busy after the timeout, the other one finishes the input
+    event_list = asyncio.run(collect_events())
+    assert time.monotonic() - start < 1
+    assert [(event['event'], event['error']) for event in event_list] == [('folder', 'timeout')]
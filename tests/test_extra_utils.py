@@ -0,0 +1,64 @@
+import os
+import gzip
+import zlib
+from multiprocessing.dummy import Pool as ThreadPool
+
+import numpy as np
+import pytest
+
+from data_identification.modules import dicom_to_nifti, extra_utils
+
+
+def convert_and_aggregate(input_list, output_folder):
+    aggregator = extra_utils.FinalDictAggregator(output_folder, check_integrity=True, nb_cores=1)
+    dicom_to_nifti.convert_dataset(input_list, output_folder, nb_cores=1, aggregator=aggregator)
+    return aggregator.finalize()
+
+
+def test_kept_duplicate_does_not_depend_on_the_order(dicom_dataset, tmp_path):
+    # the first serie of the study is sent again in resend_00000
+    dataset = dicom_dataset(study_count=1, resend_fraction=1.)
+    input_list = dataset['input_list']
+    kept_list = []
+    for ind, ordered_input_list in enumerate([input_list, input_list[::-1]]):
+        output_folder = str(tmp_path / 'nifti{}'.format(ind))
+        final_dict, error_list = convert_and_aggregate(ordered_input_list, output_folder)
+        assert error_list == []
+        assert len(final_dict) == 2
+        kept_list.append(sorted([os.path.relpath(final_dict[key]['output_dir'], output_folder)
+                                 for key in final_dict]))
+        for key in final_dict:
+            assert os.path.exists(final_dict[key]['output_path'])
+    assert kept_list[0] == kept_list[1]
+    # the first output sub-directory in sorted order is kept
+    assert kept_list[0][0] == 'resend_00000'
+
+
+@pytest.mark.parametrize('nb_threads', [1, 4])
+@pytest.mark.parametrize('size', [0, 1000, 5 * extra_utils.gzip_block_size + 123])
+def test_parallel_gzip_round_trip(tmp_path, nb_threads, size):
+    # compressible data with repetitions across the blocks
+    data = np.random.default_rng(size).integers(0, 16, size, dtype=np.uint8).tobytes()
+    path = str(tmp_path / 'data.gz')
+    extra_utils.write_parallel_gzip(path, data, nb_threads=nb_threads)
+    with gzip.open(path, 'rb') as gzip_file:
+        assert gzip_file.read() == data
+    # a single gzip member whose trailer is checked by zlib
+    with open(path, 'rb') as gzip_file:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        assert decompressor.decompress(gzip_file.read()) == data
+        assert decompressor.eof and decompressor.unused_data == b''
+
+
+def test_parallel_gzip_with_a_shared_pool(tmp_path):
+    data = bytes(range(256)) * 2000
+    pool = ThreadPool(3)
+    try:
+        for ind in range(2):
+            path = str(tmp_path / '{}.gz'.format(ind))
+            extra_utils.write_parallel_gzip(path, data, compress_level=9, pool=pool, block_size=4096)
+            with gzip.open(path, 'rb') as gzip_file:
+                assert gzip_file.read() == data
+    finally:
+        pool.close()
+        pool.join()
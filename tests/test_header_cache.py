@@ -0,0 +1,87 @@
+import os
+
+import pydicom
+
+from data_identification.modules import dicom_metadata, header_cache
+from benchmarks import synthetic_dicom
+
+
+def test_hit_miss_and_invalidation(tmp_path):
+    filepath = str(tmp_path / 'file.dcm')
+    with open(filepath, 'wb') as f:
+        f.write(b'header')
+    cache = header_cache.HeaderCache(str(tmp_path / 'cache.sqlite'))
+    try:
+        assert cache.get(filepath, 'full') is None
+        cache.put(filepath, 'full', '["a"]', {'00200013': {'vr': 'IS', 'Value': [3]}})
+        cache.flush()
+        serie_id, header = cache.get(filepath, 'full')
+        assert serie_id == '["a"]' and header.InstanceNumber == 3
+        # another scan mode is another entry
+        assert cache.get(filepath, 'prescan') is None
+        # same size, another modification time
+        stat_result = os.stat(filepath)
+        os.utime(filepath, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 10 ** 9))
+        assert cache.get(filepath, 'full') is None
+        # same modification time, another size
+        with open(filepath, 'ab') as f:
+            f.write(b'!')
+        os.utime(filepath, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+        assert cache.get(filepath, 'full') is None
+        stats = cache.statistics()
+        assert (stats['entries'], stats['hits'], stats['misses']) == (1, 1, 4)
+    finally:
+        cache.close()
+
+
+def test_eviction_of_the_least_recently_used_headers(tmp_path):
+    cache = header_cache.HeaderCache(str(tmp_path / 'cache.sqlite'), max_bytes=1000)
+    try:
+        for ind in range(10):
+            filepath = str(tmp_path / '{}.dcm'.format(ind))
+            open(filepath, 'wb').close()
+            cache.put(filepath, 'full', str(ind), {'tag': 'x' * 180})
+            cache.flush()
+        stats = cache.statistics()
+        assert stats['total_bytes'] <= 1000 and stats['evictions'] > 0
+        assert cache.get(str(tmp_path / '9.dcm'), 'full') is not None
+        assert cache.get(str(tmp_path / '0.dcm'), 'full') is None
+    finally:
+        cache.close()
+
+
+def test_scan_with_the_cache(tmp_path, monkeypatch):
+    dicom_dir = str(tmp_path / 'flat')
+    synthetic_dicom.generate_study(dicom_dir, 0, serie_count=2, slice_count=3, matrix_size=4, flat=True)
+    cache_path = str(tmp_path / 'cache.sqlite')
+    expected = dicom_metadata.scan_dicomdir(dicom_dir, '%p_%t_%s', incremental=True)
+    read_list = []
+    dcmread = pydicom.dcmread
+
+    def counted_dcmread(filepath, *args, **kwargs):
+        read_list.append(filepath)
+        return dcmread(filepath, *args, **kwargs)
+    monkeypatch.setattr(pydicom, 'dcmread', counted_dcmread)
+    for incremental in [True, False]:
+        for _ in range(2):
+            del read_list[:]
+            series = dicom_metadata.scan_dicomdir(dicom_dir, '%p_%t_%s', incremental=incremental,
+                                                  cache_path=cache_path)
+            assert sorted(series) == sorted(expected)
+            for s in series:
+                assert sorted(series[s].file_list) == sorted(expected[s].file_list)
+                assert series[s].generate_metadata() == expected[s].generate_metadata()
+    # the second scans only read the cache
+    assert read_list == []
+    # a modified file is read again
+    modified_path = sorted(os.listdir(dicom_dir))[0]
+    ds = dcmread(os.path.join(dicom_dir, modified_path))
+    ds.InstanceNumber = 100
+    ds.save_as(os.path.join(dicom_dir, modified_path))
+    series = dicom_metadata.scan_dicomdir(dicom_dir, '%p_%t_%s', incremental=True, cache_path=cache_path)
+    assert read_list == [os.path.join(dicom_dir, modified_path)]
+    assert sum([len(series[s].file_list) for s in series]) == 6
+    cache = header_cache.HeaderCache(cache_path)
+    stats = cache.statistics()
+    cache.close()
+    assert stats['entries'] == 6 and stats['misses'] == 6 + 1
@@ -0,0 +1,52 @@
+import os
+
+from data_identification.modules import dicom_to_nifti, extra_utils, metadata_catalog
+
+
+def test_catalog_after_duplicate_removal(dicom_dataset, tmp_path):
+    # the first serie of the study is sent again in resend_00000
+    dataset = dicom_dataset(study_count=1, resend_fraction=1.)
+    output_folder = str(tmp_path / 'nifti')
+    catalog_path = os.path.join(output_folder, metadata_catalog.default_catalog_filename)
+    aggregator = extra_utils.FinalDictAggregator(output_folder, check_integrity=True, nb_cores=1,
+                                                 catalog_path=catalog_path)
+    dicom_to_nifti.convert_dataset(dataset['input_list'], output_folder, nb_cores=1, aggregator=aggregator,
+                                   use_catalog=True)
+    catalog = metadata_catalog.MetadataCatalog(catalog_path)
+    assert len(catalog.select()) == 3
+    catalog.close()
+    final_dict, _ = aggregator.finalize()
+    catalog = metadata_catalog.MetadataCatalog(catalog_path)
+    row_list = catalog.select()
+    catalog.close()
+    assert sorted([row['prefix'] for row in row_list]) == sorted(final_dict)
+    for row in row_list:
+        assert row['output_path'] == final_dict[row['prefix']]['output_path']
+        assert os.path.exists(row['output_path'])
+        assert os.path.exists(row['json'])
+
+
+def test_metadata_of_a_morning_study(dicom_dataset, tmp_path):
+    # the synthetic studies are acquired at 08:00:0x and converted with the default format '%p_%t_%s'
+    dataset = dicom_dataset(study_count=1)
+    output_folder = str(tmp_path / 'nifti')
+    catalog_path = os.path.join(output_folder, metadata_catalog.default_catalog_filename)
+    converted_dict = dicom_to_nifti.convert_dataset(dataset['input_list'], output_folder, nb_cores=1,
+                                                    use_catalog=True)
+    output_dict = {}
+    for root_dir in converted_dict:
+        for output_subdirectory in converted_dict[root_dir]:
+            output_dict.update(converted_dict[root_dir][output_subdirectory])
+    assert len(output_dict) == 2
+    for pref in output_dict:
+        assert '_20200101080000_' in pref
+        assert os.path.exists(output_dict[pref]['metadata'])
+    catalog = metadata_catalog.MetadataCatalog(catalog_path)
+    row_list = catalog.select()
+    catalog.close()
+    assert len(row_list) == 2
+    for row in row_list:
+        assert row['metadata'] == output_dict[row['prefix']]['metadata']
+        assert row['Manufacturer'] == 'SIEMENS'
+        assert row['EchoTime'] is not None
+        assert row['file_count'] == 3
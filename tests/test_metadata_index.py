@@ -0,0 +1,37 @@
+from data_identification.modules import dicom_to_nifti, metadata_index
+
+
+def convert_and_index(dicom_dataset, tmp_path, **dataset_parameters):
+    dataset = dicom_dataset(**dataset_parameters)
+    output_folder = str(tmp_path / 'nifti')
+    dicom_to_nifti.convert_dataset(dataset['input_list'], output_folder, nb_cores=1)
+    index = metadata_index.MetadataIndex(str(tmp_path / 'index.sqlite'))
+    index.update(output_folder)
+    return index
+
+
+def test_like_wildcards_are_matched_literally(dicom_dataset, tmp_path):
+    # the ProtocolName of the series are study[i]_serie[j], acquired at 08:00:0x
+    index = convert_and_index(dicom_dataset, tmp_path, study_count=1)
+    try:
+        assert len(index.query(['Modality=MR'])) == 2
+        assert len(index.query(['ProtocolName~serie'])) == 2
+        assert len(index.query(['ProtocolName~0_SERIE1'])) == 1
+        assert index.query(['ProtocolName~study_']) == []
+        assert index.query(['ProtocolName~study%serie']) == []
+    finally:
+        index.close()
+
+
+def test_fields_with_a_value_per_file_are_not_indexed(dicom_dataset, tmp_path):
+    index = convert_and_index(dicom_dataset, tmp_path, study_count=1, serie_count=1,
+                              slice_count=metadata_index.max_varying_values + 1)
+    try:
+        assert len(index.query(['EchoTime=2.5'])) == 1
+        # InstanceNumber and SliceLocation have one value per file
+        assert index.query(['InstanceNumber=1']) == []
+        row_count, = index._connection.execute(
+            "SELECT COUNT(*) FROM field_values WHERE field IN ('SOPInstanceUID', 'SliceLocation')").fetchone()
+        assert row_count == 0
+    finally:
+        index.close()
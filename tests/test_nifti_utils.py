@@ -0,0 +1,77 @@
+import os
+import gzip
+
+import numpy as np
+import nibabel as nib
+
+from data_identification.modules import nifti_utils
+
+
+def create_dwi(folder, name='dwi', volume_count=4):
+    img_path = os.path.join(folder, name + '.nii.gz')
+    data = np.arange(4 * 4 * 3 * volume_count, dtype=np.int16).reshape((4, 4, 3, volume_count))
+    nib.save(nib.Nifti1Image(data, np.eye(4)), img_path)
+    np.savetxt(os.path.join(folder, name + '.bval'), np.array([[0, 1000, 2000, 3000][:volume_count]]), fmt='%d')
+    return img_path
+
+
+def test_split_type_change_on_resume(tmp_path):
+    img_path = create_dwi(str(tmp_path))
+    output_folder = str(tmp_path / 'split')
+    os.makedirs(output_folder)
+    dwi_dict, failed_dict = nifti_utils.split_dataset([img_path], output_folder, split_type='dwi', nb_cores=1,
+                                                      parallel_mode='thread')
+    assert failed_dict == {}
+    assert len(dwi_dict) == 4 and 'unlabelled' not in dwi_dict.values()
+    # same output folder and default journal, the dwi labels must not be returned for the unlabelled split
+    unlabelled_dict, failed_dict = nifti_utils.split_dataset([img_path], output_folder, split_type='unlabelled',
+                                                             nb_cores=1, parallel_mode='thread')
+    assert failed_dict == {}
+    assert sorted(unlabelled_dict) == [os.path.join(output_folder, 'dwi_unlabelled_{}.nii.gz'.format(ind))
+                                       for ind in range(4)]
+    assert set(unlabelled_dict.values()) == {'unlabelled'}
+    # nothing changed since the unlabelled split
+    resumed_dict, _ = nifti_utils.split_dataset([img_path], output_folder, split_type='unlabelled', nb_cores=1,
+                                                parallel_mode='thread')
+    assert resumed_dict == unlabelled_dict
+
+
+def test_volume_loader_reads_the_images_once(tmp_path, monkeypatch):
+    data = np.arange(4 * 4 * 3 * 2, dtype=np.int16).reshape((4, 4, 3, 2))
+    plain_path = str(tmp_path / 'plain.nii')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), plain_path)
+    scaled_img = nib.Nifti1Image(data, np.eye(4))
+    scaled_img.header.set_slope_inter(2., 1.)
+    scaled_path = str(tmp_path / 'scaled.nii')
+    nib.save(scaled_img, scaled_path)
+    read_list = []
+    asanyarray = np.asanyarray
+
+    def counted_asanyarray(a, *args, **kwargs):
+        if isinstance(a, nib.arrayproxy.ArrayProxy):
+            read_list.append(a.file_like)
+        return asanyarray(a, *args, **kwargs)
+    monkeypatch.setattr(nifti_utils.np, 'asanyarray', counted_asanyarray)
+    loader = nifti_utils.VolumeLoader()
+    assert isinstance(loader.load(nifti_utils.volume_handle(plain_path, 1)).base, np.memmap)
+    assert np.array_equal(loader.load(nifti_utils.volume_handle(scaled_path, 1)), data[..., 1] * 2. + 1.)
+    assert read_list == [plain_path, scaled_path]
+    # the scaled image does not fit in the cache, it is read volume by volume and never as a whole
+    read_list.clear()
+    small_loader = nifti_utils.VolumeLoader(max_cache_bytes=data.size * 4)
+    assert np.array_equal(small_loader.load(nifti_utils.volume_handle(scaled_path, 0)), data[..., 0] * 2. + 1.)
+    assert read_list == []
+
+
+def test_parallel_compression_is_read_by_nibabel(tmp_path):
+    data = np.arange(32 * 32 * 16, dtype=np.int16).reshape((32, 32, 16))
+    img = nib.Nifti1Image(data, np.diag([2., 2., 3., 1.]))
+    parallel_path = str(tmp_path / 'parallel.nii.gz')
+    gzip_path = str(tmp_path / 'gzip.nii.gz')
+    nifti_utils.save_nifti(img, parallel_path, compression='parallel')
+    nifti_utils.save_nifti(img, gzip_path, compression='gzip')
+    parallel_img = nib.load(parallel_path)
+    assert np.array_equal(np.asanyarray(parallel_img.dataobj), data)
+    assert np.array_equal(parallel_img.affine, img.affine)
+    with gzip.open(parallel_path, 'rb') as parallel_file, gzip.open(gzip_path, 'rb') as gzip_file:
+        assert parallel_file.read() == gzip_file.read()
@@ -0,0 +1,46 @@
+import os
+import json
+
+from data_identification.modules import dicom_to_nifti, uid_index
+
+
+def test_claim_series(tmp_path):
+    index = uid_index.UidIndex(str(tmp_path / 'index.sqlite'))
+    try:
+        assert index.claim_series('a', {'s1': ('1.2', ['1', '2', '3']), 's2': ('1.3', ['4', None])}) == {}
+        # every instance already claimed by s1 of 'a'
+        assert index.claim_series('b', {'s1': ('1.2', ['3', '1', '2'])}) == {'s1': ('a', 's1')}
+        # partial overlap, or files without SOPInstanceUID
+        assert index.claim_series('c', {'s1': ('1.2', ['1', '2', '5']), 's2': ('1.3', ['4', None])}) == {}
+        assert [(s['input_folder'], s['serie_id'], s['duplicate_of_folder'], s['file_count'])
+                for s in index.skipped_list()] == [('b', 's1', 'a', 3)]
+        # claiming the folder again replaces its claims
+        assert index.claim_series('a', {'s1': ('1.2', ['1', '2', '3'])}) == {}
+        assert index.claim_series('b', {'s1': ('1.2', ['1', '2', '3'])}) == {'s1': ('a', 's1')}
+        assert len(index.skipped_list()) == 1
+    finally:
+        index.close()
+
+
+def test_duplicated_serie_is_not_converted(dicom_dataset, tmp_path, monkeypatch):
+    # the first serie of the study is sent again in resend_00000
+    dataset = dicom_dataset(study_count=1, resend_fraction=1.)
+    converted_list = []
+    run_dcm2niix_job = dicom_to_nifti.run_dcm2niix_job
+
+    def recorded_run_dcm2niix_job(job):
+        converted_list.append((job['dicom_dir'], sorted(job['series'])))
+        return run_dcm2niix_job(job)
+    monkeypatch.setattr(dicom_to_nifti, 'run_dcm2niix_job', recorded_run_dcm2niix_job)
+    output_folder = str(tmp_path / 'nifti')
+    converted_dict = dicom_to_nifti.convert_dataset(dataset['input_list'], output_folder, nb_cores=1,
+                                                    deduplicate=True)
+    # the copy of the first serie is skipped before dcm2niix
+    serie_list = [s for _, series in converted_list for s in series]
+    assert len(serie_list) == 2 and len(set(serie_list)) == 2
+    output_list = [pref for root_dir in converted_dict for output_subdirectory in converted_dict[root_dir]
+                   for pref in converted_dict[root_dir][output_subdirectory]]
+    assert len(output_list) == 2
+    with open(os.path.join(output_folder, uid_index.default_report_filename), 'r') as report_file:
+        skipped_list = json.load(report_file)
+    assert len(skipped_list) == 1 and skipped_list[0]['file_count'] == 3